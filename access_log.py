@@ -0,0 +1,406 @@
+"""
+结构化访问日志与离线分析
+
+init_app 在 WSGI 层包装应用，每个请求结束（流式响应输出完毕或客户端断开）时向 data/logs/access.log
+追加一行 JSON：状态码、请求体大小、实际输出的字节数、首字节耗时（TTFT）、总耗时，
+以及生成接口的结果（success / error / cancelled）、最终使用的路由、模型与后端。
+文件超过 MAX_BYTES 时改名轮转，并在后台压缩为 .gz；NOVEL_ACCESS_LOG=0 时不记录。
+
+分析命令逐行读取日志（支持轮转后的 .gz，以及 nohup.out 中 Werkzeug 的访问行），
+按路由与时间段输出吞吐量、耗时分位数与错误率，内存占用与日志大小无关：
+
+    python access_log.py report
+    python access_log.py report nohup.out data/logs/ --bucket 15m --path /gen
+"""
+import argparse
+import glob
+import gzip
+import json
+import logging
+import math
+import os
+import re
+import shutil
+import sys
+import threading
+import time
+from datetime import datetime, timedelta
+
+from common import DATA_DIR, ensure_dir
+from shared_state import file_lock
+from token_estimator import route_models
+from tracing import tracer
+
+logger = logging.getLogger(__name__)
+
+LOG_DIR = os.path.join(DATA_DIR, 'logs')
+LOG_NAME = 'access.log'
+MAX_BYTES = 64 * 1024 * 1024
+KEEP_ROTATED = 30
+
+
+class AccessLog:
+    """
+    多个 worker 在 file_lock 下追加同一个文件；轮转只做改名，压缩在锁外的后台线程中进行
+    """
+
+    def __init__(self, path: str, max_bytes: int = MAX_BYTES, keep: int = KEEP_ROTATED):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.keep = keep
+
+    def write(self, record: dict):
+        line = json.dumps(record, ensure_ascii=False) + '\n'
+        rotated = None
+        with file_lock(self.path):
+            if os.path.exists(self.path) and os.path.getsize(self.path) >= self.max_bytes:
+                rotated = f'{self.path}.{datetime.now():%Y%m%d-%H%M%S-%f}'
+                os.replace(self.path, rotated)
+            with open(self.path, 'a', encoding='utf-8') as f:
+                f.write(line)
+        if rotated:
+            threading.Thread(target=self.compress, args=(rotated,), name='access-log-gzip', daemon=True).start()
+
+    def compress(self, path: str):
+        try:
+            # 先写临时文件再改名，读取方不会看到写了一半的 .gz
+            with open(path, 'rb') as src, gzip.open(path + '.gz.tmp', 'wb') as dst:
+                shutil.copyfileobj(src, dst)
+            os.replace(path + '.gz.tmp', path + '.gz')
+            os.remove(path)
+            for old in rotated_files(self.path)[:-self.keep]:
+                os.remove(old)
+        except OSError as e:
+            logger.error(f"Failed to compress rotated access log {path}: {e}")
+
+
+def rotated_files(path: str) -> list:
+    """
+    轮转后的文件，按时间从旧到新（文件名中的时间戳可直接排序）。
+    压缩完成到删除原文件之间两者同时存在，此时只取 .gz，避免重复统计
+    """
+    files = {p for p in glob.glob(glob.escape(path) + '.*') if not p.endswith(('.lock', '.tmp'))}
+    return sorted(p for p in files if p + '.gz' not in files)
+
+
+class LoggedBody:
+    """
+    包装响应的可迭代对象：统计输出字节与首字节耗时，WSGI 服务器调用 close() 时写入日志
+    """
+
+    def __init__(self, body, record: dict, started: float, middleware):
+        self.body = body
+        self.record = record
+        self.started = started
+        self.middleware = middleware
+        self.sent = 0
+        self.first = None
+        self.exhausted = False
+
+    def __iter__(self):
+        for chunk in self.body:
+            if chunk and self.first is None:
+                self.first = time.monotonic()
+            self.sent += len(chunk)
+            yield chunk
+        self.exhausted = True
+
+    def close(self):
+        try:
+            close = getattr(self.body, 'close', None)
+            if close:
+                close()
+        finally:
+            self.middleware.finish(self.record, self.started, self)
+
+
+class AccessLogMiddleware:
+    def __init__(self, wsgi_app, log: AccessLog, provider: str = None):
+        self.wsgi_app = wsgi_app
+        self.log = log
+        self.provider = provider
+
+    def __call__(self, environ, start_response):
+        started = time.monotonic()
+        record = {
+            'time': datetime.now().isoformat(timespec='milliseconds'),
+            'method': environ.get('REQUEST_METHOD'),
+            'path': environ.get('PATH_INFO'),
+            'client': environ.get('REMOTE_ADDR'),
+            # 解压前的大小；decompress_request 之后 CONTENT_LENGTH 会被移除
+            'request_bytes': int(environ.get('CONTENT_LENGTH') or 0),
+            'status': None
+        }
+
+        def logged_start_response(status, headers, exc_info=None):
+            record['status'] = int(status.split(' ', 1)[0])
+            record['request_id'] = next((v for k, v in headers if k.lower() == 'x-request-id'), None)
+            return start_response(status, headers, exc_info)
+
+        try:
+            body = self.wsgi_app(environ, logged_start_response)
+        except BaseException:
+            record['status'] = 500
+            self.finish(record, started, None)
+            raise
+        return LoggedBody(body, record, started, self)
+
+    def finish(self, record: dict, started: float, body):
+        now = time.monotonic()
+        record['response_bytes'] = body.sent if body else 0
+        record['ttft_ms'] = round((body.first - started) * 1000, 1) if body and body.first else None
+        record['duration_ms'] = round((now - started) * 1000, 1)
+        if body and not body.exhausted:
+            record['disconnected'] = True
+        record['provider'] = self.provider
+        # 生成接口的结果以 Trace 为准：出错时状态码仍是 200，错误信息在流中
+        trace = tracer.get(record['request_id']) if record.get('request_id') else None
+        if trace is not None:
+            attempts = [s for s in trace.spans if s['name'] == 'attempt']
+            route = attempts[-1]['route'] if attempts else trace.name
+            record.update({'outcome': trace.status, 'route': route, 'model': route_models.get(route),
+                           'attempts': len(attempts)})
+        try:
+            self.log.write(record)
+        except OSError as e:
+            logger.error(f"Failed to write access log: {e}")
+
+
+def backend_name(app) -> str:
+    """
+    后端名称取自应用所在的文件名：app-claude.py -> claude，app.py -> app
+    """
+    module = sys.modules.get(app.import_name)
+    path = getattr(module, '__file__', None) or app.import_name
+    name = os.path.splitext(os.path.basename(path))[0]
+    return name[4:] if name.startswith('app-') else name
+
+
+def init_access_log(app):
+    if os.environ.get('NOVEL_ACCESS_LOG') == '0':
+        return
+    log = AccessLog(os.path.join(ensure_dir(LOG_DIR), LOG_NAME))
+    app.wsgi_app = AccessLogMiddleware(app.wsgi_app, log, backend_name(app))
+
+
+# ---- 离线分析 ----
+
+WERKZEUG_LINE = re.compile(
+    r'(?P<client>\S+) - - \[(?P<time>[^\]]+)\] "(?P<method>[A-Z]+) (?P<path>\S+) [^"]*" (?P<status>\d{3}) (?P<size>\S+)'
+)
+ANSI_ESCAPE = re.compile(r'\x1b\[[0-9;]*m')
+ID_SEGMENT = re.compile(r'/(?:\d+|[0-9a-f]{8,}|[0-9a-f-]{36})(?=/|$)')
+BUCKETS = {'1m': 60, '5m': 300, '15m': 900, '1h': 3600, '1d': 86400}
+
+
+class Histogram:
+    """
+    对数分桶的耗时直方图（相邻桶相差 5%），分位数误差在 5% 以内，内存占用固定
+    """
+    GROWTH = 1.05
+
+    def __init__(self):
+        self.counts = {}
+        self.total = 0
+
+    def add(self, value: float):
+        index = 0 if value <= 1 else int(math.log(value, self.GROWTH)) + 1
+        self.counts[index] = self.counts.get(index, 0) + 1
+        self.total += 1
+
+    def percentile(self, p: float):
+        if not self.total:
+            return None
+        rank = math.ceil(self.total * p)
+        seen = 0
+        for index in sorted(self.counts):
+            seen += self.counts[index]
+            if seen >= rank:
+                return round(self.GROWTH ** index, 1) if index else 1.0
+        return None
+
+
+class RouteStats:
+    def __init__(self):
+        self.requests = 0
+        self.server_errors = 0
+        self.client_errors = 0
+        self.failed = 0  # 状态码为 200 但生成失败
+        self.cancelled = 0
+        self.bytes = 0
+        self.duration = Histogram()
+        self.ttft = Histogram()
+
+    def add(self, record: dict):
+        self.requests += 1
+        status = record.get('status') or 0
+        if status >= 500:
+            self.server_errors += 1
+        elif status >= 400:
+            self.client_errors += 1
+        elif record.get('outcome') == 'error':
+            self.failed += 1
+        if record.get('outcome') == 'cancelled' or record.get('disconnected'):
+            self.cancelled += 1
+        self.bytes += record.get('response_bytes') or 0
+        if record.get('duration_ms') is not None:
+            self.duration.add(record['duration_ms'])
+        if record.get('ttft_ms') is not None:
+            self.ttft.add(record['ttft_ms'])
+
+    def to_dict(self, seconds: float) -> dict:
+        return {
+            'requests': self.requests,
+            'rpm': round(self.requests / seconds * 60, 2),
+            'bytes_per_second': round(self.bytes / seconds, 1),
+            'error_rate': round((self.server_errors + self.failed) / self.requests, 4),
+            'client_errors': self.client_errors,
+            'cancelled': self.cancelled,
+            'p50_ms': self.duration.percentile(0.5),
+            'p90_ms': self.duration.percentile(0.9),
+            'p99_ms': self.duration.percentile(0.99),
+            'ttft_p50_ms': self.ttft.percentile(0.5),
+            'ttft_p95_ms': self.ttft.percentile(0.95)
+        }
+
+
+def expand_paths(paths: list) -> list:
+    """
+    目录展开为其中的 access.log 与轮转文件（从旧到新）；未指定时使用 data/logs
+    """
+    files = []
+    for path in paths or [LOG_DIR]:
+        if os.path.isdir(path):
+            current = os.path.join(path, LOG_NAME)
+            files += rotated_files(current) + ([current] if os.path.exists(current) else [])
+        else:
+            files.append(path)
+    return files
+
+
+def read_lines(path: str):
+    opener = gzip.open if path.endswith('.gz') else open
+    with opener(path, 'rt', encoding='utf-8', errors='replace') as f:
+        yield from f
+
+
+def parse_line(line: str):
+    """
+    解析一行日志，返回记录或 None；Werkzeug 的访问行没有耗时与输出字节，只计入请求数与状态码
+    """
+    line = line.strip()
+    if line.startswith('{'):
+        try:
+            record = json.loads(line)
+            record['time'] = datetime.fromisoformat(record['time'])
+            return record
+        except (ValueError, KeyError, TypeError):
+            return None
+    match = WERKZEUG_LINE.search(ANSI_ESCAPE.sub('', line))
+    if not match:
+        return None
+    try:
+        when = datetime.strptime(match['time'], '%d/%b/%Y %H:%M:%S')
+    except ValueError:
+        return None
+    return {'time': when, 'method': match['method'], 'path': match['path'], 'status': int(match['status']),
+            'response_bytes': int(match['size']) if match['size'].isdigit() else 0}
+
+
+def route_key(record: dict) -> str:
+    path = record.get('path') or ''
+    path = path.split('?', 1)[0]
+    if record.get('status') == 404:
+        # 扫描器探测的各种路径合并为一行
+        return '(404)'
+    if path.startswith('/static/'):
+        return '/static/*'
+    return f"{record.get('method')} {ID_SEGMENT.sub('/:id', path)}"
+
+
+def analyze(paths: list, bucket: int = 3600, path_prefix: str = None, since: datetime = None,
+            until: datetime = None) -> dict:
+    buckets = {}
+    totals = {}
+    span = [None, None]
+    skipped = 0
+    for path in expand_paths(paths):
+        for line in read_lines(path):
+            record = parse_line(line)
+            if record is None:
+                skipped += 1
+                continue
+            when = record['time']
+            if (since and when < since) or (until and when >= until):
+                continue
+            if path_prefix and not (record.get('path') or '').startswith(path_prefix):
+                continue
+            key = route_key(record)
+            start = datetime.fromtimestamp(when.timestamp() // bucket * bucket)
+            buckets.setdefault((start, key), RouteStats()).add(record)
+            totals.setdefault(key, RouteStats()).add(record)
+            span[0] = when if span[0] is None else min(span[0], when)
+            span[1] = when if span[1] is None else max(span[1], when)
+
+    if span[0] is None:
+        return {'routes': [], 'buckets': [], 'skipped_lines': skipped}
+    overall = max((span[1] - span[0]).total_seconds(), 1)
+    return {
+        'from': span[0].isoformat(),
+        'to': span[1].isoformat(),
+        'skipped_lines': skipped,
+        'routes': sorted(({'route': key, **stats.to_dict(overall)} for key, stats in totals.items()),
+                         key=lambda row: -row['requests']),
+        'buckets': [{'bucket': start.isoformat(), 'route': key, **stats.to_dict(bucket)}
+                    for (start, key), stats in sorted(buckets.items())]
+    }
+
+
+MAX_ROUTE_WIDTH = 48
+COLUMNS = ('requests', 'rpm', 'error_rate', 'cancelled', 'p50_ms', 'p90_ms', 'p99_ms', 'ttft_p50_ms', 'ttft_p95_ms')
+
+
+def format_table(rows: list, first: tuple) -> str:
+    headers = list(first) + list(COLUMNS)
+    cells = [[str(row[h])[:MAX_ROUTE_WIDTH] if row[h] is not None else '-' for h in headers] for row in rows]
+    widths = [max(len(h), *(len(c[i]) for c in cells)) for i, h in enumerate(headers)]
+    lines = ['  '.join(h.ljust(w) for h, w in zip(headers, widths))]
+    lines += ['  '.join(c.ljust(w) for c, w in zip(cell, widths)) for cell in cells]
+    return '\n'.join(lines)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='分析访问日志：按路由与时间段统计吞吐量、耗时分位数与错误率')
+    sub = parser.add_subparsers(dest='command', required=True)
+    report = sub.add_parser('report', help='输出分析报告')
+    report.add_argument('paths', nargs='*', help='日志文件或目录，支持 .gz 与 nohup.out，默认 data/logs')
+    report.add_argument('--bucket', default='1h', choices=BUCKETS)
+    report.add_argument('--path', help='只统计以此开头的路径，如 /gen')
+    report.add_argument('--since', help='开始时间，如 2025-03-18 或 2025-03-18T09:00')
+    report.add_argument('--until', help='结束时间（不含）')
+    report.add_argument('--last', help='只看最近一段时间，如 24h、7d')
+    report.add_argument('--json', action='store_true', help='以 JSON 输出')
+    args = parser.parse_args()
+
+    since = datetime.fromisoformat(args.since) if args.since else None
+    until = datetime.fromisoformat(args.until) if args.until else None
+    if args.last:
+        unit = {'m': 'minutes', 'h': 'hours', 'd': 'days'}.get(args.last[-1:])
+        if unit is None or not args.last[:-1].isdigit():
+            parser.error('--last 的格式应为数字加 m、h 或 d，如 24h')
+        since = datetime.now() - timedelta(**{unit: int(args.last[:-1])})
+    result = analyze(args.paths, BUCKETS[args.bucket], args.path, since, until)
+    if args.json:
+        print(json.dumps(result, ensure_ascii=False, indent=2))
+        return
+    if not result['routes']:
+        print('没有匹配的日志记录')
+        return
+    print(f"{result['from']} ~ {result['to']}（跳过 {result['skipped_lines']} 行非访问日志）\n")
+    print(format_table(result['routes'], ('route',)))
+    print()
+    print(format_table(result['buckets'], ('bucket', 'route')))
+
+
+if __name__ == '__main__':
+    main()
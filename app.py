@@ -1,6 +1,17 @@
+from contextlib import closing
 from flask import Flask, request, Response, render_template
 from openai import OpenAI
+import httpx
 import logging
+from cassettes import cassette_http_client
+from extensions import init_app
+from model_router import resolve_routed_prompt
+from prompt_registry import prompt_error_response
+from request_body import read_json
+from scheduler import QuotaExceeded, admit_request, quota_error_response, with_queue_headers
+from streaming import guard_stream, resilient_stream, socket_timeout
+from tracing import first_byte, span, start_trace
+from usage_ledger import Usage, request_tags
 
 app = Flask(__name__)
 logging.basicConfig(level=logging.DEBUG)
@@ -15,71 +26,88 @@ API_KEY_2 = 'UgC44uW-z-fLNadND-fL81yBXYG3B2T9fIWHFuEnWAA'
 # Initialize OpenAI clients
 client1 = OpenAI(
     base_url=API_ENDPOINT_1,
-    api_key=API_KEY_1
+    api_key=API_KEY_1,
+    http_client=cassette_http_client('app')
 )
 
 client2 = OpenAI(
     base_url=API_ENDPOINT_2,
-    api_key=API_KEY_2
+    api_key=API_KEY_2,
+    http_client=cassette_http_client('app')
 )
 
 @app.route('/bingte')
 def index():
     return render_template('index.html')
 
-@app.route('/gen', methods=['POST'])
-def generate():
-    data = request.json
-    prompt = data.get('prompt', '')
-    app.logger.debug(f"Received prompt for gen: {prompt}")
+# /gen 为效果较好的模型，/gen2 为低成本模型
+ROUTES = {
+    'gen': {'client': client1, 'model': 'Claude-3.5-Sonnet'},
+    'gen2': {'client': client2, 'model': 'Qwen2.5-72B-I-128K'},
+}
+
+def stream_completion(route, prompt):
+    """
+    按路由调用对应模型，逐块返回生成的文本
+    """
+    config = ROUTES[route]
+    connect_timeout, read_timeout = socket_timeout(route)
+    with span('upstream_connect'):
+        completion = config['client'].chat.completions.create(
+            model=config['model'],
+            messages=[{"role": "user", "content": prompt}],
+            stream=True,
+            stream_options={"include_usage": True},
+            timeout=httpx.Timeout(read_timeout, connect=connect_timeout)
+        )
+
+    app.logger.debug(f"Stream created successfully for {route}")
+
+    try:
+        for chunk in first_byte(completion):
+            if chunk.choices and chunk.choices[0].delta.content is not None:
+                yield chunk.choices[0].delta.content
+            # include_usage 时最后一块没有 choices，只带整次调用的用量
+            if chunk.usage:
+                yield Usage(config['model'], chunk.usage.prompt_tokens, chunk.usage.completion_tokens)
+    finally:
+        # 调用方提前结束时关闭上游连接，不再继续接收输出
+        completion.close()
+
+def stream_route(route):
+    trace = start_trace(route)
+    with trace.span('parse_body'):
+        data = read_json()
+    try:
+        prompt, route = resolve_routed_prompt(data, route)
+    except (LookupError, ValueError) as e:
+        return prompt_error_response(e)
+    try:
+        ticket = admit_request(data)
+    except QuotaExceeded as e:
+        return quota_error_response(e)
+    tags = request_tags(data)
+    app.logger.debug(f"Received prompt for {route} ({len(prompt)} chars)")
     
     def generate_stream():
-        try:
-            completion = client1.chat.completions.create(
-                model="Claude-3.5-Sonnet",
-                messages=[{"role": "user", "content": prompt}],
-                stream=True
-            )
-            
-            app.logger.debug("Stream created successfully for gen")
-            
-            for chunk in completion:
-                if chunk.choices[0].delta.content is not None:
-                    app.logger.debug(f"Yielding chunk: {chunk.choices[0].delta.content}")
-                    yield chunk.choices[0].delta.content
-                    
-        except Exception as e:
-            app.logger.error(f"Error in generate_stream: {e}")
-            yield f"Error: {str(e)}"
+        with closing(resilient_stream(stream_completion, route, prompt, ticket=ticket, tags=tags, trace=trace)) as chunks:
+            for content in chunks:
+                app.logger.debug(f"Yielding chunk: {content}")
+                yield content
     
-    return Response(generate_stream(), mimetype='text/plain')
+    # 客户端断开时由 guard_stream 关闭上游并记录为 cancelled
+    response = Response(guard_stream(route, generate_stream(), trace=trace), mimetype='text/plain')
+    return with_queue_headers(response, ticket)
+
+@app.route('/gen', methods=['POST'])
+def generate():
+    return stream_route('gen')
 
 @app.route('/gen2', methods=['POST'])
 def generate2():
-    data = request.json
-    prompt = data.get('prompt', '')
-    app.logger.debug(f"Received prompt for gen2: {prompt}")
-    
-    def generate_stream():
-        try:
-            completion = client2.chat.completions.create(
-                model="Qwen2.5-72B-I-128K",
-                messages=[{"role": "user", "content": prompt}],
-                stream=True
-            )
-            
-            app.logger.debug("Stream created successfully for gen2")
-            
-            for chunk in completion:
-                if chunk.choices[0].delta.content is not None:
-                    app.logger.debug(f"Yielding chunk: {chunk.choices[0].delta.content}")
-                    yield chunk.choices[0].delta.content
-                    
-        except Exception as e:
-            app.logger.error(f"Error in generate_stream: {e}")
-            yield f"Error: {str(e)}"
-    
-    return Response(generate_stream(), mimetype='text/plain')
+    return stream_route('gen2')
+
+init_app(app, stream_completion, models={route: config['model'] for route, config in ROUTES.items()})
 
 if __name__ == '__main__':
     app.run(debug=True, port=60001, host="0.0.0.0")
@@ -2,6 +2,16 @@ from flask import Flask, request, Response, render_template
 import openai
 import json
 import logging
+from contextlib import closing
+from cassettes import cassette_session, store as cassettes
+from extensions import init_app
+from model_router import resolve_routed_prompt
+from prompt_registry import prompt_error_response
+from request_body import read_json
+from scheduler import QuotaExceeded, admit_request, quota_error_response, with_queue_headers
+from streaming import guard_stream, resilient_stream, socket_timeout
+from tracing import first_byte, span, start_trace
+from usage_ledger import Usage, key_label, request_tags
 
 app = Flask(__name__)
 logging.basicConfig(level=logging.DEBUG)
@@ -9,62 +19,96 @@ logging.basicConfig(level=logging.DEBUG)
 # OpenAI API configuration
 openai.api_key = "your-api-key-here"  # Consider using environment variables
 OPENAI_MODEL = "gpt-3.5-turbo"  # Or "gpt-4" depending on your needs
+if cassettes.enabled:
+    # SDK 的请求改由挂载了 cassette 适配器的 Session 发送
+    openai.requestssession = cassette_session('chatgpt')
 
 @app.route('/')
 def index():
     return render_template('index.html')
 
+def stream_completion(route, prompt, api_key=None, model=None):
+    """
+    只有一个模型配置，gen 与 gen2 共用；逐块返回生成的文本
+    """
+    # Create messages format required by OpenAI
+    messages = [{"role": "user", "content": prompt}]
+    
+    # Make API call with streaming
+    with span('upstream_connect'):
+        response = openai.ChatCompletion.create(
+            model=model or OPENAI_MODEL,
+            messages=messages,
+            stream=True,
+            stream_options={"include_usage": True},
+            api_key=api_key or openai.api_key,
+            request_timeout=socket_timeout(route)
+        )
+
+    app.logger.debug(f"Started streaming from OpenAI for {route}")
+
+    try:
+        for chunk in first_byte(response):
+            if chunk and chunk.choices and chunk.choices[0].delta.get('content'):
+                yield chunk.choices[0].delta.content
+            # include_usage 时最后一块的 choices 为空，只带整次调用的用量
+            if chunk and chunk.get('usage'):
+                yield Usage(model or OPENAI_MODEL, chunk.usage.get('prompt_tokens'),
+                            chunk.usage.get('completion_tokens'), key=key_label(api_key or openai.api_key))
+    finally:
+        # 调用方提前结束时关闭上游流，不再继续接收输出
+        response.close()
+
+def format_error(e):
+    if isinstance(e, openai.error.OpenAIError):
+        app.logger.error(f"OpenAI API error: {e}")
+    else:
+        app.logger.error(f"General error: {e}")
+    error_response = {
+        "error": str(e),
+        "response": f"Error: {str(e)}"
+    }
+    return json.dumps(error_response) + '\n'
+
 @app.route('/gen', methods=['POST'])
 def generate():
-    data = request.json
-    prompt = data.get('prompt', '')
+    trace = start_trace('gen')
+    with trace.span('parse_body'):
+        data = read_json()
+    try:
+        prompt, route = resolve_routed_prompt(data, 'gen')
+    except (LookupError, ValueError) as e:
+        return prompt_error_response(e)
+    try:
+        ticket = admit_request(data)
+    except QuotaExceeded as e:
+        return quota_error_response(e)
+    tags = request_tags(data)
     api_key = data.get('api_key', openai.api_key)  # Allow API key override in request
     model = data.get('model', OPENAI_MODEL)
     
-    app.logger.debug(f"Received prompt: {prompt}")
+    app.logger.debug(f"Received prompt ({len(prompt)} chars)")
 
     def generate_stream():
-        try:
-            # Create messages format required by OpenAI
-            messages = [{"role": "user", "content": prompt}]
-            
-            # Make API call with streaming
-            response = openai.ChatCompletion.create(
-                model=model,
-                messages=messages,
-                stream=True,
-                api_key=api_key
-            )
-
-            app.logger.debug("Started streaming from OpenAI")
+        def completion(route, prompt):
+            return stream_completion(route, prompt, api_key=api_key, model=model)
 
-            for chunk in response:
-                if chunk and chunk.choices and chunk.choices[0].delta.get('content'):
-                    content = chunk.choices[0].delta.content
-                    # Format response to match original format
-                    response_chunk = {
-                        "response": content
-                    }
-                    app.logger.debug(f"Yielding response: {content}")
-                    yield json.dumps(response_chunk) + '\n'
+        with closing(resilient_stream(completion, route, prompt, ticket=ticket, tags=tags, trace=trace)) as chunks:
+            for content in chunks:
+                # Format response to match original format
+                response_chunk = {
+                    "response": content
+                }
+                app.logger.debug(f"Yielding response: {content}")
+                yield json.dumps(response_chunk) + '\n'
 
-        except openai.error.OpenAIError as e:
-            error_response = {
-                "error": str(e),
-                "response": f"Error: {str(e)}"
-            }
-            app.logger.error(f"OpenAI API error: {e}")
-            yield json.dumps(error_response) + '\n'
-            
-        except Exception as e:
-            error_response = {
-                "error": str(e),
-                "response": f"Error: {str(e)}"
-            }
-            app.logger.error(f"General error: {e}")
-            yield json.dumps(error_response) + '\n'
+    # 客户端断开时由 guard_stream 关闭上游并记录为 cancelled
+    response = Response(guard_stream(route, generate_stream(), format_error=format_error,
+                                     chunk_text=lambda line: json.loads(line)['response'], trace=trace),
+                        mimetype='application/x-ndjson')
+    return with_queue_headers(response, ticket)
 
-    return Response(generate_stream(), mimetype='application/x-ndjson')
+init_app(app, stream_completion, models=dict.fromkeys(('gen', 'gen2'), OPENAI_MODEL))
 
 if __name__ == '__main__':
     app.run(debug=True, port=20000, host="0.0.0.0")
@@ -2,7 +2,17 @@ from flask import Flask, request, Response, render_template
 import requests
 import json
 import logging
+from contextlib import closing
 from typing import Generator
+from cassettes import cassette_session
+from extensions import init_app
+from model_router import resolve_routed_prompt
+from prompt_registry import prompt_error_response
+from request_body import read_json
+from scheduler import QuotaExceeded, admit_request, quota_error_response, with_queue_headers
+from streaming import guard_stream, resilient_stream, socket_timeout
+from tracing import first_byte, span, start_trace
+from usage_ledger import Usage, request_tags
 
 app = Flask(__name__)
 logging.basicConfig(level=logging.DEBUG)
@@ -12,6 +22,8 @@ API_ENDPOINT_1 = 'https://api.anthropic.com/v1/messages'
 API_KEY_1 = 'xxxx'  # Replace with your Claude API key
 API_ENDPOINT_2 = API_ENDPOINT_1
 API_KEY_2 = API_KEY_1
+# 设置 NOVEL_CASSETTES 时经由 cassette 录制或回放上游响应（见 cassettes.py）
+http = cassette_session('claude')
 
 def create_headers(api_key: str) -> dict:
     return {
@@ -25,8 +37,12 @@ def create_headers(api_key: str) -> dict:
 def index():
     return render_template('index.html')
 
-def process_claude_stream(response: requests.Response) -> Generator[str, None, None]:
-    for line in response.iter_lines():
+def process_claude_stream(response: requests.Response, model: str) -> Generator[str, None, None]:
+    """
+    正文在 content_block_delta 中；输入 token 数在 message_start，输出 token 数在 message_delta 的 usage 中
+    """
+    input_tokens = 0
+    for line in first_byte(response.iter_lines()):
         if not line:
             continue
             
@@ -37,9 +53,13 @@ def process_claude_stream(response: requests.Response) -> Generator[str, None, N
                     break
                     
                 data = json.loads(data_str)
-                if data['type'] == 'message_delta':
+                if data['type'] == 'content_block_delta':
                     if text_delta := data.get('delta', {}).get('text', ''):
                         yield text_delta
+                elif data['type'] == 'message_start':
+                    input_tokens = data['message'].get('usage', {}).get('input_tokens', 0)
+                elif data['type'] == 'message_delta' and 'usage' in data:
+                    yield Usage(model, input_tokens, data['usage'].get('output_tokens', 0))
                 
         except json.JSONDecodeError as e:
             app.logger.error(f"JSON decode error: {e}")
@@ -48,99 +68,95 @@ def process_claude_stream(response: requests.Response) -> Generator[str, None, N
             app.logger.error(f"Error processing stream: {e}")
             continue
 
-@app.route('/gen', methods=['POST'])
-def generate():
-    data = request.json
-    prompt = data.get('prompt', '')
-    app.logger.debug(f"Received prompt for gen: {prompt}")
-    
-    def generate_stream():
-        try:
-            # Claude API payload structure
-            payload = {
-                "model": "claude-3-sonnet-20240229",  # 或选择其他 Claude 模型
-                "messages": [
-                    {
-                        "role": "user",
-                        "content": prompt
-                    }
-                ],
-                "stream": True,
-                "max_tokens": 4096,
-                "temperature": 0.7
+# /gen 为效果较好的模型，/gen2 为低成本模型
+ROUTES = {
+    'gen': {
+        'endpoint': API_ENDPOINT_1,
+        'api_key': API_KEY_1,
+        'model': 'claude-3-sonnet-20240229',  # 或选择其他 Claude 模型
+        'temperature': 0.7
+    },
+    'gen2': {
+        'endpoint': API_ENDPOINT_2,
+        'api_key': API_KEY_2,
+        'model': 'claude-3-haiku-20240307',  # 使用不同的模型或参数
+        'temperature': 0.8  # 可以调整温度
+    },
+}
+
+def stream_completion(route: str, prompt: str) -> Generator[str, None, None]:
+    """
+    按路由调用对应模型，逐块返回生成的文本
+    """
+    config = ROUTES[route]
+    # Claude API payload structure
+    payload = {
+        "model": config['model'],
+        "messages": [
+            {
+                "role": "user",
+                "content": prompt
             }
-            
-            response = requests.post(
-                API_ENDPOINT_1,
-                headers=create_headers(API_KEY_1),
-                json=payload,
-                stream=True
-            )
-            
-            if response.status_code != 200:
-                error_message = f"API Error: {response.status_code} - {response.text}"
-                app.logger.error(error_message)
-                yield error_message
-                return
-                
-            app.logger.debug("Stream created successfully for gen")
-            
-            for chunk in process_claude_stream(response):
-                app.logger.debug(f"Yielding chunk: {chunk}")
-                yield chunk
-                
-        except Exception as e:
-            app.logger.error(f"Error in generate_stream: {e}")
-            yield f"Error: {str(e)}"
+        ],
+        "stream": True,
+        "max_tokens": 4096,
+        "temperature": config['temperature']
+    }
     
-    return Response(generate_stream(), mimetype='text/plain')
+    with span('upstream_connect'):
+        response = http.post(
+            config['endpoint'],
+            headers=create_headers(config['api_key']),
+            json=payload,
+            stream=True,
+            timeout=socket_timeout(route)
+        )
+    
+    try:
+        if response.status_code != 200:
+            raise RuntimeError(f"API Error: {response.status_code} - {response.text}")
+            
+        app.logger.debug(f"Stream created successfully for {route}")
+        
+        yield from process_claude_stream(response, config['model'])
+    finally:
+        # 调用方提前结束时关闭上游连接，Claude 随之停止生成
+        response.close()
 
-@app.route('/gen2', methods=['POST'])
-def generate2():
-    data = request.json
-    prompt = data.get('prompt', '')
-    app.logger.debug(f"Received prompt for gen2: {prompt}")
+def stream_route(route: str):
+    trace = start_trace(route)
+    with trace.span('parse_body'):
+        data = read_json()
+    try:
+        prompt, route = resolve_routed_prompt(data, route)
+    except (LookupError, ValueError) as e:
+        return prompt_error_response(e)
+    try:
+        ticket = admit_request(data)
+    except QuotaExceeded as e:
+        return quota_error_response(e)
+    tags = request_tags(data)
+    app.logger.debug(f"Received prompt for {route} ({len(prompt)} chars)")
     
     def generate_stream():
-        try:
-            # 可以为 gen2 配置不同的参数
-            payload = {
-                "model": "claude-3-haiku-20240307",  # 使用不同的模型或参数
-                "messages": [
-                    {
-                        "role": "user",
-                        "content": prompt
-                    }
-                ],
-                "stream": True,
-                "max_tokens": 4096,
-                "temperature": 0.8,  # 可以调整温度
-            }
-            
-            response = requests.post(
-                API_ENDPOINT_2,
-                headers=create_headers(API_KEY_2),
-                json=payload,
-                stream=True
-            )
-            
-            if response.status_code != 200:
-                error_message = f"API Error: {response.status_code} - {response.text}"
-                app.logger.error(error_message)
-                yield error_message
-                return
-                
-            app.logger.debug("Stream created successfully for gen2")
-            
-            for chunk in process_claude_stream(response):
+        with closing(resilient_stream(stream_completion, route, prompt, ticket=ticket, tags=tags, trace=trace)) as chunks:
+            for chunk in chunks:
                 app.logger.debug(f"Yielding chunk: {chunk}")
                 yield chunk
-                
-        except Exception as e:
-            app.logger.error(f"Error in generate_stream: {e}")
-            yield f"Error: {str(e)}"
     
-    return Response(generate_stream(), mimetype='text/plain')
+    # 客户端断开时由 guard_stream 关闭上游并记录为 cancelled
+    response = Response(guard_stream(route, generate_stream(), trace=trace), mimetype='text/plain')
+    return with_queue_headers(response, ticket)
+
+@app.route('/gen', methods=['POST'])
+def generate():
+    return stream_route('gen')
+
+@app.route('/gen2', methods=['POST'])
+def generate2():
+    return stream_route('gen2')
+
+init_app(app, stream_completion, models={route: config['model'] for route, config in ROUTES.items()})
 
 if __name__ == '__main__':
     app.run(debug=True, port=60000, host="0.0.0.0")
@@ -1,7 +1,16 @@
 from flask import Flask, request, Response, render_template
-import requests
 import json
 import logging
+from contextlib import closing
+from cassettes import cassette_session
+from extensions import init_app
+from model_router import resolve_routed_prompt
+from prompt_registry import prompt_error_response
+from request_body import read_json
+from scheduler import QuotaExceeded, admit_request, quota_error_response, with_queue_headers
+from streaming import guard_stream, resilient_stream, socket_timeout
+from tracing import first_byte, span, start_trace
+from usage_ledger import Usage, request_tags
 
 app = Flask(__name__)
 logging.basicConfig(level=logging.DEBUG)
@@ -9,6 +18,10 @@ logging.basicConfig(level=logging.DEBUG)
 # API Configurations
 API_ENDPOINT = 'https://api.deepseek.com/v1/chat/completions'
 API_KEY = 'sk-xxxxx'
+MODEL_NAME = 'deepseek-chat'
+# deepseek-chat 上下文为 64K tokens，预留 8K 给输出
+MAX_PROMPT_TOKENS = 56000
+http = cassette_session('deepseek')
 
 def create_headers():
     return {
@@ -20,119 +33,96 @@ def create_headers():
 def index():
     return render_template('index.html')
 
-@app.route('/gen', methods=['POST'])
-def generate():
-    data = request.json
-    prompt = data.get('prompt', '')
-    app.logger.debug(f"Received prompt for gen: {prompt}")
+def stream_completion(route, prompt):
+    """
+    gen 与 gen2 使用相同的模型配置，逐块返回生成的文本
+    """
+    payload = {
+        "model": MODEL_NAME,
+        "messages": [{"role": "user", "content": prompt}],
+        "stream": True,
+        "stream_options": {"include_usage": True},
+        "temperature": 0.7
+    }
     
-    def generate_stream():
-        try:
-            payload = {
-                "model": "deepseek-chat",
-                "messages": [{"role": "user", "content": prompt}],
-                "stream": True,
-                "temperature": 0.7
-            }
-            
-            response = requests.post(
-                API_ENDPOINT,
-                headers=create_headers(),
-                json=payload,
-                stream=True
-            )
-            
-            if response.status_code != 200:
-                error_msg = f"API error: {response.status_code} - {response.text}"
-                app.logger.error(error_msg)
-                yield error_msg
-                return
+    with span('upstream_connect'):
+        response = http.post(
+            API_ENDPOINT,
+            headers=create_headers(),
+            json=payload,
+            stream=True,
+            timeout=socket_timeout(route)
+        )
+    
+    try:
+        if response.status_code != 200:
+            raise RuntimeError(f"API error: {response.status_code} - {response.text}")
+
+        app.logger.debug(f"Stream created successfully for {route}")
+        
+        for line in first_byte(response.iter_lines()):
+            if line:
+                line = line.decode('utf-8')
+                if line.startswith("data: "):
+                    line = line[6:]
+                
+                if line.strip() == '[DONE]':
+                    continue
+                
+                try:
+                    json_data = json.loads(line)
+                    if 'choices' in json_data and len(json_data['choices']) > 0:
+                        content = json_data['choices'][0].get('delta', {}).get('content')
+                        if content:
+                            yield content
+                    # include_usage 时最后一块的 choices 为空，只带整次调用的用量
+                    if usage := json_data.get('usage'):
+                        yield Usage(payload['model'], usage.get('prompt_tokens'), usage.get('completion_tokens'))
+                except json.JSONDecodeError as e:
+                    app.logger.error(f"JSON decode error: {e}")
+                    continue
+    finally:
+        # 调用方提前结束时关闭上游连接，不再继续接收输出
+        response.close()
 
-            app.logger.debug("Stream created successfully for gen")
-            
-            for line in response.iter_lines():
-                if line:
-                    line = line.decode('utf-8')
-                    if line.startswith("data: "):
-                        line = line[6:]
-                    
-                    if line.strip() == '[DONE]':
-                        continue
-                    
-                    try:
-                        json_data = json.loads(line)
-                        if 'choices' in json_data and len(json_data['choices']) > 0:
-                            content = json_data['choices'][0].get('delta', {}).get('content')
-                            if content:
-                                app.logger.debug(f"Yielding chunk: {content}")
-                                yield content
-                    except json.JSONDecodeError as e:
-                        app.logger.error(f"JSON decode error: {e}")
-                        continue
-                    
-        except Exception as e:
-            error_msg = f"Error in generate_stream: {str(e)}"
-            app.logger.error(error_msg)
-            yield error_msg
+def stream_route(route):
+    trace = start_trace(route)
+    with trace.span('parse_body'):
+        data = read_json()
+    try:
+        prompt, route = resolve_routed_prompt(data, route, MAX_PROMPT_TOKENS)
+    except (LookupError, ValueError) as e:
+        return prompt_error_response(e)
+    try:
+        ticket = admit_request(data)
+    except QuotaExceeded as e:
+        return quota_error_response(e)
+    tags = request_tags(data)
+    app.logger.debug(f"Received prompt for {route} ({len(prompt)} chars)")
+    
+    def generate_stream():
+        with closing(resilient_stream(stream_completion, route, prompt, ticket=ticket, tags=tags, trace=trace)) as chunks:
+            for content in chunks:
+                app.logger.debug(f"Yielding chunk: {content}")
+                yield content
     
-    return Response(generate_stream(), mimetype='text/plain')
+    # 客户端断开时由 guard_stream 关闭上游并记录为 cancelled
+    response = Response(
+        guard_stream(route, generate_stream(), trace=trace,
+                     format_error=lambda e: f"Error in generate_stream: {str(e)}"),
+        mimetype='text/plain'
+    )
+    return with_queue_headers(response, ticket)
+
+@app.route('/gen', methods=['POST'])
+def generate():
+    return stream_route('gen')
 
 @app.route('/gen2', methods=['POST'])
 def generate2():
-    data = request.json
-    prompt = data.get('prompt', '')
-    app.logger.debug(f"Received prompt for gen2: {prompt}")
-    
-    def generate_stream():
-        try:
-            payload = {
-                "model": "deepseek-chat",
-                "messages": [{"role": "user", "content": prompt}],
-                "stream": True,
-                "temperature": 0.7
-            }
-            
-            response = requests.post(
-                API_ENDPOINT,
-                headers=create_headers(),
-                json=payload,
-                stream=True
-            )
-            
-            if response.status_code != 200:
-                error_msg = f"API error: {response.status_code} - {response.text}"
-                app.logger.error(error_msg)
-                yield error_msg
-                return
+    return stream_route('gen2')
 
-            app.logger.debug("Stream created successfully for gen2")
-            
-            for line in response.iter_lines():
-                if line:
-                    line = line.decode('utf-8')
-                    if line.startswith("data: "):
-                        line = line[6:]
-                    
-                    if line.strip() == '[DONE]':
-                        continue
-                    
-                    try:
-                        json_data = json.loads(line)
-                        if 'choices' in json_data and len(json_data['choices']) > 0:
-                            content = json_data['choices'][0].get('delta', {}).get('content')
-                            if content:
-                                app.logger.debug(f"Yielding chunk: {content}")
-                                yield content
-                    except json.JSONDecodeError as e:
-                        app.logger.error(f"JSON decode error: {e}")
-                        continue
-                    
-        except Exception as e:
-            error_msg = f"Error in generate_stream: {str(e)}"
-            app.logger.error(error_msg)
-            yield error_msg
-    
-    return Response(generate_stream(), mimetype='text/plain')
+init_app(app, stream_completion, models=dict.fromkeys(('gen', 'gen2'), MODEL_NAME))
 
 if __name__ == '__main__':
     app.run(debug=True, port=60001, host="0.0.0.0")
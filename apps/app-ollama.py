@@ -1,7 +1,21 @@
 from flask import Flask, request, Response, render_template
-import requests
 import json
 import logging
+import os
+import threading
+from contextlib import closing
+from cassettes import cassette_session
+from common import DATA_DIR
+from extensions import init_app
+from model_router import resolve_routed_prompt
+from prompt_registry import prompt_error_response
+from request_body import read_json
+from scheduler import QuotaExceeded, admit_request, quota_error_response, with_queue_headers
+from shared_state import ProcessSlots, shared_state
+from streaming import guard_stream, resilient_stream, socket_timeout
+from token_estimator import context_windows, estimate_tokens
+from tracing import first_byte, span, start_trace
+from usage_ledger import Usage, model_prices, request_tags
 
 app = Flask(__name__)
 logging.basicConfig(level=logging.DEBUG)
@@ -9,88 +23,196 @@ logging.basicConfig(level=logging.DEBUG)
 # API Configurations
 API_ENDPOINT = 'http://127.0.0.1:11434/api/generate'
 MODEL_NAME = 'qwen2.5:14b'
+# 启动时预加载的模型，并通过 keep_alive 常驻内存，避免稀疏请求之间被卸载后重新加载
+PRELOAD_MODELS = [MODEL_NAME]
+# 本地模型不计费，账本中只统计 token 数
+model_prices[MODEL_NAME] = (0.0, 0.0)
+KEEP_ALIVE = '2h'  # -1 表示永久常驻
+# 上下文长度需覆盖大纲、设定与知识库拼成的提示词；各请求必须一致，num_ctx 变化会导致模型重新加载
+NUM_CTX = 16384
+NUM_PREDICT = 4096
+context_windows[MODEL_NAME] = NUM_CTX
+# 与 Ollama 服务端的 OLLAMA_NUM_PARALLEL 保持一致，超出的请求在网关排队，避免 CPU 主机争抢；
+# 名额由 serve.py 的全部 worker 进程共享
+PARALLEL_SLOTS = 1
+QUEUE_TIMEOUT = 300
+# 首字时限包含排队、模型加载和长提示词的预填充时间
+TIMEOUTS = {'first_token': 600}
+http = cassette_session('ollama')
+
+MODEL_OPTIONS = {
+    "num_ctx": NUM_CTX,
+    "num_predict": NUM_PREDICT
+}
+
+slots = ProcessSlots(os.path.join(DATA_DIR, 'ollama', 'slots'), PARALLEL_SLOTS)
+queue_lock = threading.Lock()
+queued = 0
+
+class PrefixReuse:
+    """
+    提示词前缀的复用完全由 Ollama 自己完成：runner 为每个并行槽保留上一次请求的 KV 缓存，
+    新请求与之相同的前缀部分不再预填充。网关始终发送完整的提示词，无法指定复用哪段缓存；
+    不使用 /api/generate 已弃用的 context 字段，带 context 时新增部分会被套上模板作为新一轮用户消息。
+    这里只做统计：完成消息中的 prompt_eval_count 为实际预填充的 token 数，与提示词估算 token 数之差
+    即为缓存省下的部分（估算有误差，低于估算的 REUSE_RATIO 才计为一次复用）。计数在各 worker 间共享
+    """
+    REUSE_RATIO = 0.8
+    FIELDS = ('requests', 'reused', 'prompt_tokens', 'evaluated_tokens', 'saved_tokens')
+
+    def __init__(self, state=shared_state, prefix='ollama_prefix'):
+        self.state = state
+        self.names = {field: f'{prefix}:{field}' for field in self.FIELDS}
+
+    def record(self, prompt_tokens, evaluated_tokens):
+        reused = evaluated_tokens < prompt_tokens * self.REUSE_RATIO
+        with self.state.transaction() as conn:
+            self.state.add_counters(conn, {
+                self.names['requests']: 1,
+                self.names['reused']: int(reused),
+                self.names['prompt_tokens']: prompt_tokens,
+                self.names['evaluated_tokens']: evaluated_tokens,
+                self.names['saved_tokens']: prompt_tokens - evaluated_tokens if reused else 0
+            })
+
+    def to_dict(self):
+        values = self.state.counters(self.names.values())
+        return {field: int(values[name]) for field, name in self.names.items()}
+
+prefix_reuse = PrefixReuse()
 
 @app.route('/')
 def index():
     return render_template('index.html')
 
-@app.route('/gen', methods=['POST'])
-def generate():
-    data = request.json
-    prompt = data.get('prompt', '')
-    app.logger.debug(f"Received prompt for gen: {prompt}")
-    
-    def generate_stream():
+def preload_models():
+    """
+    不带 prompt 的 generate 请求只加载模型；options 需与正式请求相同，否则首个请求仍会重新加载
+    """
+    for model in PRELOAD_MODELS:
         try:
-            # Prepare the request payload for Ollama
-            payload = {
-                "model": MODEL_NAME,
-                "prompt": prompt,
-                "stream": True
-            }
-            
-            # Make streaming request to Ollama
-            response = requests.post(
+            response = http.post(
                 API_ENDPOINT,
-                json=payload,
-                stream=True
+                json={"model": model, "keep_alive": KEEP_ALIVE, "options": MODEL_OPTIONS},
+                timeout=socket_timeout('gen', TIMEOUTS)
             )
-            
-            app.logger.debug("Stream created successfully for gen")
-            
-            # Process the streaming response
-            for line in response.iter_lines():
-                if line:
-                    json_response = json.loads(line)
-                    if 'response' in json_response:
-                        content = json_response['response']
-                        app.logger.debug(f"Yielding chunk: {content}")
-                        yield content
-                        
+            response.raise_for_status()
+            app.logger.info(f"Preloaded Ollama model {model} (keep_alive={KEEP_ALIVE})")
         except Exception as e:
-            app.logger.error(f"Error in generate_stream: {e}")
-            yield f"Error: {str(e)}"
-    
-    return Response(generate_stream(), mimetype='text/plain')
+            app.logger.warning(f"Failed to preload Ollama model {model}: {e}")
 
-@app.route('/gen2', methods=['POST'])
-def generate2():
-    data = request.json
-    prompt = data.get('prompt', '')
-    app.logger.debug(f"Received prompt for gen2: {prompt}")
-    
-    def generate_stream():
-        try:
-            # Prepare the request payload for Ollama
-            payload = {
-                "model": MODEL_NAME,
-                "prompt": prompt,
-                "stream": True
-            }
-            
-            # Make streaming request to Ollama
-            response = requests.post(
+def acquire_slot(route):
+    global queued
+    with queue_lock:
+        queued += 1
+        position = queued
+    try:
+        if position > PARALLEL_SLOTS:
+            app.logger.debug(f"Waiting for Ollama slot for {route} ({position - PARALLEL_SLOTS} queued)")
+        slot = slots.acquire(timeout=QUEUE_TIMEOUT)
+        if slot is None:
+            raise RuntimeError(f"本地模型繁忙，排队超过 {QUEUE_TIMEOUT} 秒")
+        return slot
+    finally:
+        with queue_lock:
+            queued -= 1
+
+def stream_completion(route, prompt):
+    """
+    gen 与 gen2 使用同一个本地模型，逐块返回生成的文本
+    """
+    # Prepare the request payload for Ollama
+    payload = {
+        "model": MODEL_NAME,
+        "prompt": prompt,
+        "stream": True,
+        "keep_alive": KEEP_ALIVE,
+        "options": MODEL_OPTIONS
+    }
+    # 超出上下文时 Ollama 会静默截断提示词开头
+    prompt_tokens = estimate_tokens(prompt, MODEL_NAME)
+    if prompt_tokens + NUM_PREDICT > NUM_CTX:
+        app.logger.warning(f"Prompt for {route} (~{prompt_tokens} tokens) may exceed num_ctx={NUM_CTX}")
+
+    with span('slot_wait'):
+        slot = acquire_slot(route)
+    try:
+        # Make streaming request to Ollama
+        with span('upstream_connect'):
+            response = http.post(
                 API_ENDPOINT,
                 json=payload,
-                stream=True
+                stream=True,
+                timeout=socket_timeout(route, TIMEOUTS)
             )
-            
-            app.logger.debug("Stream created successfully for gen2")
-            
+        
+        app.logger.debug(f"Stream created successfully for {route}")
+        
+        try:
             # Process the streaming response
-            for line in response.iter_lines():
+            for line in first_byte(response.iter_lines()):
                 if line:
                     json_response = json.loads(line)
                     if 'response' in json_response:
-                        content = json_response['response']
-                        app.logger.debug(f"Yielding chunk: {content}")
-                        yield content
-                        
-        except Exception as e:
-            app.logger.error(f"Error in generate_stream: {e}")
-            yield f"Error: {str(e)}"
+                        yield json_response['response']
+                    if json_response.get('done'):
+                        # 整个提示词都命中缓存时部分版本不返回 prompt_eval_count，无法统计，跳过
+                        if json_response.get('prompt_eval_count') is not None:
+                            prefix_reuse.record(prompt_tokens, json_response['prompt_eval_count'])
+                        yield Usage(MODEL_NAME, json_response.get('prompt_eval_count'),
+                                    json_response.get('eval_count'),
+                                    eval_seconds=json_response.get('eval_duration', 0) / 1e9)
+        finally:
+            # 连接关闭后 Ollama 会中止生成，释放本地算力
+            response.close()
+    finally:
+        slots.release(slot)
+
+def stream_route(route):
+    trace = start_trace(route)
+    with trace.span('parse_body'):
+        data = read_json()
+    try:
+        prompt, route = resolve_routed_prompt(data, route)
+    except (LookupError, ValueError) as e:
+        return prompt_error_response(e)
+    try:
+        ticket = admit_request(data)
+    except QuotaExceeded as e:
+        return quota_error_response(e)
+    tags = request_tags(data)
+    app.logger.debug(f"Received prompt for {route} ({len(prompt)} chars)")
+    
+    def generate_stream():
+        with closing(resilient_stream(stream_completion, route, prompt, TIMEOUTS, ticket=ticket, tags=tags, trace=trace)) as chunks:
+            for content in chunks:
+                app.logger.debug(f"Yielding chunk: {content}")
+                yield content
     
-    return Response(generate_stream(), mimetype='text/plain')
+    # 客户端断开时由 guard_stream 关闭上游并记录为 cancelled
+    response = Response(guard_stream(route, generate_stream(), trace=trace), mimetype='text/plain')
+    return with_queue_headers(response, ticket)
+
+@app.route('/gen', methods=['POST'])
+def generate():
+    return stream_route('gen')
+
+@app.route('/gen2', methods=['POST'])
+def generate2():
+    return stream_route('gen2')
+
+@app.route('/ollama/prefix-stats')
+def prefix_stats():
+    return Response(json.dumps(prefix_reuse.to_dict()), mimetype='application/json')
+
+init_app(app, stream_completion, TIMEOUTS, models=dict.fromkeys(('gen', 'gen2'), MODEL_NAME))
+
+def on_start():
+    """
+    启动时调用一次（serve.py 在第一个 worker 进程中调用），后台预加载模型，不阻塞启动
+    """
+    threading.Thread(target=preload_models, daemon=True).start()
 
 if __name__ == '__main__':
+    on_start()
     app.run(debug=True, port=60000, host="0.0.0.0")
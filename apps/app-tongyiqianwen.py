@@ -3,7 +3,21 @@ from flask import Flask, request, Response, render_template
 import dashscope
 import json
 import logging
+import threading
+import time
+from contextlib import closing
+from datetime import datetime
 from http import HTTPStatus
+from cassettes import recorded_chunks
+from extensions import init_app
+from model_router import resolve_routed_prompt
+from prompt_registry import prompt_error_response
+from request_body import read_json
+from scheduler import QuotaExceeded, admit_request, quota_error_response, with_queue_headers
+from shared_state import shared_state
+from streaming import guard_stream, resilient_stream
+from tracing import first_byte, span, start_trace
+from usage_ledger import Usage, request_tags
 
 app = Flask(__name__)
 logging.basicConfig(level=logging.DEBUG)
@@ -12,115 +26,220 @@ logging.basicConfig(level=logging.DEBUG)
 API_KEY_1 = 'xxxx'  # 通义千问 API Key
 API_KEY_2 = 'xxxx'  # 可以使用不同的 API Key
 
-# 设置通义千问API密钥
-dashscope.api_key = API_KEY_1
+# 密钥池：每次调用单独传入密钥，不修改全局的 dashscope.api_key；
+# 每个密钥限制并发数（按 worker 进程计）与每日调用次数（0 表示不限，多个 worker 合并计算），
+# 吞吐随密钥数量增加。相同的密钥只保留一个
+API_KEYS = [
+    {'key': API_KEY_1, 'max_concurrency': 2, 'daily_requests': 0},
+    {'key': API_KEY_2, 'max_concurrency': 2, 'daily_requests': 0},
+]
+QUEUE_TIMEOUT = 120
+THROTTLE_COOLDOWN = 60  # 密钥被限流或额度不足后暂停使用的秒数
 
 @app.route('/')
 def index():
     return render_template('index.html')
 
-@app.route('/gen', methods=['POST'])
-def generate():
-    data = request.json
-    prompt = data.get('prompt', '')
-    app.logger.debug(f"Received prompt for gen: {prompt}")
+# /gen2 使用较轻量的模型
+ROUTES = {
+    'gen': {'model': 'qwen-max', 'temperature': 0.7},  # 或 'qwen-plus', 'qwen-turbo'
+    'gen2': {'model': 'qwen-turbo', 'temperature': 0.8},
+}
+
+class KeyPool:
+    """
+    选择当前负载最低且未超出额度的密钥；全部繁忙时排队等待，超过 QUEUE_TIMEOUT 报错
+    """
+
+    def __init__(self, keys, state=shared_state):
+        self.state = state
+        self.cond = threading.Condition()
+        self.entries = []
+        seen = set()
+        for config in keys:
+            if config['key'] in seen:
+                continue
+            seen.add(config['key'])
+            self.entries.append({
+                'id': f"key-{len(self.entries) + 1}",
+                'key': config['key'],
+                'max_concurrency': config.get('max_concurrency', 1),
+                'daily_requests': config.get('daily_requests', 0),
+                'in_flight': 0,
+                'cooldown_until': 0,
+                'throttled': 0
+            })
+
+    @staticmethod
+    def counter(entry, kind):
+        return f"dashscope:{entry['id']}:{kind}:{datetime.now():%Y-%m-%d}"
+
+    def _pick(self):
+        """
+        返回 (密钥, 是否全部超出额度)；暂无可用密钥时密钥为 None
+        """
+        used = self.state.counters(self.counter(e, 'requests') for e in self.entries)
+        within_quota = [e for e in self.entries
+                        if not e['daily_requests'] or used[self.counter(e, 'requests')] < e['daily_requests']]
+        if not within_quota:
+            return None, True
+        now = time.time()
+        idle = [e for e in within_quota if e['in_flight'] < e['max_concurrency'] and e['cooldown_until'] <= now]
+        if not idle:
+            return None, False
+        entry = min(idle, key=lambda e: (e['in_flight'] / e['max_concurrency'], used[self.counter(e, 'requests')]))
+        return entry, False
+
+    def acquire(self, route):
+        deadline = time.monotonic() + QUEUE_TIMEOUT
+        with self.cond:
+            while True:
+                entry, exhausted = self._pick()
+                if exhausted:
+                    raise RuntimeError("所有 API Key 今日调用次数已用完")
+                if entry is not None:
+                    entry['in_flight'] += 1
+                    break
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise RuntimeError(f"API Key 均繁忙，排队超过 {QUEUE_TIMEOUT} 秒")
+                # 冷却结束不会触发通知，定期重新检查
+                self.cond.wait(min(remaining, 1.0))
+        with self.state.transaction() as conn:
+            self.state.add_counters(conn, {self.counter(entry, 'requests'): 1})
+        app.logger.debug(f"Using DashScope {entry['id']} for {route}")
+        return entry
+
+    def release(self, entry, tokens_used=0, throttled=False):
+        if tokens_used:
+            with self.state.transaction() as conn:
+                self.state.add_counters(conn, {self.counter(entry, 'tokens'): tokens_used})
+        with self.cond:
+            entry['in_flight'] -= 1
+            if throttled:
+                entry['cooldown_until'] = time.time() + THROTTLE_COOLDOWN
+                entry['throttled'] += 1
+            self.cond.notify()
+
+    def to_dict(self):
+        with self.cond:
+            entries = [dict(e) for e in self.entries]
+        names = [self.counter(e, kind) for e in entries for kind in ('requests', 'tokens')]
+        used = self.state.counters(names)
+        return {"keys": [
+            {
+                "id": e['id'],
+                "in_flight": e['in_flight'],
+                "max_concurrency": e['max_concurrency'],
+                "requests_today": int(used[self.counter(e, 'requests')]),
+                "daily_requests": e['daily_requests'],
+                "tokens_today": int(used[self.counter(e, 'tokens')]),
+                "throttled": e['throttled'],
+                "cooling_down": e['cooldown_until'] > time.time()
+            }
+            for e in entries
+        ]}
+
+key_pool = KeyPool(API_KEYS)
+
+# DashScope SDK 不能替换底层连接，录制与回放的是解析后的文本块
+@recorded_chunks('tongyiqianwen', lambda route: ROUTES[route]['model'])
+def stream_completion(route, prompt):
+    """
+    按路由调用对应模型，逐块返回生成的文本
+    """
+    config = ROUTES[route]
+    with span('credential_fetch') as attrs:
+        entry = key_pool.acquire(route)
+        attrs['key'] = entry['id']
+    tokens_used = 0
+    usage = None
+    throttled = False
+    response = None
+    try:
+        response = dashscope.Generation.call(
+            api_key=entry['key'],
+            model=config['model'],
+            messages=[{
+                "role": "user",
+                "content": prompt
+            }],
+            result_format='message',
+            stream=True,
+            temperature=config['temperature'],
+            top_p=0.95,
+            max_tokens=1500,
+            stop=None,
+            repetition_penalty=1.0,
+            top_k=None,
+            enable_search=False,
+            incremental_output=True
+        )
+        
+        app.logger.debug(f"Stream created successfully for {route}")
+        
+        # SDK 在开始迭代时才发出请求，first_byte 包含连接耗时
+        for chunk in first_byte(response):
+            if chunk.status_code == HTTPStatus.OK:
+                # usage 为累计值，以最后一块为准
+                if getattr(chunk, 'usage', None):
+                    usage = chunk.usage
+                    tokens_used = usage.get('input_tokens', 0) + usage.get('output_tokens', 0)
+                if hasattr(chunk.output, 'choices') and \
+                   len(chunk.output.choices) > 0 and \
+                   hasattr(chunk.output.choices[0], 'message') and \
+                   'content' in chunk.output.choices[0].message:
+                    yield chunk.output.choices[0].message['content']
+            else:
+                throttled = chunk.status_code == HTTPStatus.TOO_MANY_REQUESTS or \
+                    chunk.code in ('Throttling', 'Arrearage')
+                raise RuntimeError(f"{chunk.code} {chunk.message}")
+        if usage:
+            yield Usage(config['model'], usage.get('input_tokens'), usage.get('output_tokens'), key=entry['id'])
+    finally:
+        # 调用方提前结束时关闭 SDK 的流式生成器，断开上游连接
+        if response is not None and hasattr(response, 'close'):
+            response.close()
+        key_pool.release(entry, tokens_used, throttled)
+
+def stream_route(route):
+    trace = start_trace(route)
+    with trace.span('parse_body'):
+        data = read_json()
+    try:
+        prompt, route = resolve_routed_prompt(data, route)
+    except (LookupError, ValueError) as e:
+        return prompt_error_response(e)
+    try:
+        ticket = admit_request(data)
+    except QuotaExceeded as e:
+        return quota_error_response(e)
+    tags = request_tags(data)
+    app.logger.debug(f"Received prompt for {route} ({len(prompt)} chars)")
     
     def generate_stream():
-        try:
-            response = dashscope.Generation.call(
-                model='qwen-max',  # 或 'qwen-plus', 'qwen-turbo'
-                messages=[{
-                    "role": "user",
-                    "content": prompt
-                }],
-                result_format='message',
-                stream=True,
-                temperature=0.7,
-                top_p=0.95,
-                max_tokens=1500,
-                stop=None,
-                repetition_penalty=1.0,
-                top_k=None,
-                enable_search=False,
-                incremental_output=True
-            )
-            
-            app.logger.debug("Stream created successfully for gen")
-            
-            for chunk in response:
-                if chunk.status_code == HTTPStatus.OK:
-                    if hasattr(chunk.output, 'choices') and \
-                       len(chunk.output.choices) > 0 and \
-                       hasattr(chunk.output.choices[0], 'message') and \
-                       'content' in chunk.output.choices[0].message:
-                        content = chunk.output.choices[0].message['content']
-                        app.logger.debug(f"Yielding chunk: {content}")
-                        yield content
-                else:
-                    error_msg = f"Error: {chunk.code} {chunk.message}"
-                    app.logger.error(error_msg)
-                    yield error_msg
-                    
-        except Exception as e:
-            app.logger.error(f"Error in generate_stream: {e}")
-            yield f"Error: {str(e)}"
+        with closing(resilient_stream(stream_completion, route, prompt, ticket=ticket, tags=tags, trace=trace)) as chunks:
+            for content in chunks:
+                app.logger.debug(f"Yielding chunk: {content}")
+                yield content
     
-    return Response(generate_stream(), mimetype='text/plain')
+    # 客户端断开时由 guard_stream 关闭上游并记录为 cancelled
+    response = Response(guard_stream(route, generate_stream(), trace=trace), mimetype='text/plain')
+    return with_queue_headers(response, ticket)
+
+@app.route('/gen', methods=['POST'])
+def generate():
+    return stream_route('gen')
 
 @app.route('/gen2', methods=['POST'])
 def generate2():
-    data = request.json
-    prompt = data.get('prompt', '')
-    app.logger.debug(f"Received prompt for gen2: {prompt}")
-    
-    # 临时切换到第二个API密钥
-    original_api_key = dashscope.api_key
-    dashscope.api_key = API_KEY_2
-    
-    def generate_stream():
-        try:
-            response = dashscope.Generation.call(
-                model='qwen-turbo',  # 使用较轻量的模型
-                messages=[{
-                    "role": "user",
-                    "content": prompt
-                }],
-                result_format='message',
-                stream=True,
-                temperature=0.8,  # 可以调整参数
-                top_p=0.95,
-                max_tokens=1500,
-                stop=None,
-                repetition_penalty=1.0,
-                top_k=None,
-                enable_search=False,
-                incremental_output=True
-            )
-            
-            app.logger.debug("Stream created successfully for gen2")
-            
-            for chunk in response:
-                if chunk.status_code == HTTPStatus.OK:
-                    if hasattr(chunk.output, 'choices') and \
-                       len(chunk.output.choices) > 0 and \
-                       hasattr(chunk.output.choices[0], 'message') and \
-                       'content' in chunk.output.choices[0].message:
-                        content = chunk.output.choices[0].message['content']
-                        app.logger.debug(f"Yielding chunk: {content}")
-                        yield content
-                else:
-                    error_msg = f"Error: {chunk.code} {chunk.message}"
-                    app.logger.error(error_msg)
-                    yield error_msg
-                    
-        except Exception as e:
-            app.logger.error(f"Error in generate_stream: {e}")
-            yield f"Error: {str(e)}"
-        finally:
-            # 恢复原始API密钥
-            dashscope.api_key = original_api_key
-    
-    return Response(generate_stream(), mimetype='text/plain')
+    return stream_route('gen2')
+
+@app.route('/dashscope/key-stats')
+def key_stats():
+    return Response(json.dumps(key_pool.to_dict()), mimetype='application/json')
+
+init_app(app, stream_completion, models={route: config['model'] for route, config in ROUTES.items()})
 
 if __name__ == '__main__':
     app.run(debug=True, port=60000, host="0.0.0.0")
@@ -1,9 +1,18 @@
 from flask import Flask, request, Response, render_template
-import requests
 import json
 import logging
 from typing import Generator
 import time
+from contextlib import closing
+from cassettes import cassette_session
+from extensions import init_app
+from model_router import resolve_routed_prompt
+from prompt_registry import prompt_error_response
+from request_body import read_json
+from scheduler import QuotaExceeded, admit_request, quota_error_response, with_queue_headers
+from streaming import guard_stream, resilient_stream, socket_timeout
+from tracing import first_byte, span, start_trace
+from usage_ledger import Usage, request_tags
 
 app = Flask(__name__)
 logging.basicConfig(level=logging.DEBUG)
@@ -11,6 +20,7 @@ logging.basicConfig(level=logging.DEBUG)
 # 文心一言API配置
 API_KEY = "xxxx"  # 替换为您的 API Key
 SECRET_KEY = "xxxx"  # 替换为您的 Secret Key
+http = cassette_session('wenxinyiyang')
 
 def get_access_token() -> str:
     """
@@ -23,7 +33,7 @@ def get_access_token() -> str:
         "client_secret": SECRET_KEY
     }
     try:
-        response = requests.post(url, params=params)
+        response = http.post(url, params=params, timeout=socket_timeout('token'))
         response.raise_for_status()
         return response.json().get("access_token")
     except Exception as e:
@@ -34,67 +44,90 @@ def get_access_token() -> str:
 def index():
     return render_template('index.html')
 
-@app.route('/gen', methods=['POST'])
-def generate():
-    data = request.json
-    prompt = data.get('prompt', '')
-    app.logger.debug(f"收到prompt请求: {prompt}")
+def stream_completion(route: str, prompt: str) -> Generator[str, None, None]:
+    """
+    gen 与 gen2 使用相同的实现，逐块返回生成的文本
+    """
+    # 获取access token
+    with span('credential_fetch'):
+        access_token = get_access_token()
     
-    def generate_stream() -> Generator[str, None, None]:
-        try:
-            # 获取access token
-            access_token = get_access_token()
-            
-            # 调用文心一言API
-            url = f"https://aip.baidubce.com/rpc/2.0/ai_custom/v1/wenxinworkshop/chat/completions?access_token={access_token}"
-            
-            headers = {
-                "Content-Type": "application/json"
-            }
-            
-            payload = {
-                "messages": [{"role": "user", "content": prompt}],
-                "stream": True
-            }
-            
-            response = requests.post(url, headers=headers, json=payload, stream=True)
-            response.raise_for_status()
-            
-            app.logger.debug("成功创建流式响应")
-            
-            for line in response.iter_lines():
-                if line:
-                    line = line.decode('utf-8')
-                    if line.startswith('data: '):
-                        line = line[6:]
+    # 调用文心一言API
+    url = f"https://aip.baidubce.com/rpc/2.0/ai_custom/v1/wenxinworkshop/chat/completions?access_token={access_token}"
+    
+    headers = {
+        "Content-Type": "application/json"
+    }
+    
+    payload = {
+        "messages": [{"role": "user", "content": prompt}],
+        "stream": True
+    }
+    
+    with span('upstream_connect'):
+        response = http.post(url, headers=headers, json=payload, stream=True, timeout=socket_timeout(route))
+    try:
+        response.raise_for_status()
+        
+        app.logger.debug("成功创建流式响应")
+        
+        for line in first_byte(response.iter_lines()):
+            if line:
+                line = line.decode('utf-8')
+                if line.startswith('data: '):
+                    line = line[6:]
+                
+                if line.strip() == '[DONE]':
+                    break
                     
-                    if line.strip() == '[DONE]':
-                        break
-                        
-                    try:
-                        chunk = json.loads(line)
-                        if 'error_code' in chunk:
-                            error_msg = chunk.get('error_msg', '未知错误')
-                            app.logger.error(f"API错误: {error_msg}")
-                            yield f"错误: {error_msg}"
-                            break
-                        
-                        if content := chunk.get('result', ''):
-                            app.logger.debug(f"输出内容: {content}")
-                            yield content
-                            
-                    except json.JSONDecodeError as e:
-                        app.logger.error(f"JSON解析错误: {e}")
-                        continue
-                        
-        except requests.exceptions.RequestException as e:
-            app.logger.error(f"请求错误: {e}")
-            yield f"错误: {str(e)}"
-        except Exception as e:
-            app.logger.error(f"意外错误: {e}")
-            yield f"错误: {str(e)}"
+                try:
+                    chunk = json.loads(line)
+                except json.JSONDecodeError as e:
+                    app.logger.error(f"JSON解析错误: {e}")
+                    continue
+                
+                if 'error_code' in chunk:
+                    raise RuntimeError(chunk.get('error_msg', '未知错误'))
+                
+                if content := chunk.get('result', ''):
+                    yield content
+                # 最后一块（is_end）的 usage 为整次调用的用量
+                if chunk.get('is_end') and (usage := chunk.get('usage')):
+                    yield Usage(prompt_tokens=usage.get('prompt_tokens'), completion_tokens=usage.get('completion_tokens'))
+    finally:
+        # 调用方提前结束时关闭上游连接，不再继续接收输出
+        response.close()
+
+def stream_route(route: str):
+    trace = start_trace(route)
+    with trace.span('parse_body'):
+        data = read_json()
+    try:
+        prompt, route = resolve_routed_prompt(data, route)
+    except (LookupError, ValueError) as e:
+        return prompt_error_response(e)
+    try:
+        ticket = admit_request(data)
+    except QuotaExceeded as e:
+        return quota_error_response(e)
+    tags = request_tags(data)
+    app.logger.debug(f"收到prompt请求，长度 {len(prompt)}")
+    
+    def generate_stream() -> Generator[str, None, None]:
+        with closing(resilient_stream(stream_completion, route, prompt, ticket=ticket, tags=tags, trace=trace)) as chunks:
+            for content in chunks:
+                app.logger.debug(f"输出内容: {content}")
+                yield content
     
-    return Response(generate_stream(), mimetype='text/plain')
+    # 客户端断开时由 guard_stream 关闭上游并记录为 cancelled
+    response = Response(guard_stream(route, generate_stream(), trace=trace,
+                                     format_error=lambda e: f"错误: {str(e)}"),
+                        mimetype='text/plain')
+    return with_queue_headers(response, ticket)
+
+@app.route('/gen', methods=['POST'])
+def generate():
+    return stream_route('gen')
 
 @app.route('/gen2', methods=['POST'])
 def generate2():
@@ -102,7 +135,9 @@ def generate2():
     第二个生成接口，使用相同的实现
     可以根据需要修改参数或模型
     """
-    return generate()
+    return stream_route('gen2')
+
+init_app(app, stream_completion, models=dict.fromkeys(('gen', 'gen2'), 'ernie'))
 
 if __name__ == '__main__':
     app.run(debug=True, port=60000, host="0.0.0.0")
@@ -0,0 +1,280 @@
+"""
+静态资源打包：精简前端脚本与样式，按内容哈希命名并预压缩为 .gz/.br，
+以 immutable 缓存头提供，重复访问无需再验证。样式合并为一个文件；脚本逐个输出，
+保持各自独立的 <script>，一个脚本出错不影响其余脚本执行。
+
+启动时由 init_app 自动构建，也可作为构建步骤单独运行：python assets.py
+"""
+import gzip
+import hashlib
+import json
+import logging
+import mimetypes
+import os
+import re
+
+from flask import Blueprint, abort, request, send_file, url_for
+
+from common import BASE_DIR, ensure_dir
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+logger = logging.getLogger(__name__)
+
+assets_bp = Blueprint('assets', __name__)
+
+STATIC_DIR = os.path.join(BASE_DIR, 'static')
+DIST_DIR = os.path.join(STATIC_DIR, 'dist')
+MANIFEST_PATH = os.path.join(DIST_DIR, 'manifest.json')
+CACHE_CONTROL = 'public, max-age=31536000, immutable'
+
+# 顺序与 index.html 中原来的 <script> 顺序一致
+BUNDLES = {
+    'app.css': ['cs.css'],
+    'app.js': [
+        'request-utils.js', 'outin.js', 'bookinfo.js', 'mode-shortcut.js', 'chat-and-counter.js',
+        'theme-switcher.js', 'prompt-editor.js', 'knowledge-base.js', 'book-splitter.js', 'mind.js', 'fix.js'
+    ]
+}
+
+# 出现在这些字符或关键字之后的 / 是正则字面量的开始，否则视为除号
+REGEX_PRECEDERS = set('(,=:[!&|?{};+-*%<>~^')
+REGEX_KEYWORDS = {'return', 'typeof', 'case', 'do', 'else', 'in', 'of', 'new', 'delete', 'void',
+                  'throw', 'yield', 'await', 'instanceof'}
+WORD_PATTERN = re.compile(r'[\w$]+$')
+# write_asset 输出的文件名：<名称>.<12 位哈希><扩展名>，以及预压缩的 .gz/.br
+HASHED_PATTERN = re.compile(r'.+\.[0-9a-f]{12}\.(?:js|css)(?:\.gz|\.br)?')
+
+manifest = {}
+
+
+def minify_js(source: str) -> str:
+    """
+    保守的精简：只去掉注释、行首行尾空白和空行，字符串、模板字符串与正则原样保留；
+    保留换行，不影响自动分号插入
+    """
+    out = []
+    i = 0
+    n = len(source)
+    templates = []  # 模板字符串中 ${ } 表达式的花括号深度栈
+    in_template = False
+
+    def last_significant():
+        for piece in reversed(out):
+            stripped = piece.rstrip()
+            if stripped:
+                return stripped
+        return ''
+
+    def emit_space(char):
+        if not out or out[-1] in (' ', '\n'):
+            if char == '\n' and out and out[-1] == ' ':
+                out[-1] = '\n'
+            return
+        out.append(char)
+
+    while i < n:
+        c = source[i]
+        if in_template:
+            start = i
+            while i < n:
+                if source[i] == '\\':
+                    i += 2
+                elif source[i] == '`':
+                    i += 1
+                    in_template = False
+                    break
+                elif source.startswith('${', i):
+                    i += 2
+                    templates.append(0)
+                    in_template = False
+                    break
+                else:
+                    i += 1
+            out.append(source[start:i])
+            continue
+
+        if c in ' \t\r':
+            emit_space(' ')
+            i += 1
+        elif c == '\n':
+            emit_space('\n')
+            i += 1
+        elif source.startswith('//', i):
+            end = source.find('\n', i)
+            i = n if end == -1 else end
+        elif source.startswith('/*', i):
+            end = source.find('*/', i + 2)
+            end = n if end == -1 else end + 2
+            emit_space('\n' if '\n' in source[i:end] else ' ')
+            i = end
+        elif c in '"\'':
+            start = i
+            i += 1
+            while i < n and source[i] != c and source[i] != '\n':
+                i += 2 if source[i] == '\\' else 1
+            i += 1
+            out.append(source[start:i])
+        elif c == '`':
+            out.append(c)
+            i += 1
+            in_template = True
+        elif c == '/' and (not last_significant() or last_significant()[-1] in REGEX_PRECEDERS or
+                           (WORD_PATTERN.search(last_significant()) or [''])[0] in REGEX_KEYWORDS):
+            start = i
+            i += 1
+            in_class = False
+            while i < n and source[i] != '\n':
+                if source[i] == '\\':
+                    i += 2
+                    continue
+                if source[i] == '[':
+                    in_class = True
+                elif source[i] == ']':
+                    in_class = False
+                elif source[i] == '/' and not in_class:
+                    i += 1
+                    break
+                i += 1
+            while i < n and (source[i].isalnum()):
+                i += 1
+            out.append(source[start:i])
+        else:
+            if templates:
+                if c == '{':
+                    templates[-1] += 1
+                elif c == '}':
+                    if templates[-1] == 0:
+                        templates.pop()
+                        out.append(c)
+                        i += 1
+                        in_template = True
+                        continue
+                    templates[-1] -= 1
+            start = i
+            i += 1
+            # 普通代码字符成段输出
+            while i < n and source[i] not in ' \t\r\n/"\'`{}':
+                i += 1
+            out.append(source[start:i])
+
+    return ''.join(out).strip() + '\n'
+
+
+def minify_css(source: str) -> str:
+    """
+    去掉注释并压缩空白；字符串原样保留，不改动选择器中的空格
+    """
+    parts = re.split(r'("(?:\\.|[^"\\])*"|\'(?:\\.|[^\'\\])*\')', source)
+    for i in range(0, len(parts), 2):
+        text = re.sub(r'/\*.*?\*/', '', parts[i], flags=re.S)
+        text = re.sub(r'\s+', ' ', text)
+        parts[i] = re.sub(r'\s*([{};,])\s*', r'\1', text)
+    return ''.join(parts).strip() + '\n'
+
+
+def write_file(path: str, data: bytes):
+    tmp_path = f'{path}.{os.getpid()}.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+
+
+def read_source(filename: str) -> str:
+    with open(os.path.join(STATIC_DIR, filename), encoding='utf-8', errors='surrogateescape') as f:
+        return f.read()
+
+
+def write_asset(name: str, text: str) -> str:
+    data = text.encode('utf-8', errors='surrogateescape')
+    digest = hashlib.sha256(data).hexdigest()[:12]
+    stem, ext = os.path.splitext(name)
+    hashed = f'{stem}.{digest}{ext}'
+    path = os.path.join(DIST_DIR, hashed)
+    if not os.path.exists(path):
+        write_file(path, data)
+        write_file(path + '.gz', gzip.compress(data, compresslevel=9, mtime=0))
+        if brotli is not None:
+            write_file(path + '.br', brotli.compress(data))
+        logger.info(f"Built asset {hashed} ({len(data)} bytes)")
+    return hashed
+
+
+def build_bundle(name: str, files: list) -> list:
+    """
+    返回打包后的文件名列表。脚本不合并：合并后一个文件的语法错误或顶层异常会让之后的脚本全部失效，
+    而用 try/catch 包裹又会把顶层的 const/class 变成块级作用域，其他脚本和页面内联脚本无法访问
+    """
+    if name.endswith('.js'):
+        return [write_asset(filename, minify_js(read_source(filename))) for filename in files]
+    return [write_asset(name, ''.join(minify_css(read_source(filename)) for filename in files))]
+
+
+def remove_stale(built: dict):
+    """
+    删除不在本次清单中的旧构建产物；只处理哈希命名的文件，其他进程写入中的 .tmp 文件不受影响
+    """
+    keep = {hashed for names in built.values() for hashed in names}
+    for filename in os.listdir(DIST_DIR):
+        if HASHED_PATTERN.fullmatch(filename) and re.sub(r'\.(gz|br)$', '', filename) not in keep:
+            try:
+                os.remove(os.path.join(DIST_DIR, filename))
+            except FileNotFoundError:
+                pass
+
+
+def build_assets() -> dict:
+    ensure_dir(DIST_DIR)
+    built = {name: build_bundle(name, files) for name, files in BUNDLES.items()}
+    write_file(MANIFEST_PATH, json.dumps(built, indent=2).encode('utf-8'))
+    manifest.clear()
+    manifest.update(built)
+    remove_stale(built)
+    return built
+
+
+def asset_urls(name: str) -> list:
+    """
+    模板中使用：打包成功时返回哈希命名的文件，否则退回各源文件
+    """
+    if name in manifest:
+        return [url_for('assets.serve_asset', filename=hashed) for hashed in manifest[name]]
+    return [url_for('static', filename=filename) for filename in BUNDLES[name]]
+
+
+@assets_bp.route('/assets/<filename>')
+def serve_asset(filename):
+    if not any(filename in names for names in manifest.values()):
+        abort(404)
+    path = os.path.join(DIST_DIR, filename)
+    accept = request.headers.get('Accept-Encoding', '')
+    encoding = None
+    for name, ext in (('br', '.br'), ('gzip', '.gz')):
+        if name in accept and os.path.exists(path + ext):
+            path += ext
+            encoding = name
+            break
+
+    response = send_file(path, mimetype=mimetypes.guess_type(filename)[0], etag=False, max_age=31536000)
+    response.headers['Cache-Control'] = CACHE_CONTROL
+    response.headers['Vary'] = 'Accept-Encoding'
+    if encoding:
+        response.headers['Content-Encoding'] = encoding
+    return response
+
+
+def init_assets(app):
+    try:
+        build_assets()
+    except Exception as e:
+        logger.warning(f"Failed to build asset bundles, serving source files: {e}")
+    app.jinja_env.globals['asset_urls'] = asset_urls
+    app.register_blueprint(assets_bp)
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    print(json.dumps(build_assets(), indent=2))
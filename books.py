@@ -0,0 +1,288 @@
+"""
+拆书导入：服务端编码识别与流式章节切分
+
+上传的 TXT 按块落盘（同时计算内容哈希作为 book_id），
+之后以 mmap 方式逐行扫描，只记录章节标题与字节偏移，
+章节正文在前端展开或拆解时再按需读取。
+"""
+import codecs
+import hashlib
+import json
+import logging
+import mmap
+import os
+import re
+
+from flask import Blueprint, request
+
+from common import DATA_DIR, ensure_dir, json_response
+from search_index import index_book_async
+
+logger = logging.getLogger(__name__)
+
+books_bp = Blueprint('books', __name__)
+
+BOOKS_DIR = os.path.join(DATA_DIR, 'books')
+MAX_FILE_SIZE = 50 * 1024 * 1024  # 与 book-splitter.js 的 CONFIG.MAX_FILE_SIZE 一致
+CHUNK_SIZE = 1024 * 1024
+SAMPLE_SIZE = 64 * 1024
+
+# gb18030 是 GBK/GB2312 的超集，一并覆盖前端的 GBK、GB2312 选项
+SUPPORTED_ENCODINGS = ['utf-8', 'gb18030', 'big5']
+ENCODING_ALIASES = {
+    'utf-8': 'utf-8',
+    'utf8': 'utf-8',
+    'gbk': 'gb18030',
+    'gb2312': 'gb18030',
+    'gb18030': 'gb18030',
+    'big5': 'big5',
+}
+
+# 常用汉字，用于在 GB 与 BIG5 都能解码时判断哪种结果更像正常文本
+COMMON_CHARS = set(
+    '的一是不了在人有我他这个们中来上大为和国地到以说时要就出会可也你对生能而子那得于着下自之年过发后作里'
+    '用道行所然家种事成方多经么去法学如都同现当没动面起看定天分还进好小部其些主样理心她本前开但因只从想实'
+    '們這個來為國說時會對於後裡從實動現沒當還進著過發經'
+)
+
+# 与 book-splitter.js 中 splitPattern 的规则保持一致：
+# 含"第X章/第X节"的行，或以"章节+数字"开头的行
+CHAPTER_NUM = '[0-9一二三四五六七八九十百千万零]+'
+HEADING_PATTERN = re.compile(
+    rf'第{CHAPTER_NUM}[章节]|^章节(?:[0-9]+|[一二三四五六七八九十百千万零]+)'
+)
+
+
+def normalize_encoding(name: str) -> str:
+    return ENCODING_ALIASES.get((name or '').strip().lower(), '')
+
+
+def detect_encoding(sample: bytes) -> str:
+    """
+    根据文件开头的样本判断编码
+    """
+    if sample.startswith(codecs.BOM_UTF8):
+        return 'utf-8-sig'
+
+    best_encoding, best_score = None, -1.0
+    for encoding in SUPPORTED_ENCODINGS:
+        decoder = codecs.getincrementaldecoder(encoding)(errors='strict')
+        try:
+            # final=False 容忍样本末尾被截断的多字节字符
+            text = decoder.decode(sample, final=False)
+        except UnicodeDecodeError:
+            continue
+        if encoding == 'utf-8':
+            return encoding
+        hanzi = [ch for ch in text if '一' <= ch <= '鿿']
+        score = sum(ch in COMMON_CHARS for ch in hanzi) / len(hanzi) if hanzi else 0.0
+        if score > best_score:
+            best_encoding, best_score = encoding, score
+
+    return best_encoding or 'gb18030'
+
+
+def is_heading(line: str) -> bool:
+    """
+    与 book-splitter.js 的 splitPattern 一致：含有"第X章/节"或以"章节"开头的行即为标题，不限行长
+    """
+    if not line:
+        return False
+    # 先用子串粗筛，绝大多数正文行无需进入正则
+    if '第' not in line and not line.startswith('章节'):
+        return False
+    return HEADING_PATTERN.search(line) is not None
+
+
+def split_chapters(path: str, encoding: str) -> list:
+    """
+    在内存映射的文件上单遍扫描，返回章节索引
+    offset/end 为正文在原始文件中的字节区间，length 为正文字符数
+    """
+    chapters = []
+    if os.path.getsize(path) == 0:
+        return chapters
+
+    decoder = codecs.getincrementaldecoder(encoding)(errors='replace')
+    current = None
+
+    with open(path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        size = len(mm)
+        pos = 0
+        while pos < size:
+            newline = mm.find(b'\n', pos)
+            line_end = size if newline == -1 else newline + 1
+            line = decoder.decode(mm[pos:line_end], final=line_end == size)
+            stripped = line.strip()
+
+            if is_heading(stripped):
+                if current is not None:
+                    current['end'] = pos
+                    chapters.append(current)
+                current = {
+                    'index': len(chapters),
+                    'title': stripped,
+                    'title_offset': pos,
+                    'offset': line_end,
+                    'end': size,
+                    'length': 0
+                }
+            elif current is not None:
+                current['length'] += len(line)
+
+            pos = line_end
+
+    if current is not None:
+        chapters.append(current)
+    return chapters
+
+
+class BookStore:
+    """
+    data/books/<book_id>/ 下保存原始文件 source.txt 与章节索引 index.json
+    """
+
+    def __init__(self, root: str = BOOKS_DIR):
+        self.root = root
+
+    def book_dir(self, book_id: str) -> str:
+        if not re.fullmatch(r'[0-9a-f]{16}', book_id or ''):
+            raise KeyError(book_id)
+        return os.path.join(self.root, book_id)
+
+    def save_upload(self, stream, filename: str, encoding: str = '') -> dict:
+        ensure_dir(self.root)
+        tmp_path = os.path.join(self.root, f'.upload-{os.getpid()}-{id(stream)}')
+        digest = hashlib.sha1()
+        size = 0
+        try:
+            with open(tmp_path, 'wb') as out:
+                while True:
+                    block = stream.read(CHUNK_SIZE)
+                    if not block:
+                        break
+                    size += len(block)
+                    if size > MAX_FILE_SIZE:
+                        raise ValueError(f'文件大小不能超过{MAX_FILE_SIZE // 1024 // 1024}MB')
+                    digest.update(block)
+                    out.write(block)
+
+            book_id = digest.hexdigest()[:16]
+            book_dir = ensure_dir(self.book_dir(book_id))
+            source_path = os.path.join(book_dir, 'source.txt')
+            os.replace(tmp_path, source_path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+        if not encoding:
+            with open(source_path, 'rb') as f:
+                encoding = detect_encoding(f.read(SAMPLE_SIZE))
+
+        chapters = split_chapters(source_path, encoding)
+        index = {
+            'book_id': book_id,
+            'filename': filename,
+            'encoding': encoding,
+            'size': size,
+            'chapters': chapters
+        }
+        with open(os.path.join(book_dir, 'index.json'), 'w', encoding='utf-8') as f:
+            json.dump(index, f, ensure_ascii=False)
+        return index
+
+    def load_index(self, book_id: str) -> dict:
+        path = os.path.join(self.book_dir(book_id), 'index.json')
+        if not os.path.exists(path):
+            raise KeyError(book_id)
+        with open(path, encoding='utf-8') as f:
+            return json.load(f)
+
+    def iter_chapters(self, book_id: str):
+        """
+        source 为正文在原始文件中的位置，可交给 read_source 重新读取
+        """
+        book = self.load_index(book_id)
+        path = os.path.join(self.book_dir(book_id), 'source.txt')
+        with open(path, 'rb') as f:
+            for chapter in book['chapters']:
+                f.seek(chapter['offset'])
+                raw = f.read(chapter['end'] - chapter['offset'])
+                yield {
+                    'index': chapter['index'],
+                    'title': chapter['title'],
+                    'content': raw.decode(book['encoding'], errors='replace').strip(),
+                    'source': {'book_id': book_id, 'offset': chapter['offset'], 'end': chapter['end'],
+                               'encoding': book['encoding']}
+                }
+
+    def read_source(self, source: dict) -> str:
+        path = os.path.join(self.book_dir(source['book_id']), 'source.txt')
+        with open(path, 'rb') as f:
+            f.seek(source['offset'])
+            raw = f.read(source['end'] - source['offset'])
+        return raw.decode(source['encoding'], errors='replace').strip()
+
+    def read_chapter(self, book_id: str, index: int) -> dict:
+        book = self.load_index(book_id)
+        chapters = book['chapters']
+        if not 0 <= index < len(chapters):
+            raise KeyError(index)
+        chapter = chapters[index]
+        path = os.path.join(self.book_dir(book_id), 'source.txt')
+        with open(path, 'rb') as f:
+            f.seek(chapter['offset'])
+            raw = f.read(chapter['end'] - chapter['offset'])
+        return {
+            'index': index,
+            'title': chapter['title'],
+            'content': raw.decode(book['encoding'], errors='replace').strip()
+        }
+
+
+book_store = BookStore()
+
+
+@books_bp.route('/books/import', methods=['POST'])
+def import_book():
+    if request.content_length and request.content_length > MAX_FILE_SIZE + CHUNK_SIZE:
+        return json_response({'error': f'文件大小不能超过{MAX_FILE_SIZE // 1024 // 1024}MB'}, 413)
+
+    upload = request.files.get('file')
+    if upload is None:
+        return json_response({'error': '缺少上传文件'}, 400)
+
+    encoding = ''
+    if request.form.get('encoding'):
+        encoding = normalize_encoding(request.form['encoding'])
+        if not encoding:
+            return json_response({'error': f"不支持的编码: {request.form['encoding']}"}, 400)
+
+    try:
+        index = book_store.save_upload(upload.stream, upload.filename or '', encoding)
+    except ValueError as e:
+        return json_response({'error': str(e)}, 413)
+    except Exception as e:
+        logger.error(f"Error importing book: {e}")
+        return json_response({'error': f'导入失败: {e}'}, 500)
+
+    logger.info(f"Imported book {index['book_id']}: {len(index['chapters'])} chapters, encoding {index['encoding']}")
+    # 全文索引在后台建立，不阻塞章节目录的返回
+    index_book_async(index['book_id'], book_store.iter_chapters(index['book_id']))
+    return json_response(index)
+
+
+@books_bp.route('/books/<book_id>', methods=['GET'])
+def get_book(book_id):
+    try:
+        return json_response(book_store.load_index(book_id))
+    except KeyError:
+        return json_response({'error': '书籍不存在'}, 404)
+
+
+@books_bp.route('/books/<book_id>/chapters/<int:index>', methods=['GET'])
+def get_chapter(book_id, index):
+    try:
+        return json_response(book_store.read_chapter(book_id, index))
+    except KeyError:
+        return json_response({'error': '章节不存在'}, 404)
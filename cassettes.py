@@ -0,0 +1,520 @@
+"""
+上游流式响应的录制与回放（cassette）
+
+NOVEL_CASSETTES=record 时，每次上游调用的原始响应字节连同相邻数据块的间隔写入 data/cassettes/<后端>/；
+NOVEL_CASSETTES=replay 时按请求（方法、地址与请求体，不含查询参数）查找录制的 cassette，
+经由各后端原有的解析与流式处理返回，不访问网络；NOVEL_CASSETTE_SPEED=fast 时不等待录制的间隔。
+
+基于 requests 的后端通过 cassette_session() 发送请求，OpenAI SDK（httpx）使用 cassette_http_client()；
+通义千问与 Gemini 的 SDK 无法替换底层连接，改用 recorded_chunks 录制 SDK 解析后的文本块。
+
+    python cassettes.py list
+    python cassettes.py bench apps/app-claude.py data/cassettes/claude/<key>.cassette --fast --repeat 20
+
+tests/cassettes 中附带 Claude、DeepSeek 与 Ollama 的示例录制，python -m pytest 以 fast 模式经由各后端回放。
+"""
+import argparse
+import functools
+import gzip
+import hashlib
+import json
+import logging
+import os
+import statistics
+import struct
+import tempfile
+import threading
+import time
+from datetime import datetime
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+from requests.structures import CaseInsensitiveDict
+from requests.utils import get_encoding_from_headers
+
+import common
+from common import DATA_DIR, ensure_dir
+
+try:
+    import httpx
+except ImportError:
+    # 只有使用 OpenAI SDK 的后端需要
+    httpx = None
+
+logger = logging.getLogger(__name__)
+
+CASSETTE_DIR = os.environ.get('NOVEL_CASSETTE_DIR', os.path.join(DATA_DIR, 'cassettes'))
+MAGIC = b'NCAS1\n'
+# 每个数据块：距上一块的微秒数、长度、类型
+RECORD = struct.Struct('<IIB')
+BODY, TEXT, USAGE = 0, 1, 2
+# requests 录制的是解码后的正文，这些响应头回放时不再适用
+DROPPED_HEADERS = {'content-encoding', 'content-length', 'transfer-encoding'}
+
+
+class CassetteNotFound(RuntimeError):
+    pass
+
+
+class Cassette:
+    """
+    header 记录请求与响应头；records 为 (间隔秒数, 类型, 数据)
+    """
+
+    def __init__(self, header: dict, records: list = None):
+        self.header = header
+        self.records = records or []
+
+    @classmethod
+    def load(cls, path: str) -> 'Cassette':
+        with gzip.open(path, 'rb') as f:
+            if f.readline() != MAGIC:
+                raise ValueError(f'不是 cassette 文件: {path}')
+            header = json.loads(f.readline())
+            records = []
+            while head := f.read(RECORD.size):
+                delay_us, length, kind = RECORD.unpack(head)
+                records.append((delay_us / 1e6, kind, f.read(length)))
+        return cls(header, records)
+
+    def save(self, path: str):
+        ensure_dir(os.path.dirname(path))
+        tmp = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+        with gzip.open(tmp, 'wb', compresslevel=6) as f:
+            f.write(MAGIC)
+            f.write(json.dumps(self.header, ensure_ascii=False).encode('utf-8') + b'\n')
+            for delay, kind, data in self.records:
+                f.write(RECORD.pack(min(int(delay * 1e6), 0xFFFFFFFF), len(data), kind))
+                f.write(data)
+        os.replace(tmp, path)
+
+    @property
+    def duration(self) -> float:
+        return self.header.get('header_delay', 0) + sum(delay for delay, _, _ in self.records)
+
+    def play(self, fast: bool = False):
+        """
+        按录制的间隔逐块产出 (类型, 数据)；fast 时不等待
+        """
+        for delay, kind, data in self.records:
+            if delay and not fast:
+                time.sleep(delay)
+            yield kind, data
+
+
+class Recorder:
+    def __init__(self, path: str, header: dict):
+        self.path = path
+        self.cassette = Cassette({**header, 'recorded': datetime.now().isoformat(timespec='seconds')})
+        self.started = time.monotonic()
+        self.last = self.started
+        self.finished = False
+
+    def response(self, status: int, headers: dict):
+        now = time.monotonic()
+        self.cassette.header.update(status=status, headers=headers, header_delay=round(now - self.started, 6))
+        self.last = now
+
+    def add(self, kind: int, data: bytes):
+        now = time.monotonic()
+        self.cassette.records.append((now - self.last, kind, data))
+        self.last = now
+
+    def finish(self, complete: bool = False):
+        """
+        可重复调用；提前关闭的响应同样保存，complete 标记是否读到了结尾
+        """
+        if self.finished:
+            return
+        self.finished = True
+        self.cassette.header['complete'] = complete
+        try:
+            self.cassette.save(self.path)
+            logger.info(f"Recorded cassette {self.path} ({len(self.cassette.records)} chunks)")
+        except OSError as e:
+            logger.error(f"Failed to save cassette {self.path}: {e}")
+
+
+class CassetteStore:
+    def __init__(self, root: str = CASSETTE_DIR):
+        self.root = root
+        self.mode = os.environ.get('NOVEL_CASSETTES', '')
+        self.fast = os.environ.get('NOVEL_CASSETTE_SPEED') == 'fast'
+        self.loaded = {}
+        self.forced = None
+        if self.mode and self.mode not in ('record', 'replay'):
+            raise ValueError(f'NOVEL_CASSETTES 只能是 record 或 replay: {self.mode}')
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.mode)
+
+    @staticmethod
+    def request_key(method: str, url: str, body) -> str:
+        # 查询参数中常有临时凭据（如文心一言的 access_token），不参与匹配
+        parts = urlsplit(url)
+        if isinstance(body, str):
+            body = body.encode('utf-8')
+        digest = hashlib.sha256(f'{method} {parts.scheme}://{parts.netloc}{parts.path}\n'.encode('utf-8'))
+        digest.update(body or b'')
+        return digest.hexdigest()[:24]
+
+    @staticmethod
+    def chunk_key(route: str, prompt: str, model: str = None) -> str:
+        return hashlib.sha256(json.dumps([route, model, prompt], ensure_ascii=False).encode('utf-8')).hexdigest()[:24]
+
+    def path(self, backend: str, key: str) -> str:
+        return os.path.join(self.root, backend, f'{key}.cassette')
+
+    def recorder(self, backend: str, key: str, header: dict) -> Recorder:
+        return Recorder(self.path(backend, key), {'backend': backend, 'key': key, **header})
+
+    def find(self, backend: str, key: str) -> Cassette:
+        """
+        按 key 查找；找不到时使用 force() 指定的 cassette（用于以任意提示词回放某次录制）
+        """
+        path = self.path(backend, key)
+        if not os.path.exists(path):
+            if self.forced is None:
+                raise CassetteNotFound(f'没有录制的 cassette: {backend}/{key}')
+            path = self.forced
+        if path not in self.loaded:
+            self.loaded[path] = Cassette.load(path)
+        return self.loaded[path]
+
+    def force(self, path: str, fast: bool = None):
+        self.mode = 'replay'
+        self.forced = os.path.abspath(path)
+        if fast is not None:
+            self.fast = fast
+
+
+store = CassetteStore()
+
+
+class RecordingRaw:
+    """
+    包装 urllib3 的响应，读取正文时按块录制
+    """
+
+    def __init__(self, raw, recorder: Recorder):
+        self.raw = raw
+        self.recorder = recorder
+
+    def stream(self, amt=2 ** 16, decode_content=None):
+        for chunk in self.raw.stream(amt, decode_content=True):
+            self.recorder.add(BODY, chunk)
+            yield chunk
+        self.recorder.finish(complete=True)
+
+    def read(self, amt=None, decode_content=None, **kwargs):
+        data = self.raw.read(amt, decode_content=True, **kwargs)
+        if data:
+            self.recorder.add(BODY, data)
+        else:
+            self.recorder.finish(complete=True)
+        return data
+
+    def close(self):
+        self.recorder.finish()
+        self.raw.close()
+
+    def release_conn(self):
+        self.recorder.finish()
+        self.raw.release_conn()
+
+    def __getattr__(self, name):
+        return getattr(self.raw, name)
+
+
+class ReplayRaw:
+    def __init__(self, cassette: Cassette, fast: bool):
+        self.chunks = (data for kind, data in cassette.play(fast) if kind == BODY)
+        self.buffer = b''
+
+    def stream(self, amt=2 ** 16, decode_content=None):
+        if self.buffer:
+            yield self.buffer
+            self.buffer = b''
+        yield from self.chunks
+
+    def read(self, amt=None, decode_content=None, **kwargs):
+        while amt is None or len(self.buffer) < amt:
+            chunk = next(self.chunks, None)
+            if chunk is None:
+                break
+            self.buffer += chunk
+        if amt is None:
+            data, self.buffer = self.buffer, b''
+        else:
+            data, self.buffer = self.buffer[:amt], self.buffer[amt:]
+        return data
+
+    def close(self):
+        self.chunks.close()
+
+    def release_conn(self):
+        pass
+
+
+class CassetteAdapter(HTTPAdapter):
+    """
+    requests 的传输适配器：录制模式下转发并录制响应，回放模式下直接由 cassette 构造响应
+    """
+
+    def __init__(self, backend: str, cassettes: CassetteStore = store):
+        super().__init__()
+        self.backend = backend
+        self.cassettes = cassettes
+
+    def send(self, request, stream=False, **kwargs):
+        key = self.cassettes.request_key(request.method, request.url, request.body)
+        if self.cassettes.mode == 'replay':
+            return self.replay(request, self.cassettes.find(self.backend, key))
+
+        recorder = self.cassettes.recorder(self.backend, key, {
+            'transport': 'requests', 'method': request.method, 'url': request.url.split('?')[0],
+            'request': (request.body.decode('utf-8', 'replace') if isinstance(request.body, bytes)
+                        else request.body)
+        })
+        response = super().send(request, stream=True, **kwargs)
+        recorder.response(response.status_code, {k: v for k, v in response.headers.items()
+                                                  if k.lower() not in DROPPED_HEADERS})
+        response.raw = RecordingRaw(response.raw, recorder)
+        return response
+
+    def replay(self, request, cassette: Cassette):
+        header = cassette.header
+        if not self.cassettes.fast:
+            time.sleep(header.get('header_delay', 0))
+        response = requests.Response()
+        response.status_code = header['status']
+        response.headers = CaseInsensitiveDict(header['headers'])
+        response.encoding = get_encoding_from_headers(response.headers)
+        response.raw = ReplayRaw(cassette, self.cassettes.fast)
+        response.reason = 'Replayed'
+        response.url = request.url
+        response.request = request
+        response.connection = self
+        return response
+
+
+def cassette_session(backend: str):
+    """
+    后端发送上游请求所用的对象：启用录制或回放时为挂载了 CassetteAdapter 的 Session，
+    未启用时直接返回 requests 模块，行为与原来一致
+    """
+    if not store.enabled:
+        return requests
+    session = requests.Session()
+    adapter = CassetteAdapter(backend)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+if httpx is not None:
+    class RecordingByteStream(httpx.SyncByteStream):
+        def __init__(self, stream, recorder: Recorder):
+            self.stream = stream
+            self.recorder = recorder
+
+        def __iter__(self):
+            for chunk in self.stream:
+                self.recorder.add(BODY, chunk)
+                yield chunk
+            self.recorder.finish(complete=True)
+
+        def close(self):
+            self.recorder.finish()
+            self.stream.close()
+
+    class ReplayByteStream(httpx.SyncByteStream):
+        def __init__(self, cassette: Cassette, fast: bool):
+            self.chunks = (data for kind, data in cassette.play(fast) if kind == BODY)
+
+        def __iter__(self):
+            yield from self.chunks
+
+        def close(self):
+            self.chunks.close()
+
+    class CassetteTransport(httpx.BaseTransport):
+        """
+        httpx 的传输层：录制的是未解码的原始字节，回放时由 httpx 按原响应头解码
+        """
+
+        def __init__(self, backend: str, cassettes: CassetteStore = store):
+            self.backend = backend
+            self.cassettes = cassettes
+            self.inner = httpx.HTTPTransport()
+
+        def handle_request(self, request):
+            body = request.read()
+            key = self.cassettes.request_key(request.method, str(request.url), body)
+            if self.cassettes.mode == 'replay':
+                cassette = self.cassettes.find(self.backend, key)
+                if not self.cassettes.fast:
+                    time.sleep(cassette.header.get('header_delay', 0))
+                return httpx.Response(cassette.header['status'], headers=cassette.header['headers'],
+                                      stream=ReplayByteStream(cassette, self.cassettes.fast), request=request)
+
+            recorder = self.cassettes.recorder(self.backend, key, {
+                'transport': 'httpx', 'method': request.method, 'url': str(request.url).split('?')[0],
+                'request': body.decode('utf-8', 'replace')
+            })
+            response = self.inner.handle_request(request)
+            recorder.response(response.status_code, dict(response.headers.multi_items()))
+            return httpx.Response(response.status_code, headers=response.headers,
+                                  stream=RecordingByteStream(response.stream, recorder),
+                                  extensions=response.extensions, request=request)
+
+        def close(self):
+            self.inner.close()
+
+
+def cassette_http_client(backend: str):
+    """
+    传给 OpenAI(http_client=...) 的客户端；未启用录制或回放时返回 None，使用 SDK 默认的客户端
+    """
+    if not store.enabled:
+        return None
+    if httpx is None:
+        raise RuntimeError('录制或回放 OpenAI SDK 的请求需要安装 httpx')
+    return httpx.Client(transport=CassetteTransport(backend), follow_redirects=True)
+
+
+def recorded_chunks(backend: str, model_of=None):
+    """
+    装饰 stream_completion(route, prompt, ...)，录制或回放其产出的文本块与 Usage；
+    用于不能替换底层连接的 SDK，回放时不经过 SDK 的解析。model_of(route) 返回模型名称，参与匹配
+    """
+    # 延迟导入：bench 需要在后端与共享状态模块导入之前切换数据目录
+    from usage_ledger import Usage
+
+    def decorator(stream_completion):
+        @functools.wraps(stream_completion)
+        def wrapper(route, prompt, *args, **kwargs):
+            if not store.enabled:
+                yield from stream_completion(route, prompt, *args, **kwargs)
+                return
+            model = model_of(route) if model_of else None
+            key = store.chunk_key(route, prompt, model)
+            if store.mode == 'replay':
+                for kind, data in store.find(backend, key).play(store.fast):
+                    yield Usage(**json.loads(data)) if kind == USAGE else data.decode('utf-8')
+                return
+
+            recorder = store.recorder(backend, key, {
+                'transport': 'chunks', 'route': route, 'model': model, 'prompt': prompt, 'status': 200
+            })
+            complete = False
+            try:
+                for item in stream_completion(route, prompt, *args, **kwargs):
+                    if isinstance(item, Usage):
+                        recorder.add(USAGE, json.dumps({name: getattr(item, name) for name in Usage.__slots__})
+                                     .encode('utf-8'))
+                    else:
+                        recorder.add(TEXT, item.encode('utf-8'))
+                    yield item
+                complete = True
+            finally:
+                recorder.finish(complete)
+        return wrapper
+    return decorator
+
+
+def list_cassettes(root: str = CASSETTE_DIR) -> list:
+    items = []
+    for dirpath, _, filenames in os.walk(root):
+        for name in sorted(filenames):
+            if not name.endswith('.cassette'):
+                continue
+            path = os.path.join(dirpath, name)
+            cassette = Cassette.load(path)
+            header = cassette.header
+            items.append({
+                'path': os.path.relpath(path, root),
+                'backend': header.get('backend'),
+                'transport': header.get('transport'),
+                'target': header.get('url') or header.get('route'),
+                'status': header.get('status'),
+                'complete': header.get('complete'),
+                'chunks': len(cassette.records),
+                'bytes': sum(len(data) for _, _, data in cassette.records),
+                'duration': round(cassette.duration, 3),
+                'recorded': header.get('recorded')
+            })
+    return items
+
+
+def bench(app_path: str, cassette_path: str, route: str = 'gen', fast: bool = False, repeat: int = 1) -> dict:
+    """
+    以回放模式加载后端，把 cassette 经由后端的 stream_completion 与 resilient_stream 重放 repeat 次，
+    统计首块耗时、总耗时与输出量
+    """
+    cassette = Cassette.load(cassette_path)
+    store.force(cassette_path, fast)
+    from serve import load_module
+    from streaming import resilient_stream
+
+    stream_completion = load_module(app_path).stream_completion
+    route = cassette.header.get('route') or route
+    prompt = cassette.header.get('prompt', '')
+    runs = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        first = None
+        chunks = chars = 0
+        for chunk in resilient_stream(stream_completion, route, prompt, lane='interactive',
+                                      tags={'feature': 'bench'}):
+            if first is None:
+                first = time.perf_counter() - started
+            chunks += 1
+            chars += len(chunk)
+        runs.append({'first_chunk': first or 0, 'total': time.perf_counter() - started,
+                     'chunks': chunks, 'chars': chars})
+    totals = sorted(run['total'] for run in runs)
+    return {
+        'cassette': cassette_path,
+        'recorded_duration': round(cassette.duration, 3),
+        'runs': repeat,
+        'chunks': runs[-1]['chunks'],
+        'chars': runs[-1]['chars'],
+        'first_chunk_median': round(statistics.median(run['first_chunk'] for run in runs), 6),
+        'total_median': round(statistics.median(totals), 6),
+        'total_min': round(totals[0], 6),
+        'total_p95': round(totals[min(len(totals) - 1, int(len(totals) * 0.95))], 6),
+        'chars_per_second': round(runs[-1]['chars'] / statistics.median(totals), 1) if totals[0] else None
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='查看或回放录制的上游流式响应')
+    sub = parser.add_subparsers(dest='command', required=True)
+    list_parser = sub.add_parser('list', help='列出录制的 cassette')
+    list_parser.add_argument('--dir', default=CASSETTE_DIR)
+    bench_parser = sub.add_parser('bench', help='经由后端的解析与流式处理回放 cassette')
+    bench_parser.add_argument('app', help='后端文件，如 apps/app-claude.py')
+    bench_parser.add_argument('cassette')
+    bench_parser.add_argument('--route', default='gen')
+    bench_parser.add_argument('--fast', action='store_true', help='不等待录制的间隔')
+    bench_parser.add_argument('--repeat', type=int, default=1)
+    args = parser.parse_args()
+
+    if args.command == 'list':
+        for item in list_cassettes(args.dir):
+            print(json.dumps(item, ensure_ascii=False))
+        return
+    # 统计、账本与检索索引写入临时目录，不影响正式数据；后端的模块此时尚未导入，按新目录计算数据路径
+    common.DATA_DIR = tempfile.mkdtemp(prefix='novel-bench-')
+    logging.basicConfig(level=logging.WARNING)
+    result = bench(args.app, os.path.abspath(args.cassette), args.route, args.fast, max(1, args.repeat))
+    print(json.dumps(result, ensure_ascii=False, indent=2))
+
+
+if __name__ == '__main__':
+    # 以模块名重新导入后运行，命令行与后端使用同一个 store
+    import cassettes
+    cassettes.main()
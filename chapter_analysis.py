@@ -0,0 +1,201 @@
+"""
+拆书的章节拆解结果缓存
+
+拆解结果以（章节标题与正文、拆解提示词、模型）的哈希为键保存在 data/analyses/ 下，
+与书籍、章节序号无关：重新导入修改过的文件、重新切分或再次"全部拆解"时，
+内容、提示词与模型都没变的章节直接复用已有结果，只有哈希为新的章节才调用模型。
+超出模型上下文的章节先在后台分段概括（见 summarizer.py），以概括后的章节摘要代替正文拆解；
+概括完成前接口返回 202 与 Retry-After，客户端稍后重新请求。多进程部署时重新请求可能由其他 worker 处理，
+它会重新开始概括，但已完成的分块概括保存在 data/summaries/ 下，不会重复调用模型。
+"""
+import hashlib
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+
+from flask import Blueprint, Response, current_app
+
+from books import book_store
+from common import DATA_DIR, ResultStore, json_response
+from model_router import model_router
+from request_body import read_json
+from scheduler import QuotaExceeded, quota_error_response, scheduler, with_queue_headers
+from streaming import guard_stream
+from summarizer import condense_chapter, prompt_budget
+from token_estimator import estimate_route_tokens, route_models
+from tracing import start_trace
+from usage_ledger import request_tags
+
+logger = logging.getLogger(__name__)
+
+analysis_bp = Blueprint('analysis', __name__)
+
+ANALYSIS_DIR = os.path.join(DATA_DIR, 'analyses')
+DEFAULT_ROUTE = 'gen'
+MAX_LOOKUP_CHAPTERS = 1000
+CONDENSE_WORKERS = 2
+CONDENSE_RETRY_AFTER = 5
+
+
+def build_prompt(title: str, content: str, prompt: str) -> str:
+    """
+    与 book-splitter.js 原先发送到 /gen 的格式一致
+    """
+    return f'\n\n章节标题：{title}\n\n章节内容：{content} \n\n{prompt}'
+
+
+def analysis_key(title: str, content: str, prompt: str, model: str) -> str:
+    digest = hashlib.sha256()
+    for part in (title, content, prompt, model):
+        digest.update((part or '').encode('utf-8'))
+        digest.update(b'\0')
+    return digest.hexdigest()
+
+
+analysis_store = ResultStore(ANALYSIS_DIR)
+
+# 拆解键 -> 正在进行的分段概括
+condense_pool = ThreadPoolExecutor(max_workers=CONDENSE_WORKERS, thread_name_prefix='condense')
+condensing = {}
+condensing_lock = threading.Lock()
+
+
+def choose_route(route: str, prompt: str) -> str:
+    """
+    与 /gen 带 task=analysis 时的偏好相同，但不使用实时统计：缓存键中的模型即实际调用的模型，
+    同一章节的键不能随路由近期的延迟与成功率变化，否则已拆解的章节会被当作未拆解而重新调用模型
+    """
+    return model_router.choose(route, prompt, 'analysis', live=False)['route']
+
+
+def chapter_source(data: dict) -> tuple:
+    """
+    章节标题与正文：请求中没有正文时按 book_id、index 从服务端导入的书籍读取
+    """
+    if data.get('content') or not data.get('book_id'):
+        return data.get('title', ''), data.get('content', '')
+    chapter = book_store.read_chapter(data['book_id'], int(data.get('index', -1)))
+    return data.get('title') or chapter['title'], chapter['content']
+
+
+@analysis_bp.route('/analyses/chapter', methods=['POST'])
+def analyze_chapter():
+    """
+    请求: {prompt, title?, content? | book_id + index, route?, lane?}
+    已有结果时直接返回（X-Analysis-Cache: hit），否则流式返回模型输出并在完整结束后保存；
+    X-Analysis-Key 为该结果的键。超长章节概括完成前返回 202 {status: 'condensing'}
+    """
+    data = read_json()
+    if not data.get('prompt'):
+        return json_response({'error': '缺少拆解提示词'}, 400)
+    try:
+        title, content = chapter_source(data)
+    except (KeyError, ValueError):
+        return json_response({'error': '章节不存在'}, 404)
+    if not content:
+        return json_response({'error': '缺少章节内容'}, 400)
+
+    prompt = build_prompt(title, content, data['prompt'])
+    route = choose_route(data.get('route') or DEFAULT_ROUTE, prompt)
+    model = route_models.get(route, route)
+    key = analysis_key(title, content, data['prompt'], model)
+
+    cached = analysis_store.get(key)
+    if cached is not None:
+        response = Response(cached['analysis'], mimetype='text/plain')
+        response.headers['X-Analysis-Cache'] = 'hit'
+        response.headers['X-Analysis-Key'] = key
+        return response
+
+    stream_completion = current_app.extensions['stream_completion']
+    tags = request_tags(data, 'splitter')
+    if estimate_route_tokens(prompt, route) > prompt_budget(route):
+        # 在准入本次拆解之前完成：分段概括的调用各自排队，不会排在尚未开始的拆解调用之后；
+        # 概括可能需要几分钟，在后台进行，不让这次请求一直没有响应
+        with condensing_lock:
+            future = condensing.get(key)
+            if future is None:
+                future = condensing[key] = condense_pool.submit(
+                    condense_chapter, partial(stream_completion, tags=tags), title, content)
+            if future.done():
+                del condensing[key]
+        if not future.done():
+            response = json_response({'status': 'condensing', 'key': key}, 202)
+            response.headers['Retry-After'] = str(CONDENSE_RETRY_AFTER)
+            response.headers['X-Analysis-Key'] = key
+            return response
+        try:
+            summary = future.result()
+        except Exception as e:
+            logger.error(f"Failed to condense chapter {title}: {e}")
+            return json_response({'error': f'章节分段概括失败: {e}'}, 502)
+        prompt = build_prompt(title, f'（本章篇幅超出模型上下文，以下为分段概括后的章节概要）\n{summary}', data['prompt'])
+
+    try:
+        ticket = scheduler.admit(data.get('lane') or 'batch')
+    except QuotaExceeded as e:
+        return quota_error_response(e)
+    trace = start_trace(route)
+
+    def generate_stream():
+        parts = []
+        for chunk in stream_completion(route, prompt, ticket=ticket, tags=tags, trace=trace):
+            parts.append(chunk)
+            yield chunk
+        # 出错或客户端断开时不会执行到这里，不完整的结果不保存
+        analysis_store.put(key, {
+            'analysis': ''.join(parts),
+            'title': title,
+            'model': model,
+            'created': time.time()
+        })
+
+    response = Response(guard_stream(route, generate_stream(), trace=trace), mimetype='text/plain')
+    response.headers['X-Analysis-Cache'] = 'miss'
+    response.headers['X-Analysis-Key'] = key
+    return with_queue_headers(response, ticket)
+
+
+@analysis_bp.route('/analyses/lookup', methods=['POST'])
+def lookup_analyses():
+    """
+    请求: {prompt, route?, book_id?, chapters: [{index, title?, content?}]}
+    返回各章节当前的键与已有的拆解结果（没有时为 null），不调用模型；
+    提供 book_id 时未带正文的章节从服务端导入的书籍读取
+    """
+    data = read_json()
+    chapters = data.get('chapters') or []
+    if not data.get('prompt'):
+        return json_response({'error': '缺少拆解提示词'}, 400)
+    if len(chapters) > MAX_LOOKUP_CHAPTERS:
+        return json_response({'error': f'每次最多查询 {MAX_LOOKUP_CHAPTERS} 章'}, 400)
+
+    book = {}
+    if data.get('book_id') and any(not c.get('content') for c in chapters):
+        try:
+            # 整本书顺序读取一次，不必逐章重新加载章节索引
+            book = {c['index']: c for c in book_store.iter_chapters(data['book_id'])}
+        except KeyError:
+            return json_response({'error': '书籍不存在'}, 404)
+
+    route = data.get('route') or DEFAULT_ROUTE
+    results = []
+    for chapter in chapters:
+        source = chapter if chapter.get('content') else book.get(chapter.get('index'))
+        if source is None:
+            results.append({'index': chapter.get('index'), 'key': None, 'analysis': None})
+            continue
+        title = chapter.get('title') or source.get('title', '')
+        prompt = build_prompt(title, source['content'], data['prompt'])
+        model = route_models.get(choose_route(route, prompt), route)
+        key = analysis_key(title, source['content'], data['prompt'], model)
+        cached = analysis_store.get(key)
+        results.append({'index': chapter.get('index'), 'key': key, 'analysis': cached and cached['analysis']})
+
+    return json_response({
+        'chapters': results,
+        'hits': sum(r['analysis'] is not None for r in results)
+    })
@@ -0,0 +1,173 @@
+import json
+import logging
+import os
+import threading
+import time
+
+from flask import Response
+
+logger = logging.getLogger(__name__)
+
+# 服务端数据目录（拆书、索引、缓存等），可通过环境变量覆盖
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+DATA_DIR = os.environ.get('NOVEL_DATA_DIR', os.path.join(BASE_DIR, 'data'))
+
+
+def json_response(data, status=200) -> Response:
+    """
+    以 UTF-8 原文输出 JSON，与 /api-info 的返回格式保持一致
+    """
+    return Response(
+        json.dumps(data, ensure_ascii=False),
+        status=status,
+        mimetype='application/json'
+    )
+
+
+def int_field(data: dict, name: str, default: int, low: int, high: int) -> int:
+    """
+    请求体中的整数参数，超出范围时截断到 [low, high]；不是整数时抛出 ValueError
+    """
+    try:
+        value = int(data.get(name, default))
+    except (TypeError, ValueError):
+        raise ValueError(f'{name} 应为整数')
+    return max(low, min(value, high))
+
+
+def ensure_dir(path: str) -> str:
+    os.makedirs(path, exist_ok=True)
+    return path
+
+
+class ResultStore:
+    """
+    按内容哈希保存的模型输出（拆解结果、分层摘要等），每条一个文件：<root>/<键的前两位>/<键>.json
+    """
+
+    def __init__(self, root: str):
+        self.root = root
+
+    def path(self, key: str) -> str:
+        return os.path.join(self.root, key[:2], f'{key}.json')
+
+    def get(self, key: str):
+        try:
+            with open(self.path(key), encoding='utf-8') as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+        except ValueError as e:
+            logger.warning(f"Ignoring corrupt result {key}: {e}")
+            return None
+
+    def put(self, key: str, record: dict):
+        path = self.path(key)
+        ensure_dir(os.path.dirname(path))
+        tmp = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+        with open(tmp, 'w', encoding='utf-8') as f:
+            json.dump(record, f, ensure_ascii=False)
+        os.replace(tmp, path)
+
+
+class BackgroundRun:
+    """
+    后台任务（批量生成、分层摘要、知识提取）的状态与检查点：<root>/<run_id>.json，
+    子类设置 root 并在 __init__ 中给出初始 state
+    """
+    root = None
+
+    def __init__(self, run_id: str, spec: dict, state: dict):
+        self.run_id = run_id
+        self.spec = spec
+        self.lock = threading.Lock()
+        self.thread = None
+        self.state = state
+
+    @property
+    def path(self) -> str:
+        return os.path.join(self.root, f'{self.run_id}.json')
+
+    def checkpoint(self):
+        with self.lock:
+            self.state['updated'] = time.time()
+            payload = json.dumps({'run_id': self.run_id, 'spec': self.spec, 'state': self.state}, ensure_ascii=False)
+        ensure_dir(self.root)
+        tmp_path = f'{self.path}.{os.getpid()}.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            f.write(payload)
+        os.replace(tmp_path, self.path)
+
+    def final_checkpoint(self):
+        """
+        任务结束时的检查点；写入失败时本进程内的查询仍以内存中的状态为准（见 RunRegistry.get）
+        """
+        try:
+            self.checkpoint()
+        except OSError as e:
+            logger.error(f"Failed to checkpoint {type(self).__name__} {self.run_id}: {e}")
+
+    @classmethod
+    def load(cls, run_id: str):
+        # shared_state 依赖本模块，在此处导入避免循环导入
+        from shared_state import process_alive
+
+        path = os.path.join(cls.root, f'{run_id}.json')
+        if not os.path.exists(path):
+            return None
+        with open(path, encoding='utf-8') as f:
+            data = json.load(f)
+        run = cls(data['run_id'], data['spec'], data['state'])
+        # 运行该任务的进程已退出时视为中断；仍在运行时由该进程继续写入检查点
+        if run.state['status'] == 'running' and not process_alive(run.state.get('pid')):
+            run.state['status'] = 'interrupted'
+        return run
+
+
+class RunRegistry:
+    """
+    本进程已知的后台任务。任务可能由别的 worker 进程运行或继续，查询时读取检查点
+    """
+
+    def __init__(self, run_class):
+        self.run_class = run_class
+        self.runs = {}
+        self.lock = threading.Lock()
+
+    def add(self, run: BackgroundRun):
+        with self.lock:
+            self.runs[run.run_id] = run
+
+    def get(self, run_id: str):
+        """
+        本进程正在运行的任务直接返回；否则读取检查点，检查点比内存中的状态旧时
+        （本进程最后一次写入失败）仍以内存为准，不会停在 running
+        """
+        with self.lock:
+            run = self.runs.get(run_id)
+            if run is not None and run.thread and run.thread.is_alive():
+                return run
+            if run_id.isalnum():
+                loaded = self.run_class.load(run_id)
+                if loaded is not None and (run is None or loaded.state['updated'] >= run.state['updated']):
+                    run = self.runs[run_id] = loaded
+            return run
+
+
+def complete_text(stream_completion, route: str, prompt: str, on_chunk=None, should_stop=None) -> str:
+    """
+    消费 stream_completion(route, prompt) 的流式输出并拼接为完整文本
+    """
+    parts = []
+    stream = stream_completion(route, prompt)
+    try:
+        for content in stream:
+            parts.append(content)
+            if on_chunk:
+                on_chunk(content)
+            if should_stop and should_stop():
+                raise InterruptedError('任务已取消')
+    finally:
+        # 取消时及时关闭上游连接
+        stream.close()
+    return ''.join(parts)
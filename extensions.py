@@ -0,0 +1,57 @@
+"""
+各模型后端共用的服务端功能，在各 app 文件中通过 init_app(app) 注册
+"""
+from functools import partial
+
+from access_log import init_access_log
+from assets import init_assets
+from books import books_bp
+from chapter_analysis import analysis_bp
+from knowledge_extraction import extraction_bp
+from model_router import add_route_header, router_bp
+from optimizer import optimizer_bp
+from pipeline import pipeline_bp
+from prompt_registry import prompts_bp
+from request_body import decompress_request
+from retrieval import retrieval_bp
+from scheduler import scheduler_bp
+from search_index import search_bp
+from streaming import resilient_stream
+from summarizer import summary_bp
+from token_estimator import route_models
+from token_stats import stats_bp
+from tracing import add_request_id_header, traces_bp
+from usage_ledger import usage_bp
+
+
+def init_app(app, stream_completion=None, timeouts=None, models=None):
+    """
+    stream_completion(route, prompt) 由各后端提供，逐块返回模型输出；
+    依赖模型调用的服务端功能只在提供该函数时注册，并统一加上超时、卡顿重试与备用路由；
+    这些功能默认进入调度器的批量车道；
+    models 为路由 -> 模型名称，用于按模型的分词器估算 token 数
+    """
+    route_models.update(models or {})
+    app.before_request(decompress_request)
+    app.after_request(add_request_id_header)
+    app.after_request(add_route_header)
+    init_assets(app)
+    init_access_log(app)
+    app.register_blueprint(books_bp)
+    app.register_blueprint(search_bp)
+    app.register_blueprint(retrieval_bp)
+    app.register_blueprint(stats_bp)
+    app.register_blueprint(prompts_bp)
+    app.register_blueprint(scheduler_bp)
+    app.register_blueprint(usage_bp)
+    app.register_blueprint(traces_bp)
+    app.register_blueprint(router_bp)
+
+    if stream_completion is None:
+        return
+    app.extensions['stream_completion'] = partial(resilient_stream, stream_completion, timeouts=timeouts)
+    app.register_blueprint(pipeline_bp)
+    app.register_blueprint(optimizer_bp)
+    app.register_blueprint(analysis_bp)
+    app.register_blueprint(summary_bp)
+    app.register_blueprint(extraction_bp)
@@ -0,0 +1,344 @@
+"""
+从拆书结果增量提取知识库条目
+
+以章节的拆解结果为输入，用要求输出 JSON 的提示词提取人物、世界观、时间线、剧情线索与地点，
+按规范化后的名称去重合并到知识库（knowledge-base.js 的 data 结构）。
+每章的提取结果以（填充后的提示词、模型）的哈希为键缓存，前端记下已合并的键，
+再次提取时只处理新增或拆解结果有变化的章节。
+
+提取在后台任务中分批并行进行：每次调用模型前从各 worker 共享的令牌桶取令牌，
+整本书的提取不会在短时间内占满上游的请求配额，调用本身仍在调度器的批量车道中排队。
+"""
+import hashlib
+import json
+import logging
+import os
+import re
+import threading
+import time
+import unicodedata
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+
+from flask import Blueprint, current_app
+
+from chapter_analysis import analysis_store
+from common import DATA_DIR, BackgroundRun, ResultStore, RunRegistry, complete_text, int_field, json_response
+from pipeline import fill_template
+from request_body import read_json
+from shared_state import shared_state
+from token_estimator import route_models
+
+logger = logging.getLogger(__name__)
+
+extraction_bp = Blueprint('extraction', __name__)
+
+KNOWLEDGE_DIR = os.path.join(DATA_DIR, 'knowledge')
+RUNS_DIR = os.path.join(KNOWLEDGE_DIR, 'runs')
+DEFAULT_ROUTE = 'gen2'
+DEFAULT_CONCURRENCY = 3
+MAX_CONCURRENCY = 8
+# 每批提交的章节数，每批结束后写入检查点
+BATCH_SIZE = 20
+RATE_BUCKET = 'knowledge-extract'
+# 所有 worker 合计每秒最多发起的提取调用数与允许的突发数
+RATE_PER_SECOND = float(os.environ.get('NOVEL_EXTRACT_RATE', '0.5'))
+RATE_BURST = 4
+
+# 与 knowledge-base.js 中 getCustomFields 的字段一致
+CATEGORY_FIELDS = {
+    'characters': ['age', 'role', 'personality'],
+    'worldSettings': ['rules', 'background'],
+    'timeline': ['date', 'importance'],
+    'plotLines': ['mainPlot', 'subPlots'],
+    'locations': ['coordinates', 'features'],
+}
+
+EXTRACT_PROMPT = """以下是小说章节（${title}）的拆解分析。请从中提取知识库条目，只输出一个 JSON 对象，不要输出其他内容：
+{
+  "characters": [{"name": "人物名", "description": "身份与本章经历", "role": "角色定位", "personality": "性格特征", "tags": ["标签"]}],
+  "worldSettings": [{"name": "设定名", "description": "说明", "rules": "规则体系", "background": "背景设定"}],
+  "timeline": [{"name": "事件", "description": "经过", "date": "故事中的时间", "importance": 3}],
+  "plotLines": [{"name": "线索名", "description": "本章进展", "mainPlot": "主要情节", "subPlots": "支线情节"}],
+  "locations": [{"name": "地点名", "description": "描述", "features": "特征"}]
+}
+没有的类别输出空数组；同一人物、地点使用书中最常用的称呼；importance 为 1 到 5 的整数；不要编造分析中没有的信息。
+
+${text}"""
+
+extraction_store = ResultStore(os.path.join(KNOWLEDGE_DIR, 'cache'))
+
+
+def normalize_name(name: str) -> str:
+    """
+    去重用的名称：全角半角统一、忽略大小写、空白与标点（"林 动"、"林动。"、"《林动》"视为同一条目）
+    """
+    return re.sub(r'[\W_]+', '', unicodedata.normalize('NFKC', name).lower())
+
+
+def parse_extraction(reply: str) -> dict:
+    """
+    从模型输出中取出 JSON 对象（容忍前后的说明文字与代码块标记），只保留已知类别与字段
+    """
+    start, end = reply.find('{'), reply.rfind('}')
+    if start < 0 or end < start:
+        raise ValueError('模型输出中没有 JSON 对象')
+    data = json.loads(reply[start:end + 1])
+    if not isinstance(data, dict):
+        raise ValueError('模型输出的 JSON 不是对象')
+
+    result = {}
+    for category, fields in CATEGORY_FIELDS.items():
+        items = []
+        for item in data.get(category) or []:
+            if not isinstance(item, dict) or not str(item.get('name') or '').strip():
+                continue
+            tags = item.get('tags') if isinstance(item.get('tags'), list) else []
+            clean = {
+                'type': category,
+                'name': str(item['name']).strip(),
+                'description': str(item.get('description') or '').strip(),
+                'tags': [str(tag).strip() for tag in tags if str(tag).strip()]
+            }
+            for field in fields:
+                if item.get(field) not in (None, ''):
+                    clean[field] = str(item[field]).strip()
+            items.append(clean)
+        result[category] = items
+    return result
+
+
+def merge_item(existing: dict, item: dict) -> bool:
+    """
+    合并同名条目：标签取并集，空字段补全，描述中没有的内容追加在后面；已有的字段不覆盖
+    """
+    changed = False
+    for key, value in item.items():
+        if key in ('type', 'name') or not value:
+            continue
+        current = existing.get(key)
+        if key == 'tags':
+            tags = list(current or [])
+            new_tags = [tag for tag in value if tag not in tags]
+            if new_tags:
+                existing['tags'] = tags + new_tags
+                changed = True
+        elif not current:
+            existing[key] = value
+            changed = True
+        elif key == 'description' and value not in str(current):
+            existing[key] = f'{current}\n{value}'
+            changed = True
+    return changed
+
+
+def merge_knowledge(knowledge: dict, extracted: dict) -> tuple:
+    """
+    把提取结果按规范化名称合并进 knowledge（原地修改），返回（新增条目数, 更新条目数）
+    """
+    added = updated = 0
+    for category in CATEGORY_FIELDS:
+        items = knowledge.setdefault(category, [])
+        by_name = {normalize_name(str(i.get('name', ''))): i for i in items if isinstance(i, dict)}
+        for item in extracted.get(category) or []:
+            key = normalize_name(item['name'])
+            if not key:
+                continue
+            if key in by_name:
+                updated += merge_item(by_name[key], item)
+            else:
+                new_item = {**item, 'tags': list(item.get('tags') or [])}
+                items.append(new_item)
+                by_name[key] = new_item
+                added += 1
+    return added, updated
+
+
+def wait_for_rate():
+    while (wait := shared_state.take(RATE_BUCKET, RATE_PER_SECOND, RATE_BURST)) > 0:
+        time.sleep(min(wait, 5))
+
+
+class Extractor:
+    def __init__(self, stream_completion, route: str = DEFAULT_ROUTE, store: ResultStore = extraction_store):
+        self.stream_completion = stream_completion
+        self.route = route
+        self.model = route_models.get(route, route)
+        self.store = store
+
+    def prompt(self, chapter: dict) -> str:
+        return fill_template(EXTRACT_PROMPT, {'title': chapter['title'], 'text': chapter['analysis']})
+
+    def key(self, chapter: dict) -> str:
+        return hashlib.sha256(f'{self.model}\0{self.prompt(chapter)}'.encode('utf-8')).hexdigest()
+
+    def extract(self, chapter: dict) -> tuple:
+        """
+        返回（提取结果, 是否命中缓存）；输出无法解析时抛出 ValueError，不写入缓存
+        """
+        key = self.key(chapter)
+        record = self.store.get(key)
+        if record is not None:
+            return record['items'], True
+        wait_for_rate()
+        items = parse_extraction(complete_text(self.stream_completion, self.route, self.prompt(chapter)))
+        self.store.put(key, {'items': items, 'title': chapter['title'], 'model': self.model, 'created': time.time()})
+        return items, False
+
+
+class ExtractionRun(BackgroundRun):
+    """
+    processed 为前端已合并过的提取键，这些章节跳过；结果 items 为其余章节按顺序去重合并后的条目，
+    由前端通过 /knowledge/merge 合并进当前的知识库
+    """
+
+    root = RUNS_DIR
+
+    def __init__(self, run_id: str, spec: dict, state: dict = None):
+        super().__init__(run_id, spec, state or {
+            'status': 'pending',
+            'done': 0,
+            'total': 0,
+            'skipped': 0,
+            'calls': 0,
+            'cached': 0,
+            'errors': [],
+            'error': None,
+            'created': time.time(),
+            'updated': time.time(),
+            'items': {},
+            'processed': []
+        })
+
+    def start(self, stream_completion, chapters: list, processed: set):
+        # 用量账本中以任务 ID 作为请求 ID，汇总整次提取的消耗
+        stream_completion = partial(stream_completion, tags={'feature': 'knowledge', 'request_id': self.run_id})
+        self.thread = threading.Thread(target=self.run, args=(stream_completion, chapters, processed), daemon=True)
+        self.thread.start()
+
+    def _extract(self, extractor: Extractor, chapter: dict):
+        try:
+            items, cached = extractor.extract(chapter)
+        except Exception as e:
+            logger.warning(f"Knowledge extraction failed for chapter {chapter['index']}: {e}")
+            with self.lock:
+                self.state['done'] += 1
+                self.state['errors'].append({'index': chapter['index'], 'title': chapter['title'], 'error': str(e)})
+            return None
+        with self.lock:
+            self.state['done'] += 1
+            self.state['cached' if cached else 'calls'] += 1
+        return items
+
+    def run(self, stream_completion, chapters: list, processed: set):
+        extractor = Extractor(stream_completion, self.spec['route'])
+        try:
+            keys = [extractor.key(c) for c in chapters]
+            pending = [(c, k) for c, k in zip(chapters, keys) if k not in processed]
+            self.state.update(status='running', pid=os.getpid(), total=len(pending),
+                              skipped=len(chapters) - len(pending))
+            self.checkpoint()
+
+            extracted = {}
+            with ThreadPoolExecutor(max_workers=self.spec['concurrency'],
+                                    thread_name_prefix=f'extract-{self.run_id}') as pool:
+                for start in range(0, len(pending), BATCH_SIZE):
+                    batch = pending[start:start + BATCH_SIZE]
+                    results = list(pool.map(partial(self._extract, extractor), [c for c, _ in batch]))
+                    # 按章节顺序合并，同名条目的描述按情节先后追加
+                    with self.lock:
+                        for (_, key), items in zip(batch, results):
+                            if items is not None:
+                                merge_knowledge(extracted, items)
+                                self.state['processed'].append(key)
+                        self.state['items'] = extracted
+                    self.checkpoint()
+            self.state['status'] = 'done' if not self.state['errors'] else 'error'
+        except Exception as e:
+            # 已提取的章节都在缓存中，重新提取时不会再调用模型
+            logger.error(f"Knowledge extraction {self.run_id} failed: {e}")
+            with self.lock:
+                self.state.update(status='error', error=str(e))
+        self.final_checkpoint()
+        logger.info(f"Knowledge extraction {self.run_id} finished with status {self.state['status']} "
+                    f"({self.state['calls']} calls, {self.state['cached']} cached, {len(self.state['errors'])} errors)")
+
+    def to_dict(self) -> dict:
+        with self.lock:
+            return {
+                'run_id': self.run_id,
+                'status': self.state['status'],
+                'progress': {'done': self.state['done'], 'total': self.state['total']},
+                'skipped': self.state['skipped'],
+                'calls': self.state['calls'],
+                'cached': self.state['cached'],
+                'errors': list(self.state['errors']),
+                'error': self.state.get('error'),
+                'created': self.state['created'],
+                'updated': self.state['updated'],
+                'items': self.state['items'],
+                'processed': list(self.state['processed'])
+            }
+
+
+runs = RunRegistry(ExtractionRun)
+get_run = runs.get
+
+
+@extraction_bp.route('/knowledge/extractions', methods=['POST'])
+def create_extraction():
+    """
+    请求: {chapters: [{index, title, key? | analysis?}], processed?: [提取键...], route?, concurrency?}
+    key 为拆书结果的键（X-Analysis-Key），由服务端读取拆解结果；没有键时使用请求中的 analysis
+    """
+    data = read_json()
+    chapters = []
+    for chapter in data.get('chapters') or []:
+        if not isinstance(chapter, dict):
+            continue
+        record = analysis_store.get(chapter['key']) if re.fullmatch(r'[0-9a-f]{64}', chapter.get('key') or '') else None
+        analysis = record['analysis'] if record else chapter.get('analysis')
+        if analysis:
+            chapters.append({'index': chapter.get('index'), 'title': chapter.get('title', ''), 'analysis': analysis})
+    if not chapters:
+        return json_response({'error': '没有可提取的拆书结果'}, 400)
+    route = data.get('route') or DEFAULT_ROUTE
+    if not isinstance(route, str) or route not in route_models:
+        return json_response({'error': f'不支持的路由: {route}'}, 400)
+    try:
+        concurrency = int_field(data, 'concurrency', DEFAULT_CONCURRENCY, 1, MAX_CONCURRENCY)
+    except ValueError as e:
+        return json_response({'error': str(e)}, 400)
+
+    spec = {'chapters': len(chapters), 'route': route, 'concurrency': concurrency}
+    run = ExtractionRun(uuid.uuid4().hex[:16], spec)
+    runs.add(run)
+    run.checkpoint()
+    run.start(current_app.extensions['stream_completion'], chapters, set(data.get('processed') or []))
+    return json_response(run.to_dict(), 202)
+
+
+@extraction_bp.route('/knowledge/extractions/<run_id>', methods=['GET'])
+def get_extraction(run_id):
+    run = get_run(run_id)
+    if run is None:
+        return json_response({'error': '任务不存在'}, 404)
+    return json_response(run.to_dict())
+
+
+@extraction_bp.route('/knowledge/merge', methods=['POST'])
+def merge_into_knowledge():
+    """
+    请求: {knowledge: 当前知识库, items: 提取结果}，返回合并后的知识库与新增、更新的条目数
+    """
+    data = read_json()
+    knowledge = data.get('knowledge') if isinstance(data.get('knowledge'), dict) else {}
+    items = data.get('items') or {}
+    if not isinstance(items, dict) or not all(isinstance(v, list) for v in items.values()):
+        return json_response({'error': 'items 应为按类别分组的条目列表'}, 400)
+    try:
+        added, updated = merge_knowledge(knowledge, items)
+    except (KeyError, TypeError, AttributeError):
+        return json_response({'error': '知识库或条目的格式不正确'}, 400)
+    return json_response({'knowledge': knowledge, 'added': added, 'updated': updated})
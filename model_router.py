@@ -0,0 +1,175 @@
+"""
+按任务类型、提示词长度与实时延迟选择路由
+
+/gen、/gen2 默认仍使用各自的路由；以下情况由路由策略改选：
+- 提示词放不进所请求路由的上下文窗口（预留输出空间后）时，改用放得下的路由中窗口最大的一个；
+- 请求体声明了 task（如 title、analysis），或 route 为 'auto' 时，按任务的偏好在放得下的路由中选择：
+  fast 选预计耗时最短的（首字延迟 + 输出 token 数 / 输出速度），economy 选费用最低的，quality 保持所请求的路由。
+  只有 route 为 'auto' 而没有 task 时，短提示词按 fast 处理。
+
+首字延迟、输出速度与成功率由 resilient_stream 在每次调用后记入共享状态，按最近 RECENT_CALLS 次的中位数计算；
+近期成功率过低的路由不参与选择。选择结果通过 X-Route、X-Route-Reason 响应头返回，并记入该请求的 Trace。
+"""
+import logging
+import statistics
+
+from flask import Blueprint, g
+
+from common import json_response
+from prompt_registry import check_prompt_size, resolve_prompt
+from shared_state import shared_state
+from token_estimator import OUTPUT_RESERVE, context_window, estimate_route_tokens, route_models
+from usage_ledger import compute_cost, price_for
+
+logger = logging.getLogger(__name__)
+
+router_bp = Blueprint('router', __name__)
+
+AUTO_ROUTE = 'auto'
+RECENT_CALLS = 50
+# route 为 'auto' 且未声明任务时，不超过该 token 数的提示词按 fast 处理
+SHORT_PROMPT_TOKENS = 2000
+# 近期成功率低于该值的路由不参与选择（其他路由都不满足时除外）
+MIN_SUCCESS_RATE = 0.5
+# 还没有实测数据时假定的首字延迟（秒）与输出速度（tokens/秒）
+DEFAULT_TTFT = 3.0
+DEFAULT_TOKENS_PER_SECOND = 30.0
+NO_STATS = {'ttft': None, 'tokens_per_second': None, 'success_rate': None, 'calls': 0}
+
+# 任务类型 -> 偏好
+TASK_PROFILES = {
+    'title': 'fast', 'intro': 'fast', 'name': 'fast', 'chat': 'fast', 'score': 'fast',
+    'summary': 'economy', 'analysis': 'economy', 'extract': 'economy',
+    'outline': 'quality', 'chapters': 'quality', 'content': 'quality', 'polish': 'quality',
+}
+# 各偏好预计的输出 token 数，用于估算耗时与费用
+EXPECTED_OUTPUT_TOKENS = {'fast': 300, 'economy': 1500, 'quality': 3000}
+
+class ModelRouter:
+    def __init__(self, state=shared_state):
+        self.state = state
+
+    def observe(self, route: str, ttft: float = None, seconds: float = 0, completion_tokens: int = 0,
+                failed: bool = False):
+        """
+        记录一次上游调用：failed 为出错（取消不算），ttft 为首字耗时，seconds 为总耗时
+        """
+        with self.state.transaction() as conn:
+            self.state.push_sample(conn, f'router:ok:{route}', 0 if failed else 1, RECENT_CALLS)
+            if ttft is not None:
+                self.state.push_sample(conn, f'router:ttft:{route}', ttft, RECENT_CALLS)
+                # 输出时间太短时速度不准，不计入
+                if completion_tokens and seconds - ttft > 0.5:
+                    self.state.push_sample(conn, f'router:rate:{route}', completion_tokens / (seconds - ttft),
+                                           RECENT_CALLS)
+
+    def stats(self, route: str) -> dict:
+        ttft = self.state.samples(f'router:ttft:{route}')
+        rate = self.state.samples(f'router:rate:{route}')
+        ok = self.state.samples(f'router:ok:{route}')
+        return {
+            'ttft': statistics.median(ttft) if ttft else None,
+            'tokens_per_second': statistics.median(rate) if rate else None,
+            'success_rate': sum(ok) / len(ok) if ok else None,
+            'calls': len(ok)
+        }
+
+    def expected_seconds(self, stats: dict, output_tokens: int) -> float:
+        ttft = stats['ttft'] if stats['ttft'] is not None else DEFAULT_TTFT
+        rate = stats['tokens_per_second'] or DEFAULT_TOKENS_PER_SECOND
+        return ttft + output_tokens / rate
+
+    def choose(self, route: str, prompt: str, task: str = None, auto: bool = False, live: bool = True) -> dict:
+        """
+        返回 {route, requested, reason, profile, prompt_tokens}；reason 为 requested（保持原路由）、
+        context（原路由放不下）、fast / economy（按任务偏好）或 no_fit（都放不下，保持原路由由上限检查拒绝）。
+        live 为 False 时不使用实时统计，只按上下文窗口与价格选择，同样的提示词与配置总是得到同样的结果
+        """
+        requested = route
+        decision = {'route': route, 'requested': route, 'reason': 'requested', 'profile': None}
+        if route not in route_models:
+            return decision
+
+        tokens = {r: estimate_route_tokens(prompt, r) for r in route_models}
+        windows = {r: context_window(route_models[r]) for r in route_models}
+        fitting = [r for r in route_models if tokens[r] + OUTPUT_RESERVE <= windows[r]]
+        profile = TASK_PROFILES.get(task)
+        if profile is None and auto:
+            profile = 'fast' if tokens[requested] <= SHORT_PROMPT_TOKENS else 'quality'
+        decision['profile'] = profile
+        decision['prompt_tokens'] = tokens[requested]
+
+        if not fitting:
+            decision['reason'] = 'no_fit'
+        elif profile in (None, 'quality'):
+            if requested not in fitting:
+                # 同样大小的窗口优先保持原路由
+                chosen = max(fitting, key=lambda r: (windows[r], r == requested))
+                decision.update(route=chosen, reason='context', prompt_tokens=tokens[chosen])
+        else:
+            stats = {r: self.stats(r) if live else NO_STATS for r in fitting}
+            healthy = [r for r in fitting
+                       if stats[r]['success_rate'] is None or stats[r]['success_rate'] >= MIN_SUCCESS_RATE] or fitting
+            output_tokens = EXPECTED_OUTPUT_TOKENS[profile]
+
+            def key(r):
+                seconds = round(self.expected_seconds(stats[r], output_tokens), 1)
+                cost = compute_cost(route_models[r], tokens[r], output_tokens)
+                # 相同时优先保持原路由
+                return (seconds, cost, r != requested) if profile == 'fast' else (cost, seconds, r != requested)
+
+            chosen = min(healthy, key=key)
+            decision.update(route=chosen, reason='requested' if chosen == requested else profile,
+                            prompt_tokens=tokens[chosen])
+        return decision
+
+    def to_dict(self) -> dict:
+        routes = []
+        for route, model in route_models.items():
+            input_price, output_price = price_for(model)
+            routes.append({
+                'route': route,
+                'model': model,
+                'context_window': context_window(model),
+                'input_price': input_price,
+                'output_price': output_price,
+                **self.stats(route)
+            })
+        return {'routes': routes, 'tasks': TASK_PROFILES}
+
+
+model_router = ModelRouter()
+
+
+def resolve_routed_prompt(data: dict, route: str, limit: int = None) -> tuple:
+    """
+    生成接口的提示词与实际使用的路由：渲染提示词后交由路由策略选择，再按选中的路由检查输入上限。
+    异常与 resolve_prompt 相同
+    """
+    prompt = resolve_prompt(data)
+    decision = model_router.choose(route, prompt, data.get('task'), data.get('route') == AUTO_ROUTE)
+    check_prompt_size(prompt, decision['route'], limit)
+    g.route_decision = decision
+    trace = g.get('trace')
+    if trace is not None and decision['route'] != route:
+        trace.attrs.update(routed_to=decision['route'], route_reason=decision['reason'])
+    if decision['route'] != route:
+        logger.info(f"Routed {route} request to {decision['route']} ({decision['reason']}, "
+                    f"~{decision['prompt_tokens']} prompt tokens)")
+    return prompt, decision['route']
+
+
+def add_route_header(response):
+    decision = g.get('route_decision')
+    if decision:
+        response.headers['X-Route'] = decision['route']
+        response.headers['X-Route-Reason'] = decision['reason']
+    return response
+
+
+@router_bp.route('/router', methods=['GET'])
+def router_stats():
+    """
+    各路由的模型、上下文窗口、价格与近期的首字延迟、输出速度、成功率，以及任务类型的偏好
+    """
+    return json_response(model_router.to_dict())
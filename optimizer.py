@@ -0,0 +1,366 @@
+"""
+AI 迭代优化的服务端模式：每轮并发生成多个候选，择优保留
+
+每轮同时请求 K 个候选，按模型自评的【**评分**】或单独的低成本打分调用选出最优，
+达到目标分数即停止，未达标则把当轮最优结果反馈给下一轮。
+"""
+import json
+import logging
+import re
+import threading
+from contextlib import closing
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from functools import partial
+
+from flask import Blueprint, Response, current_app, request
+
+from common import complete_text, int_field, json_response
+from token_estimator import route_models
+from usage_ledger import request_tags
+
+logger = logging.getLogger(__name__)
+
+optimizer_bp = Blueprint('optimizer', __name__)
+
+DEFAULT_CANDIDATES = 3
+MAX_CANDIDATES = 6
+DEFAULT_TARGET_SCORE = 80
+DEFAULT_MAX_ROUNDS = 3
+MAX_ROUNDS = 5
+SCORE_LEVELS = [90, 80, 70, 60]
+
+FEEDBACK_PROMPT = """${prompt}
+
+上次优化结果：
+评分：${score}
+内容：${content}
+
+请特别注意改进：
+${focus}"""
+
+JUDGE_PROMPT = """请对以下小说内容进行0-100分的综合评分，评分依据：语言流畅自然、无机械性AI语句和冗余修辞、与上下文衔接连贯。
+只输出一个整数分数，不要输出其他内容。
+
+${content}"""
+
+MARKER_START = '【**'
+MARKER_END = '**】'
+MAX_MARKER_LENGTH = 12
+SECTIONS = {
+    '评分': 'score',
+    '评分说明': 'reason',
+    '优化开始': 'content',
+    '优化结束': None,
+    '优化说明': 'changes'
+}
+
+
+class OptimizationStreamParser:
+    """
+    按 token 增量解析【**评分**】/【**评分说明**】/【**优化开始**】…【**优化结束**】/【**优化说明**】格式，
+    feed() 返回本次新产生的事件：score、delta、section_end
+    """
+
+    def __init__(self):
+        self.buffer = ''
+        self.section = None
+        self.sections = {}
+        self.seen = set()
+        self.content_finished = False
+
+    def feed(self, chunk: str) -> list:
+        self.buffer += chunk
+        events = []
+        while True:
+            start = self.buffer.find(MARKER_START)
+            if start == -1:
+                # 末尾可能是被截断的标记开头，先保留
+                keep = 0
+                for size in range(len(MARKER_START) - 1, 0, -1):
+                    if self.buffer.endswith(MARKER_START[:size]):
+                        keep = size
+                        break
+                self._append(self.buffer[:len(self.buffer) - keep], events)
+                self.buffer = self.buffer[len(self.buffer) - keep:]
+                return events
+
+            end = self.buffer.find(MARKER_END, start + len(MARKER_START))
+            if end == -1:
+                if len(self.buffer) - start > MAX_MARKER_LENGTH + len(MARKER_START):
+                    # 不是标记，按普通文本处理
+                    self._append(self.buffer[:start + 1], events)
+                    self.buffer = self.buffer[start + 1:]
+                    continue
+                self._append(self.buffer[:start], events)
+                self.buffer = self.buffer[start:]
+                return events
+
+            name = self.buffer[start + len(MARKER_START):end]
+            if len(name) > MAX_MARKER_LENGTH or name not in SECTIONS:
+                # 只跳过这个【，其后的文本中可能还有真正的标记
+                self._append(self.buffer[:start + 1], events)
+                self.buffer = self.buffer[start + 1:]
+                continue
+
+            self._append(self.buffer[:start], events)
+            self.buffer = self.buffer[end + len(MARKER_END):]
+            self._close_section(events)
+            if name == '优化结束':
+                self.content_finished = 'content' in self.seen
+            self.section = SECTIONS[name]
+            if self.section:
+                self.seen.add(self.section)
+                self.sections[self.section] = ''
+
+    def finish(self) -> list:
+        events = []
+        self._append(self.buffer, events)
+        self.buffer = ''
+        self._close_section(events)
+        return events
+
+    def _append(self, text: str, events: list):
+        if not text or not self.section:
+            return
+        self.sections[self.section] += text
+        if self.section != 'score':
+            events.append({'event': 'delta', 'section': self.section, 'text': text})
+
+    def _close_section(self, events: list):
+        if not self.section:
+            return
+        text = self.sections[self.section].strip()
+        if self.section == 'score':
+            match = re.match(r'\d+', text)
+            if match:
+                events.append({'event': 'score', 'value': int(match.group())})
+        events.append({'event': 'section_end', 'section': self.section, 'text': text})
+        self.section = None
+
+    def result(self) -> dict:
+        """
+        汇总解析结果；缺少评分或内容时抛出 ValueError，
+        内容缺少结束标记时仍返回已生成部分并标记 complete=False
+        """
+        match = re.match(r'\d+', self.sections.get('score', '').strip())
+        if not match or 'content' not in self.sections:
+            raise ValueError('响应格式不完整，缺少必要的评分或内容字段')
+        score = int(match.group())
+        if not 0 <= score <= 100:
+            raise ValueError('无效的评分值')
+        return {
+            'score': score,
+            'content': self.sections['content'].strip(),
+            'reason': self.sections.get('reason', '').strip() or '无评分说明',
+            'changes': self.sections.get('changes', '').strip() or '无修改说明',
+            'complete': self.content_finished
+        }
+
+
+def parse_stream(stream, stop_after_content: bool = False, on_event=None, should_stop=None) -> dict:
+    """
+    边接收边解析；stop_after_content 时在【**优化结束**】后立即关闭上游流，省去优化说明的输出；
+    should_stop() 为真时关闭上游流并抛出 InterruptedError
+    """
+    parser = OptimizationStreamParser()
+    try:
+        for chunk in stream:
+            for event in parser.feed(chunk):
+                if on_event:
+                    on_event(event)
+            if stop_after_content and parser.content_finished:
+                break
+            if should_stop and should_stop():
+                raise InterruptedError('任务已取消')
+    finally:
+        close = getattr(stream, 'close', None)
+        if close:
+            close()
+    for event in parser.finish():
+        if on_event:
+            on_event(event)
+    return parser.result()
+
+
+def score_level(score: int) -> int:
+    return next((level for level in SCORE_LEVELS if score >= level), SCORE_LEVELS[-1])
+
+
+def judge_score(stream_completion, route: str, content: str) -> int:
+    reply = complete_text(stream_completion, route, JUDGE_PROMPT.replace('${content}', content))
+    match = re.search(r'\d+', reply)
+    if not match:
+        raise ValueError(f'打分结果无法解析: {reply[:50]}')
+    return max(0, min(100, int(match.group())))
+
+
+def generate_candidate(stream_completion, options: dict, prompt: str, should_stop=None) -> dict:
+    result = parse_stream(stream_completion(options['route'], prompt), options['skip_explanation'],
+                          should_stop=should_stop)
+    if options['scoring'] == 'judge':
+        result['self_score'] = result['score']
+        result['score'] = judge_score(stream_completion, options['judge_route'], result['content'])
+    return result
+
+
+def optimize_rounds(stream_completion, options: dict):
+    """
+    逐轮产出事件字典：candidate / error / round / result；
+    本生成器被关闭时，正在生成的候选会关闭各自的上游流
+    """
+    best = None
+    prompt = options['prompt']
+    cancel_event = threading.Event()
+    pool = ThreadPoolExecutor(max_workers=options['candidates'])
+    try:
+        for round_no in range(1, options['max_rounds'] + 1):
+            round_done = threading.Event()
+
+            def should_stop():
+                return cancel_event.is_set() or round_done.is_set()
+
+            futures = {
+                pool.submit(generate_candidate, stream_completion, options, prompt, should_stop): i
+                for i in range(options['candidates'])
+            }
+            round_best = None
+            for future in as_completed(futures):
+                index = futures[future]
+                try:
+                    candidate = future.result()
+                except Exception as e:
+                    logger.warning(f"Candidate {index} in round {round_no} failed: {e}")
+                    yield {'event': 'error', 'round': round_no, 'candidate': index, 'error': str(e)}
+                    continue
+                candidate.update(round=round_no, candidate=index)
+                yield {'event': 'candidate', **candidate}
+                if round_best is None or candidate['score'] > round_best['score']:
+                    round_best = candidate
+                # 已有候选达到目标分数时不再等待同轮其余候选
+                if round_best['score'] >= options['target_score']:
+                    break
+            # 同轮仍在生成的候选随之关闭上游流
+            round_done.set()
+
+            if round_best is None:
+                yield {'event': 'round', 'round': round_no, 'best_score': None}
+                continue
+            if best is None or round_best['score'] > best['score']:
+                best = round_best
+            yield {'event': 'round', 'round': round_no, 'best_score': round_best['score']}
+
+            if best['score'] >= options['target_score']:
+                break
+            focus = options['feedback'].get(str(score_level(best['score'])), '')
+            prompt = (FEEDBACK_PROMPT
+                      .replace('${prompt}', options['prompt'])
+                      .replace('${score}', str(best['score']))
+                      .replace('${content}', best['content'])
+                      .replace('${focus}', focus))
+    finally:
+        cancel_event.set()
+        pool.shutdown(wait=False, cancel_futures=True)
+
+    if best is None:
+        yield {'event': 'result', 'error': '所有候选均生成失败'}
+    else:
+        yield {'event': 'result', **best, 'reached_target': best['score'] >= options['target_score']}
+
+
+@optimizer_bp.route('/optimize/segment', methods=['POST'])
+def optimize_segment():
+    """
+    请求: {prompt, candidates?, target_score?, max_rounds?, route?, scoring?: 'self' | 'judge',
+          judge_route?, feedback?: {"90": 改进重点, "80": ...}, skip_explanation?}
+    以 NDJSON 逐行返回事件，最后一行为 result
+    """
+    data = request.json or {}
+    if not data.get('prompt'):
+        return json_response({'error': '缺少提示词'}, 400)
+    scoring = data.get('scoring', 'self')
+    if scoring not in ('self', 'judge'):
+        return json_response({'error': f'不支持的评分方式: {scoring}'}, 400)
+    route = data.get('route', 'gen2')
+    judge_route = data.get('judge_route', 'gen2')
+    for value in (route, judge_route):
+        if not isinstance(value, str) or value not in route_models:
+            return json_response({'error': f'不支持的路由: {value}'}, 400)
+    feedback = data.get('feedback') or {}
+    if not isinstance(feedback, dict):
+        return json_response({'error': 'feedback 应为对象'}, 400)
+    try:
+        candidates = int_field(data, 'candidates', DEFAULT_CANDIDATES, 1, MAX_CANDIDATES)
+        target_score = int_field(data, 'target_score', DEFAULT_TARGET_SCORE, 0, 100)
+        max_rounds = int_field(data, 'max_rounds', DEFAULT_MAX_ROUNDS, 1, MAX_ROUNDS)
+    except ValueError as e:
+        return json_response({'error': str(e)}, 400)
+
+    options = {
+        'prompt': data['prompt'],
+        'candidates': candidates,
+        'target_score': target_score,
+        'max_rounds': max_rounds,
+        'route': route,
+        'scoring': scoring,
+        'judge_route': judge_route,
+        'feedback': {str(k): v for k, v in feedback.items()},
+        'skip_explanation': bool(data.get('skip_explanation'))
+    }
+    stream_completion = partial(current_app.extensions['stream_completion'], tags=request_tags(data, 'optimizer'))
+
+    def generate_events():
+        try:
+            # 关闭 optimize_rounds 会通知所有进行中的候选停止生成
+            with closing(optimize_rounds(stream_completion, options)) as events:
+                for event in events:
+                    yield json.dumps(event, ensure_ascii=False) + '\n'
+        except GeneratorExit:
+            logger.info("Client disconnected from /optimize/segment, cancelling candidates")
+            raise
+
+    return Response(generate_events(), mimetype='application/x-ndjson')
+
+
+@optimizer_bp.route('/optimize/stream', methods=['POST'])
+def optimize_stream():
+    """
+    请求: {prompt, route?, stop_after_content?}
+    以 NDJSON 返回结构化事件：score / delta / section_end，最后一行为 result 或 error
+    """
+    data = request.json or {}
+    if not data.get('prompt'):
+        return json_response({'error': '缺少提示词'}, 400)
+    route = data.get('route', 'gen2')
+    if not isinstance(route, str) or route not in route_models:
+        return json_response({'error': f'不支持的路由: {route}'}, 400)
+    stop_after_content = bool(data.get('stop_after_content'))
+    stream_completion = partial(current_app.extensions['stream_completion'], tags=request_tags(data, 'optimizer'))
+
+    def generate_events():
+        parser = OptimizationStreamParser()
+        # 单段优化由用户在编辑器中触发，走交互车道
+        stream = stream_completion(route, data['prompt'], lane='interactive')
+        try:
+            for chunk in stream:
+                for event in parser.feed(chunk):
+                    yield json.dumps(event, ensure_ascii=False) + '\n'
+                if stop_after_content and parser.content_finished:
+                    logger.debug("Optimization content finished, closing upstream stream")
+                    break
+        except Exception as e:
+            logger.error(f"Error in optimize_stream: {e}")
+            yield json.dumps({'event': 'error', 'error': str(e)}, ensure_ascii=False) + '\n'
+            return
+        finally:
+            # 正常结束、提前截断或客户端断开时都关闭上游流
+            stream.close()
+
+        for event in parser.finish():
+            yield json.dumps(event, ensure_ascii=False) + '\n'
+        try:
+            yield json.dumps({'event': 'result', **parser.result()}, ensure_ascii=False) + '\n'
+        except ValueError as e:
+            yield json.dumps({'event': 'error', 'error': str(e), 'sections': parser.sections},
+                             ensure_ascii=False) + '\n'
+
+    return Response(generate_events(), mimetype='application/x-ndjson')
@@ -0,0 +1,378 @@
+"""
+批量生成正文：由大纲与章节细纲并发生成各章正文
+
+默认（continuity=outline）每章以上一章的细纲作为前情，各章互不等待、全部并行；
+continuity=body 时由低成本模型把上一章生成的正文概括为前情提要，衔接更紧密但按顺序推进。
+运行状态在每个任务完成后写入检查点，中断后可从检查点继续。
+"""
+import logging
+import os
+import threading
+import time
+import uuid
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from functools import partial
+
+from flask import Blueprint, current_app, request
+
+from common import DATA_DIR, BackgroundRun, RunRegistry, complete_text, int_field, json_response
+from shared_state import shared_state
+from token_estimator import route_models
+
+logger = logging.getLogger(__name__)
+
+pipeline_bp = Blueprint('pipeline', __name__)
+
+PIPELINE_DIR = os.path.join(DATA_DIR, 'pipeline')
+DEFAULT_CONCURRENCY = 3
+MAX_CONCURRENCY = 8
+CANCEL_POLL_INTERVAL = 1.0  # 检查其他 worker 进程发出的取消请求的间隔（秒）
+
+SUMMARY_PROMPT = """请用不超过150字概括以下章节的主要情节、人物状态和结尾悬念，作为下一章的前情提要，只输出提要本身：
+
+${text}"""
+
+DEFAULT_BODY_PROMPT = """作为专业网文作家，请根据以下信息创作本章正文：
+
+小说大纲：
+${outline}
+
+背景设定：
+${background}
+
+人物设定：
+${characters}
+
+写作风格：
+${style}
+
+上一章（细纲或前情提要）：
+${previous_summary}
+
+本章细纲：
+${chapter_outline}
+
+要求：紧扣本章细纲，与前情自然衔接，直接输出正文。"""
+
+
+def fill_template(template: str, variables: dict) -> str:
+    for key, value in variables.items():
+        template = template.replace('${' + key + '}', value or '')
+    return template
+
+
+class PipelineRun(BackgroundRun):
+    """
+    任务为 ('body', i)，continuity=body 时还有 ('summary', i)：提要来自第 i 章已生成的正文，
+    第 i+1 章正文等待该提要。continuity=outline 时直接以上一章细纲作为前情，不调用模型。
+    spec['numbers'] 为各章在全书中的章号，只提交部分章节时，章号不相邻的章节不互相依赖；
+    spec['previous'] 为请求中给出的上一章内容，优先于以上两种前情
+    """
+
+    root = PIPELINE_DIR
+
+    def __init__(self, run_id: str, spec: dict, state: dict = None):
+        super().__init__(run_id, spec, state or {
+            'status': 'pending',
+            'created': time.time(),
+            'updated': time.time(),
+            'chapters': [
+                {'index': i, 'status': 'pending', 'summary': '', 'content': '', 'chars': 0, 'error': ''}
+                for i in range(len(spec['chapters']))
+            ]
+        })
+        self.cancel_event = threading.Event()
+        self.cancel_checked = 0
+
+    @classmethod
+    def load(cls, run_id: str):
+        run = super().load(run_id)
+        if run is None:
+            return None
+        for chapter in run.state['chapters']:
+            if chapter['status'] == 'generating':
+                chapter['status'] = 'pending'
+        return run
+
+    def number(self, i: int) -> int:
+        numbers = self.spec.get('numbers')
+        return numbers[i] if numbers else i + 1
+
+    def follows(self, i: int) -> bool:
+        """
+        第 i 章是否紧接在本次提交的上一章之后，且请求没有给出它的前情
+        """
+        previous = self.spec.get('previous')
+        return i > 0 and not (previous and previous[i]) and self.number(i) == self.number(i - 1) + 1
+
+    def dependencies(self, task: tuple) -> list:
+        kind, i = task
+        if kind == 'body':
+            if self.spec['continuity'] == 'body' and self.follows(i):
+                return [('summary', i - 1)]
+            return []
+        return [('body', i)]
+
+    def tasks(self) -> list:
+        n = len(self.spec['chapters'])
+        # 只有下一章要用到的提要才需要生成
+        summaries = [('summary', i) for i in range(n - 1)
+                     if self.spec['continuity'] == 'body' and self.follows(i + 1)]
+        return summaries + [('body', i) for i in range(n)]
+
+    def previous_context(self, i: int) -> str:
+        previous = self.spec.get('previous')
+        if previous and previous[i]:
+            return previous[i]
+        if self.follows(i):
+            if self.spec['continuity'] == 'body':
+                return self.state['chapters'][i - 1]['summary']
+            return self.spec['chapters'][i - 1]
+        return '（本章为第一章）' if self.number(i) == 1 else ''
+
+    def is_done(self, task: tuple) -> bool:
+        kind, i = task
+        chapter = self.state['chapters'][i]
+        if kind == 'summary':
+            return bool(chapter['summary'])
+        return chapter['status'] == 'done'
+
+    @property
+    def cancel_key(self) -> str:
+        return f'pipeline:cancel:{self.run_id}'
+
+    def running_elsewhere(self) -> bool:
+        return self.state['status'] == 'running' and not (self.thread and self.thread.is_alive())
+
+    def request_cancel(self):
+        if self.thread and self.thread.is_alive():
+            self.cancel_event.set()
+        else:
+            # 由运行该任务的 worker 进程在 should_stop 中读取
+            shared_state.put_value(self.cancel_key, True)
+
+    def should_stop(self) -> bool:
+        if not self.cancel_event.is_set() and time.time() - self.cancel_checked > CANCEL_POLL_INTERVAL:
+            self.cancel_checked = time.time()
+            if shared_state.get_value(self.cancel_key):
+                self.cancel_event.set()
+        return self.cancel_event.is_set()
+
+    def start(self, stream_completion):
+        if self.thread and self.thread.is_alive():
+            return False
+        self.cancel_event.clear()
+        shared_state.put_value(self.cancel_key, False)
+        # 用量账本中以任务 ID 作为请求 ID，汇总整次批量生成的消耗
+        stream_completion = partial(stream_completion, tags={'feature': 'pipeline', 'request_id': self.run_id})
+        self.thread = threading.Thread(target=self.run, args=(stream_completion,), daemon=True)
+        self.thread.start()
+        return True
+
+    def run(self, stream_completion):
+        self.state['status'] = 'running'
+        self.state['pid'] = os.getpid()
+        self.checkpoint()
+        failed = set()
+        submitted = set()
+        futures = {}
+        concurrency = self.spec['concurrency']
+
+        with ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix=f'pipeline-{self.run_id}') as pool:
+            while not self.cancel_event.is_set():
+                for task in self.tasks():
+                    if task in submitted or self.is_done(task):
+                        continue
+                    deps = self.dependencies(task)
+                    if any(dep in failed for dep in deps):
+                        failed.add(task)
+                        submitted.add(task)
+                        self._set_chapter(task[1], status='error', error='依赖的前序任务失败')
+                        continue
+                    if all(self.is_done(dep) for dep in deps):
+                        submitted.add(task)
+                        futures[pool.submit(self._run_task, stream_completion, task)] = task
+
+                if not futures:
+                    break
+                done, _ = wait(futures, return_when=FIRST_COMPLETED)
+                for future in done:
+                    task = futures.pop(future)
+                    error = future.exception()
+                    if error is not None and not self.cancel_event.is_set():
+                        logger.error(f"Pipeline {self.run_id} task {task} failed: {error}")
+                        failed.add(task)
+                        if task[0] == 'body':
+                            self._set_chapter(task[1], status='error', error=str(error))
+                self.checkpoint()
+
+            if self.cancel_event.is_set():
+                wait(futures)
+
+        chapters = self.state['chapters']
+        if self.cancel_event.is_set():
+            self.state['status'] = 'cancelled'
+        elif all(c['status'] == 'done' for c in chapters):
+            self.state['status'] = 'done'
+        else:
+            self.state['status'] = 'error'
+        for chapter in chapters:
+            if chapter['status'] == 'generating':
+                chapter['status'] = 'pending'
+        self.final_checkpoint()
+        logger.info(f"Pipeline {self.run_id} finished with status {self.state['status']}")
+
+    def _set_chapter(self, index: int, **fields):
+        with self.lock:
+            self.state['chapters'][index].update(fields)
+
+    def _run_task(self, stream_completion, task: tuple):
+        kind, i = task
+        spec = self.spec
+        chapter = self.state['chapters'][i]
+        if kind == 'summary':
+            summary = complete_text(
+                stream_completion, spec['summary_route'],
+                fill_template(SUMMARY_PROMPT, {'text': chapter['content']}),
+                should_stop=self.should_stop
+            )
+            self._set_chapter(i, summary=summary.strip())
+            return
+
+        previous_summary = self.previous_context(i)
+        template = spec['template']
+        if previous_summary and '${previous_summary}' not in template:
+            template += '\n\n上一章（细纲或前情提要）：\n${previous_summary}'
+        prompt = fill_template(template, {
+            **spec['variables'],
+            'outline': spec['outline'],
+            'chapter_outline': spec['chapters'][i],
+            'previous_summary': previous_summary or '（未提供）'
+        })
+
+        self._set_chapter(i, status='generating', chars=0, error='')
+
+        def on_chunk(content):
+            with self.lock:
+                chapter['chars'] += len(content)
+
+        content = complete_text(stream_completion, spec['body_route'], prompt,
+                                on_chunk=on_chunk, should_stop=self.should_stop)
+        self._set_chapter(i, status='done', content=content, chars=len(content))
+
+    def to_dict(self, include_content: bool = False) -> dict:
+        with self.lock:
+            chapters = []
+            for chapter in self.state['chapters']:
+                item = {k: v for k, v in chapter.items() if include_content or k != 'content'}
+                chapters.append(item)
+            done = sum(c['status'] == 'done' for c in chapters)
+            return {
+                'run_id': self.run_id,
+                'status': self.state['status'],
+                'created': self.state['created'],
+                'updated': self.state['updated'],
+                'progress': {'done': done, 'total': len(chapters)},
+                'chapters': chapters
+            }
+
+
+runs = RunRegistry(PipelineRun)
+get_run = runs.get
+
+
+@pipeline_bp.route('/pipeline/runs', methods=['POST'])
+def create_run():
+    """
+    请求: {outline, chapters: [细纲 | {outline, number?, previous?}...], template?, variables?, concurrency?,
+          body_route?, summary_route?, continuity?: 'outline' | 'body'}
+    number 为该章在全书中的章号（默认按提交顺序从 1 开始），previous 为未随本次提交的上一章的细纲或提要
+    """
+    data = request.json or {}
+    items = data.get('chapters')
+    if not isinstance(items, list):
+        return json_response({'error': '缺少章节细纲'}, 400)
+    chapters, numbers, previous = [], [], []
+    for item in items:
+        if isinstance(item, str):
+            item = {'outline': item}
+        if not isinstance(item, dict) or not isinstance(item.get('outline'), str) or not item['outline'].strip():
+            continue
+        try:
+            number = int_field(item, 'number', (numbers[-1] if numbers else 0) + 1, 1, 100000)
+        except ValueError as e:
+            return json_response({'error': str(e)}, 400)
+        chapters.append(item['outline'])
+        numbers.append(number)
+        previous.append(item['previous'] if isinstance(item.get('previous'), str) else '')
+    if not chapters:
+        return json_response({'error': '缺少章节细纲'}, 400)
+    continuity = data.get('continuity', 'outline')
+    if continuity not in ('outline', 'body'):
+        return json_response({'error': f'不支持的 continuity: {continuity}'}, 400)
+    try:
+        concurrency = int_field(data, 'concurrency', DEFAULT_CONCURRENCY, 1, MAX_CONCURRENCY)
+    except ValueError as e:
+        return json_response({'error': str(e)}, 400)
+    body_route, summary_route = data.get('body_route', 'gen'), data.get('summary_route', 'gen2')
+    for route in (body_route, summary_route):
+        if not isinstance(route, str) or route not in route_models:
+            return json_response({'error': f'不支持的路由: {route}'}, 400)
+
+    spec = {
+        'outline': data.get('outline', ''),
+        'chapters': chapters,
+        'numbers': numbers,
+        'previous': previous,
+        'template': data.get('template') or DEFAULT_BODY_PROMPT,
+        'variables': {k: v for k, v in (data.get('variables') or {}).items() if isinstance(v, str)},
+        'concurrency': concurrency,
+        'body_route': body_route,
+        'summary_route': summary_route,
+        'continuity': continuity
+    }
+    run = PipelineRun(uuid.uuid4().hex[:16], spec)
+    runs.add(run)
+    run.checkpoint()
+    run.start(current_app.extensions['stream_completion'])
+    return json_response(run.to_dict(), 202)
+
+
+@pipeline_bp.route('/pipeline/runs/<run_id>', methods=['GET'])
+def get_run_status(run_id):
+    run = get_run(run_id)
+    if run is None:
+        return json_response({'error': '任务不存在'}, 404)
+    return json_response(run.to_dict(include_content=request.args.get('content') == '1'))
+
+
+@pipeline_bp.route('/pipeline/runs/<run_id>/chapters/<int:index>', methods=['GET'])
+def get_run_chapter(run_id, index):
+    run = get_run(run_id)
+    if run is None or not 0 <= index < len(run.state['chapters']):
+        return json_response({'error': '章节不存在'}, 404)
+    return json_response(run.state['chapters'][index])
+
+
+@pipeline_bp.route('/pipeline/runs/<run_id>/resume', methods=['POST'])
+def resume_run(run_id):
+    run = get_run(run_id)
+    if run is None:
+        return json_response({'error': '任务不存在'}, 404)
+    if run.running_elsewhere():
+        return json_response({'error': '任务正在运行'}, 409)
+    for chapter in run.state['chapters']:
+        if chapter['status'] == 'error':
+            chapter.update(status='pending', error='')
+    if not run.start(current_app.extensions['stream_completion']):
+        return json_response({'error': '任务正在运行'}, 409)
+    return json_response(run.to_dict(), 202)
+
+
+@pipeline_bp.route('/pipeline/runs/<run_id>/cancel', methods=['POST'])
+def cancel_run(run_id):
+    run = get_run(run_id)
+    if run is None:
+        return json_response({'error': '任务不存在'}, 404)
+    run.request_cancel()
+    return json_response({'run_id': run_id, 'status': 'cancelling'})
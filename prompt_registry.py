@@ -0,0 +1,343 @@
+"""
+服务端提示词模板：带版本的预编译模板与按项目保存的设定变量
+
+模板与项目变量（背景、人物、大纲等）只在变化时上传一次，
+生成请求只需携带 template_id 和本次调用特有的变量，由服务端渲染出完整提示词。
+"""
+import json
+import logging
+import os
+import re
+import threading
+import time
+from collections import OrderedDict
+
+from flask import Blueprint, request
+
+from common import DATA_DIR, ensure_dir, json_response
+from shared_state import file_lock
+from token_estimator import MAX_TOKENS_PER_CHAR, OUTPUT_RESERVE, context_window, estimate_route_tokens, route_models
+
+logger = logging.getLogger(__name__)
+
+prompts_bp = Blueprint('prompts', __name__)
+
+PROMPTS_DIR = os.path.join(DATA_DIR, 'prompts')
+PLACEHOLDER_PATTERN = re.compile(r'\$\{(\w+)\}')
+ID_PATTERN = re.compile(r'^[\w\-]{1,64}$')
+PREFIX_CACHE_SIZE = 256
+# 各路由允许的最大提示词 token 数（按路由对应模型的分词估算），超出时直接拒绝，不再请求上游；
+# 路由登记了模型时还不能超过该模型的上下文窗口减去输出预留，见 prompt_limit
+MAX_PROMPT_TOKENS = {'gen': 180000, 'gen2': 120000}
+
+
+class PromptTooLarge(ValueError):
+    pass
+
+
+def file_mtime(path: str):
+    try:
+        return os.stat(path).st_mtime_ns
+    except FileNotFoundError:
+        return None
+
+
+def write_json(path: str, data):
+    ensure_dir(os.path.dirname(path))
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(data, f, ensure_ascii=False)
+    os.replace(tmp_path, path)
+
+
+class CompiledTemplate:
+    """
+    预先把模板拆分为文本与 ${变量} 片段，渲染时只做一次拼接；
+    未提供的变量保留原样，与前端 replace 的行为一致
+    """
+
+    def __init__(self, template_id: str, version: int, text: str):
+        self.template_id = template_id
+        self.version = version
+        self.text = text
+        parts = PLACEHOLDER_PATTERN.split(text)
+        # split 结果中奇数位为变量名
+        self.segments = [(i % 2 == 1, part) for i, part in enumerate(parts) if part]
+        self.variables = sorted({name for is_var, name in self.segments if is_var})
+
+    def render_segments(self, segments, variables: dict) -> str:
+        return ''.join(
+            (variables[value] if value in variables else '${' + value + '}') if is_var else value
+            for is_var, value in segments
+        )
+
+    def split_static(self, dynamic: set) -> int:
+        """
+        返回第一个依赖本次调用变量的片段下标，此前的部分只依赖项目变量，可以缓存
+        """
+        for i, (is_var, value) in enumerate(self.segments):
+            if is_var and value in dynamic:
+                return i
+        return len(self.segments)
+
+
+class PromptRegistry:
+    """
+    模板与项目变量缓存在内存中，读取时按文件修改时间校验，
+    多个 worker 进程中任一进程的修改对其他进程立即可见
+    """
+
+    def __init__(self, root: str):
+        self.root = root
+        self.lock = threading.Lock()
+        self.templates = {}  # id -> [CompiledTemplate, ...]，按版本排列
+        self.projects = {}   # id -> (文件修改时间, 项目)
+        self.prefix_cache = OrderedDict()
+        self.prefix_hits = 0
+        self.templates_mtime = None
+
+    @property
+    def templates_path(self) -> str:
+        return os.path.join(self.root, 'templates.json')
+
+    def project_path(self, project_id: str) -> str:
+        """
+        project_id 可能来自生成请求的请求体，不合法的 ID 一律视为项目不存在，不拼接到路径中
+        """
+        if not isinstance(project_id, str) or not ID_PATTERN.fullmatch(project_id):
+            raise LookupError(f'项目不存在: {project_id}')
+        return os.path.join(self.root, 'projects', f'{project_id}.json')
+
+    def _ensure_loaded(self):
+        mtime = file_mtime(self.templates_path)
+        if mtime is None or mtime == self.templates_mtime:
+            return
+        with open(self.templates_path, encoding='utf-8') as f:
+            self.templates = {
+                template_id: [CompiledTemplate(template_id, v['version'], v['text']) for v in versions]
+                for template_id, versions in json.load(f).items()
+            }
+        self.templates_mtime = mtime
+
+    def _save_templates(self):
+        write_json(self.templates_path, {
+            template_id: [{'version': t.version, 'text': t.text} for t in versions]
+            for template_id, versions in self.templates.items()
+        })
+        self.templates_mtime = file_mtime(self.templates_path)
+
+    def put_template(self, template_id: str, text: str) -> tuple:
+        """
+        文本与最新版本相同时不创建新版本；返回 (模板, 是否新建)
+        """
+        with self.lock, file_lock(self.templates_path):
+            self._ensure_loaded()
+            versions = self.templates.setdefault(template_id, [])
+            if versions and versions[-1].text == text:
+                return versions[-1], False
+            template = CompiledTemplate(template_id, len(versions) + 1, text)
+            versions.append(template)
+            self._save_templates()
+            return template, True
+
+    def get_template(self, template_id: str, version: int = None) -> CompiledTemplate:
+        with self.lock:
+            self._ensure_loaded()
+            versions = self.templates.get(template_id)
+            if not versions:
+                raise LookupError(f'模板不存在: {template_id}')
+            if version is None:
+                return versions[-1]
+            if not 1 <= version <= len(versions):
+                raise LookupError(f'模板版本不存在: {template_id} v{version}')
+            return versions[version - 1]
+
+    def list_templates(self) -> list:
+        with self.lock:
+            self._ensure_loaded()
+            return [
+                {'id': template_id, 'version': versions[-1].version, 'variables': versions[-1].variables}
+                for template_id, versions in self.templates.items()
+            ]
+
+    def _load_project(self, project_id: str) -> dict:
+        path = self.project_path(project_id)
+        mtime = file_mtime(path)
+        if mtime is None:
+            raise LookupError(f'项目不存在: {project_id}')
+        cached = self.projects.get(project_id)
+        if cached is not None and cached[0] == mtime:
+            return cached[1]
+        with open(path, encoding='utf-8') as f:
+            project = json.load(f)
+        self.projects[project_id] = (mtime, project)
+        return project
+
+    def get_project(self, project_id: str) -> dict:
+        with self.lock:
+            return self._load_project(project_id)
+
+    def update_project(self, project_id: str, variables: dict, remove: list = ()) -> dict:
+        path = self.project_path(project_id)
+        with self.lock, file_lock(path):
+            try:
+                # 以磁盘上的最新版本为准，其他进程的修改不会被覆盖
+                project = dict(self._load_project(project_id))
+                project['variables'] = dict(project['variables'])
+            except LookupError:
+                project = {'revision': 0, 'variables': {}, 'updated': 0}
+            project['variables'].update(variables)
+            for name in remove:
+                project['variables'].pop(name, None)
+            project['revision'] += 1
+            project['updated'] = time.time()
+            write_json(path, project)
+            self.projects[project_id] = (file_mtime(path), project)
+            return project
+
+    def render(self, template_id: str, version: int = None, project_id: str = None,
+               variables: dict = None, project_revision: int = None) -> str:
+        template = self.get_template(template_id, version)
+        variables = variables or {}
+        if not project_id:
+            return template.render_segments(template.segments, variables)
+
+        project = self.get_project(project_id)
+        if project_revision is not None and project_revision != project['revision']:
+            raise ValueError('项目变量版本不一致，请重新同步')
+        split = template.split_static(set(variables))
+        key = (template_id, template.version, project_id, project['revision'], split)
+        with self.lock:
+            prefix = self.prefix_cache.get(key)
+            if prefix is not None:
+                self.prefix_cache.move_to_end(key)
+                self.prefix_hits += 1
+        if prefix is None:
+            prefix = template.render_segments(template.segments[:split], project['variables'])
+            with self.lock:
+                self.prefix_cache[key] = prefix
+                if len(self.prefix_cache) > PREFIX_CACHE_SIZE:
+                    self.prefix_cache.popitem(last=False)
+        merged = {**project['variables'], **variables}
+        return prefix + template.render_segments(template.segments[split:], merged)
+
+
+registry = PromptRegistry(PROMPTS_DIR)
+
+
+def prompt_limit(route: str = None):
+    """
+    路由可用的提示词 token 数：模型上下文窗口减去输出预留，且不超过该路由的静态上限；
+    路由未登记模型时只按静态上限，两者都没有时返回 None（不限制）
+    """
+    limit = MAX_PROMPT_TOKENS.get(route)
+    if route not in route_models:
+        return limit
+    budget = context_window(route_models[route]) - OUTPUT_RESERVE
+    return min(budget, limit) if limit else budget
+
+
+def check_prompt_size(prompt: str, route: str = None, limit: int = None):
+    limit = limit or prompt_limit(route)
+    if not limit or len(prompt) * MAX_TOKENS_PER_CHAR <= limit:
+        # 按最坏情况也不会超限时不必估算
+        return
+    tokens = estimate_route_tokens(prompt, route)
+    if tokens > limit:
+        raise PromptTooLarge(f'提示词约 {tokens} tokens（{len(prompt)} 字），超过模型输入上限 {limit} tokens，请精简设定或分段处理')
+
+
+def resolve_prompt(data: dict, route: str = None, limit: int = None) -> str:
+    """
+    生成接口的提示词：提供 template_id 时由服务端渲染，否则使用请求中的完整 prompt。
+    模板或项目不存在时抛出 LookupError，项目变量版本不一致时抛出 ValueError，
+    超过路由输入上限时抛出 PromptTooLarge
+    """
+    if not data.get('template_id'):
+        prompt = data.get('prompt', '')
+        check_prompt_size(prompt, route, limit)
+        return prompt
+    version = data.get('version')
+    revision = data.get('project_revision')
+    prompt = registry.render(
+        data['template_id'],
+        version=int(version) if version is not None else None,
+        project_id=data.get('project_id'),
+        variables={k: v for k, v in (data.get('variables') or {}).items() if isinstance(v, str)},
+        project_revision=int(revision) if revision is not None else None
+    )
+    check_prompt_size(prompt, route, limit)
+    return prompt
+
+
+def prompt_error_response(e: Exception):
+    if isinstance(e, PromptTooLarge):
+        status = 413
+    else:
+        status = 404 if isinstance(e, LookupError) else 409
+    return json_response({'error': str(e)}, status)
+
+
+@prompts_bp.route('/prompts/templates', methods=['GET'])
+def list_templates():
+    return json_response({'templates': registry.list_templates()})
+
+
+@prompts_bp.route('/prompts/templates/<template_id>', methods=['GET'])
+def get_template(template_id):
+    version = request.args.get('version', type=int)
+    try:
+        template = registry.get_template(template_id, version)
+    except LookupError as e:
+        return json_response({'error': str(e)}, 404)
+    return json_response({'id': template_id, 'version': template.version,
+                          'variables': template.variables, 'text': template.text})
+
+
+@prompts_bp.route('/prompts/templates/<template_id>', methods=['PUT'])
+def put_template(template_id):
+    """
+    请求: {text}；内容变化时创建新版本
+    """
+    if not ID_PATTERN.match(template_id):
+        return json_response({'error': '无效的模板 id'}, 400)
+    text = (request.json or {}).get('text')
+    if not isinstance(text, str) or not text:
+        return json_response({'error': '缺少模板内容'}, 400)
+    template, created = registry.put_template(template_id, text)
+    return json_response({'id': template_id, 'version': template.version,
+                          'variables': template.variables, 'created': created})
+
+
+@prompts_bp.route('/prompts/projects/<project_id>/variables', methods=['GET'])
+def get_project_variables(project_id):
+    try:
+        project = registry.get_project(project_id)
+    except LookupError as e:
+        return json_response({'error': str(e)}, 404)
+    return json_response({'project_id': project_id, **project})
+
+
+@prompts_bp.route('/prompts/projects/<project_id>/variables', methods=['PATCH'])
+def update_project_variables(project_id):
+    """
+    请求: {variables: {名称: 值}, remove?: [名称]}；只需上传变化的变量
+    """
+    if not ID_PATTERN.match(project_id):
+        return json_response({'error': '无效的项目 id'}, 400)
+    data = request.json or {}
+    variables = {k: v for k, v in (data.get('variables') or {}).items() if isinstance(v, str)}
+    project = registry.update_project(project_id, variables, data.get('remove') or [])
+    return json_response({'project_id': project_id, 'revision': project['revision']})
+
+
+@prompts_bp.route('/prompts/render', methods=['POST'])
+def render_prompt():
+    """
+    请求与生成接口相同：{template_id, version?, project_id?, project_revision?, variables?}
+    """
+    try:
+        prompt = resolve_prompt(request.json or {})
+    except (LookupError, ValueError) as e:
+        return prompt_error_response(e)
+    return json_response({'prompt': prompt})
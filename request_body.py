@@ -0,0 +1,106 @@
+"""
+压缩请求体：支持 Content-Encoding 为 gzip、deflate、zstd 的请求，
+边读边解压并限制解压后的大小，防止压缩炸弹
+"""
+import io
+import json
+import zlib
+
+from flask import current_app, request
+from werkzeug.exceptions import BadRequest, RequestEntityTooLarge, UnsupportedMediaType
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# 解压后的请求体上限，可通过 app.config['MAX_DECOMPRESSED_SIZE'] 覆盖；需容纳 50MB 的整书导入
+DEFAULT_MAX_DECOMPRESSED_SIZE = 64 * 1024 * 1024
+READ_SIZE = 64 * 1024
+
+
+class DecompressingReader(io.RawIOBase):
+    """
+    包装 wsgi.input，按需解压；超过 limit 时抛出 RequestEntityTooLarge
+    """
+
+    def __init__(self, source, encoding: str, limit: int):
+        self.source = source
+        self.limit = limit
+        self.total = 0
+        self.pending = b''
+        self.offset = 0
+        self.eof = False
+        if encoding == 'zstd':
+            self.decompressor = zstandard.ZstdDecompressor().decompressobj()
+        elif encoding == 'gzip':
+            self.decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        else:
+            # HTTP 的 deflate 即 zlib 格式
+            self.decompressor = zlib.decompressobj(zlib.MAX_WBITS)
+
+    def readable(self) -> bool:
+        return True
+
+    def _fill(self):
+        while self.offset >= len(self.pending) and not self.eof:
+            self.offset = 0
+            data = self.source.read(READ_SIZE)
+            if not data:
+                self.eof = True
+                flush = getattr(self.decompressor, 'flush', None)
+                self.pending = flush() if flush else b''
+            else:
+                try:
+                    self.pending = self.decompressor.decompress(data)
+                except Exception:
+                    raise BadRequest('请求体解压失败')
+            self.total += len(self.pending)
+            if self.total > self.limit:
+                raise RequestEntityTooLarge(f'解压后的请求体超过 {self.limit // (1024 * 1024)}MB 上限')
+
+    def readinto(self, buffer) -> int:
+        self._fill()
+        size = min(len(buffer), len(self.pending) - self.offset)
+        buffer[:size] = self.pending[self.offset:self.offset + size]
+        self.offset += size
+        return size
+
+
+def decompress_request():
+    """
+    before_request：替换 wsgi.input 为解压流，后续的 request.json / request.files 读到的都是原始内容
+    """
+    encoding = request.headers.get('Content-Encoding', '').strip().lower()
+    if not encoding or encoding == 'identity':
+        return None
+    if encoding not in ('gzip', 'deflate', 'zstd'):
+        raise UnsupportedMediaType(f'不支持的 Content-Encoding: {encoding}')
+    if encoding == 'zstd' and zstandard is None:
+        raise UnsupportedMediaType('服务端未安装 zstandard，无法解压 zstd 请求体')
+
+    limit = current_app.config.get('MAX_DECOMPRESSED_SIZE', DEFAULT_MAX_DECOMPRESSED_SIZE)
+    environ = request.environ
+    environ['wsgi.input'] = io.BufferedReader(
+        DecompressingReader(request.stream, encoding, limit), buffer_size=READ_SIZE
+    )
+    # 解压后长度未知，按流读取到结束
+    environ.pop('CONTENT_LENGTH', None)
+    environ.pop('HTTP_CONTENT_ENCODING', None)
+    environ['wsgi.input_terminated'] = True
+    for key in ('stream', 'content_length'):
+        request.__dict__.pop(key, None)
+    return None
+
+
+def read_json() -> dict:
+    """
+    读取 JSON 请求体：直接解析字节，不在 request 上缓存原始数据，避免大段章节正文多留一份副本
+    """
+    data = request.get_data(cache=False)
+    if not data:
+        return {}
+    try:
+        return json.loads(data)
+    except ValueError:
+        raise BadRequest('请求体不是有效的 JSON')
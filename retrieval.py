@@ -0,0 +1,178 @@
+"""
+生成提示词的知识注入：按相关度筛选设定与知识库条目
+
+以当前大纲/片段为查询，对小说背景、人物设定的段落和知识库条目做 BM25 打分，
+在字数预算内只保留最相关的前 k 条，避免每次都把全部设定塞进提示词。
+"""
+import logging
+import re
+
+from flask import Blueprint, request
+
+from common import json_response
+from search_index import BigramIndex, search_index, tokenize
+
+logger = logging.getLogger(__name__)
+
+retrieval_bp = Blueprint('retrieval', __name__)
+
+DEFAULT_TOP_K = 12
+DEFAULT_BUDGET = 3000  # 注入内容的总字数上限
+MAX_PASSAGE_LENGTH = 400
+NAME_BONUS = 5.0  # 知识库条目名称直接出现在查询中时的额外得分
+
+KNOWLEDGE_TITLES = {
+    'characters': '人物档案',
+    'worldSettings': '世界观',
+    'timeline': '时间线',
+    'plotLines': '剧情线索',
+    'locations': '地点空间'
+}
+
+
+def split_passages(text: str) -> list:
+    """
+    按空行切分段落，过长的段落再按行切分
+    """
+    passages = []
+    for block in re.split(r'\n\s*\n', text or ''):
+        block = block.strip()
+        if not block:
+            continue
+        if len(block) <= MAX_PASSAGE_LENGTH:
+            passages.append(block)
+            continue
+        current = ''
+        for line in block.splitlines():
+            if current and len(current) + len(line) > MAX_PASSAGE_LENGTH:
+                passages.append(current)
+                current = ''
+            current = f'{current}\n{line}' if current else line
+        if current.strip():
+            passages.append(current)
+    return passages
+
+
+def format_knowledge_item(item: dict) -> str:
+    parts = []
+    for key, value in item.items():
+        if key == 'name' or not value:
+            continue
+        parts.append(' '.join(map(str, value)) if isinstance(value, list) else str(value))
+    return f"{item.get('name', '')}：{'；'.join(parts)}"
+
+
+def knowledge_from_index() -> dict:
+    """
+    未随请求提供知识库时，使用已同步到全文索引中的条目
+    """
+    knowledge = {}
+    search_index.refresh()
+    with search_index.lock:
+        for doc_id, doc in zip(search_index.doc_ids, search_index.docs):
+            if doc_id is None or doc['type'] != 'knowledge':
+                continue
+            category = doc['meta'].get('category', '')
+            knowledge.setdefault(category, []).append({'name': doc['title'], 'description': doc['text']})
+    return knowledge
+
+
+def select_context(query: str, sections: dict, knowledge: dict = None,
+                   top_k: int = DEFAULT_TOP_K, budget: int = DEFAULT_BUDGET) -> dict:
+    """
+    sections: {'background': 文本, 'characters': 文本, ...}
+    knowledge: knowledge-base.js 的 data 结构
+    返回筛选后的各段文本，按原有顺序拼接
+    """
+    index = BigramIndex()
+    candidates = {}
+    for name, text in sections.items():
+        for i, passage in enumerate(split_passages(text)):
+            doc_id = f'{name}:{i}'
+            index.upsert(doc_id, name, '', passage, log=False)
+            candidates[doc_id] = {'section': name, 'order': i, 'text': passage}
+    for category, items in (knowledge or {}).items():
+        if not isinstance(items, list):
+            continue
+        for i, item in enumerate(items):
+            if not isinstance(item, dict) or not item.get('name'):
+                continue
+            doc_id = f'knowledge:{category}:{i}'
+            text = format_knowledge_item(item)
+            index.upsert(doc_id, 'knowledge', item['name'], text, log=False)
+            candidates[doc_id] = {'section': 'knowledge', 'category': category, 'order': i,
+                                  'name': item['name'], 'text': text}
+
+    scores = {index.doc_ids[num]: s for num, s in index.score(tokenize(query), require_all=False).items()}
+    for doc_id, candidate in candidates.items():
+        if candidate.get('name') and candidate['name'] in query:
+            scores[doc_id] = scores.get(doc_id, 0.0) + NAME_BONUS
+
+    selected = []
+    used = 0
+    for doc_id in sorted(scores, key=lambda d: -scores[d]):
+        if len(selected) >= top_k:
+            break
+        length = len(candidates[doc_id]['text'])
+        if used + length > budget:
+            continue
+        selected.append(doc_id)
+        used += length
+
+    # 某段设定完全没有命中时保留其首段，保证模型仍能看到基本设定
+    for name, text in sections.items():
+        first = f'{name}:0'
+        if first in candidates and not any(candidates[d]['section'] == name for d in selected):
+            if used + len(candidates[first]['text']) <= budget:
+                selected.append(first)
+                used += len(candidates[first]['text'])
+
+    result = {name: [] for name in sections}
+    result['knowledge'] = []
+    for doc_id in sorted(selected, key=lambda d: (candidates[d].get('category', ''), candidates[d]['order'])):
+        candidate = candidates[doc_id]
+        if candidate['section'] == 'knowledge':
+            title = KNOWLEDGE_TITLES.get(candidate['category'], candidate['category'])
+            result['knowledge'].append(f"[{title}] {candidate['text']}")
+        else:
+            result[candidate['section']].append(candidate['text'])
+
+    original = sum(len(c['text']) for c in candidates.values())
+    return {
+        'sections': {name: '\n\n'.join(parts) for name, parts in result.items()},
+        'items': [
+            {'id': doc_id, 'score': round(scores[doc_id], 4) if doc_id in scores else 0,
+             'length': len(candidates[doc_id]['text'])}
+            for doc_id in selected
+        ],
+        'original_chars': original,
+        'selected_chars': used
+    }
+
+
+@retrieval_bp.route('/knowledge/retrieve', methods=['POST'])
+def retrieve():
+    """
+    请求: {query, sections: {background, characters, ...}, knowledge?, top_k?, budget?}
+    """
+    data = request.json or {}
+    query = data.get('query', '')
+    if not query.strip():
+        return json_response({'error': '缺少查询内容'}, 400)
+    sections = {k: v for k, v in (data.get('sections') or {}).items() if isinstance(v, str)}
+    knowledge = data.get('knowledge')
+    if knowledge is None:
+        knowledge = knowledge_from_index()
+    elif not isinstance(knowledge, dict):
+        return json_response({'error': 'knowledge 应为知识库对象'}, 400)
+    try:
+        top_k = int(data.get('top_k', DEFAULT_TOP_K))
+        budget = int(data.get('budget', DEFAULT_BUDGET))
+    except (TypeError, ValueError):
+        return json_response({'error': 'top_k 与 budget 应为整数'}, 400)
+    if top_k < 1 or budget < 1:
+        return json_response({'error': 'top_k 与 budget 应为正整数'}, 400)
+
+    result = select_context(query, sections, knowledge, top_k, budget)
+    logger.debug(f"Retrieved {len(result['items'])} passages, {result['selected_chars']}/{result['original_chars']} chars")
+    return json_response(result)
@@ -0,0 +1,241 @@
+"""
+上游调用的准入与排队
+
+interactive（聊天、单次生成、右键优化）优先于 batch（拆书分析、批量优化、批量生成正文）：
+有交互请求排队时不再启动新的批量调用，并为交互请求预留并发名额，批量任务再多也不会把聊天堵住。
+超出每日/每月调用上限或 token 额度时直接拒绝；排队位置与预计等待时间通过响应头和 /queue 接口提供。
+
+调用额度按共享状态中的计数检查，多个 worker 进程合计；排队与并发名额（UPSTREAM_SLOTS、RESERVED_INTERACTIVE）
+则是每个 worker 进程各自计算的，serve.py 启动 N 个 worker 时上游的总并发最多为 N × UPSTREAM_SLOTS。
+"""
+import itertools
+import logging
+import threading
+import time
+from collections import deque
+
+from flask import Blueprint
+
+from common import json_response
+from token_stats import token_stats
+
+logger = logging.getLogger(__name__)
+
+scheduler_bp = Blueprint('scheduler', __name__)
+
+LANES = ('interactive', 'batch')
+# 每个 worker 进程同时进行的上游调用数，其中 RESERVED_INTERACTIVE 个只给交互请求使用
+UPSTREAM_SLOTS = 8
+RESERVED_INTERACTIVE = 2
+QUEUE_TIMEOUTS = {'interactive': 120, 'batch': 1800}
+# 还没有完成的调用可供估算时，假定每次调用占用的秒数
+DEFAULT_CALL_SECONDS = 30
+
+
+class QuotaExceeded(Exception):
+    pass
+
+
+class QueueTimeout(RuntimeError):
+    pass
+
+
+def check_budget():
+    """
+    调用前检查全局额度，超出时抛出 QuotaExceeded
+    """
+    counts = token_stats.snapshot()
+    if counts['today_calls'] >= token_stats.daily_limit:
+        raise QuotaExceeded(f'今日调用次数已达上限 {token_stats.daily_limit}')
+    if counts['month_calls'] >= token_stats.monthly_limit:
+        raise QuotaExceeded(f'本月调用次数已达上限 {token_stats.monthly_limit}')
+    if counts['tokens_used'] >= token_stats.total_tokens:
+        raise QuotaExceeded(f'token 额度已用完（共 {token_stats.total_tokens}）')
+
+
+class Ticket:
+    def __init__(self, scheduler, lane: str, ticket_id: int):
+        self.scheduler = scheduler
+        self.lane = lane
+        self.id = ticket_id
+        self.enqueued = time.monotonic()
+        self.started = None
+        self.state = 'queued'  # queued -> running -> done
+
+    def wait(self):
+        self.scheduler.wait(self)
+
+    def release(self):
+        self.scheduler.release(self)
+
+    def status(self) -> dict:
+        return self.scheduler.status(self)
+
+
+class Scheduler:
+    def __init__(self, slots: int = UPSTREAM_SLOTS, reserved_interactive: int = RESERVED_INTERACTIVE):
+        self.slots = slots
+        self.reserved_interactive = min(reserved_interactive, slots - 1)
+        self.cond = threading.Condition()
+        self.queues = {lane: deque() for lane in LANES}
+        self.tickets = {}
+        self.running = 0
+        self.running_by_lane = dict.fromkeys(LANES, 0)
+        self.durations = deque(maxlen=50)
+        self.ids = itertools.count(1)
+        self.admitted = dict.fromkeys(LANES, 0)
+        self.rejected = 0
+
+    def capacity(self, lane: str) -> int:
+        return self.slots if lane == 'interactive' else self.slots - self.reserved_interactive
+
+    def admit(self, lane: str = 'interactive') -> Ticket:
+        """
+        检查额度并排队；返回的 Ticket 须在调用前 wait()，结束后 release()
+        """
+        if lane not in LANES:
+            lane = 'interactive'
+        try:
+            check_budget()
+        except QuotaExceeded:
+            with self.cond:
+                self.rejected += 1
+            raise
+        with self.cond:
+            ticket = Ticket(self, lane, next(self.ids))
+            self.queues[lane].append(ticket)
+            self.tickets[ticket.id] = ticket
+            self.admitted[lane] += 1
+            return ticket
+
+    def _can_start(self, ticket: Ticket) -> bool:
+        queue = self.queues[ticket.lane]
+        if not queue or queue[0] is not ticket:
+            return False
+        if ticket.lane == 'batch' and self.queues['interactive']:
+            return False
+        if self.running >= self.slots:
+            return False
+        return ticket.lane == 'interactive' or self.running_by_lane['batch'] < self.capacity('batch')
+
+    def wait(self, ticket: Ticket):
+        timeout = QUEUE_TIMEOUTS[ticket.lane]
+        deadline = ticket.enqueued + timeout
+        with self.cond:
+            if ticket.state != 'queued':
+                return
+            while not self._can_start(ticket):
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    self._remove(ticket)
+                    self.cond.notify_all()
+                    raise QueueTimeout(f'排队超过 {timeout} 秒，请稍后重试')
+                self.cond.wait(remaining)
+            self.queues[ticket.lane].popleft()
+            ticket.state = 'running'
+            ticket.started = time.monotonic()
+            self.running += 1
+            self.running_by_lane[ticket.lane] += 1
+            # 同一车道的下一张票可能也能开始
+            self.cond.notify_all()
+        waited = ticket.started - ticket.enqueued
+        if waited > 1:
+            logger.info(f"{ticket.lane} call {ticket.id} waited {waited:.1f}s in queue")
+
+    def _remove(self, ticket: Ticket):
+        if ticket.state == 'queued':
+            self.queues[ticket.lane].remove(ticket)
+        elif ticket.state == 'running':
+            self.running -= 1
+            self.running_by_lane[ticket.lane] -= 1
+            self.durations.append(time.monotonic() - ticket.started)
+        ticket.state = 'done'
+        self.tickets.pop(ticket.id, None)
+
+    def release(self, ticket: Ticket):
+        """
+        可重复调用；排队中的票直接出队
+        """
+        with self.cond:
+            if ticket.state == 'done':
+                return
+            self._remove(ticket)
+            self.cond.notify_all()
+
+    def avg_call_seconds(self) -> float:
+        return sum(self.durations) / len(self.durations) if self.durations else DEFAULT_CALL_SECONDS
+
+    def status(self, ticket: Ticket) -> dict:
+        with self.cond:
+            # 可以立即开始的调用不算排队
+            if ticket.state != 'queued' or self._can_start(ticket):
+                return {'ticket': ticket.id, 'lane': ticket.lane, 'state': ticket.state,
+                        'position': 0, 'estimated_wait': 0}
+            position = self.queues[ticket.lane].index(ticket) + 1
+            ahead = position - 1
+            if ticket.lane == 'batch':
+                ahead += len(self.queues['interactive'])
+            capacity = self.capacity(ticket.lane)
+            busy = self.running >= self.slots or \
+                (ticket.lane == 'batch' and self.running_by_lane['batch'] >= capacity)
+            # 前面的调用按平均耗时、以车道可用的并发数分批完成
+            estimated = (ahead + 1) / capacity * self.avg_call_seconds() if ahead or busy else 0
+            return {'ticket': ticket.id, 'lane': ticket.lane, 'state': 'queued',
+                    'position': position, 'estimated_wait': round(estimated, 1)}
+
+    def get_ticket(self, ticket_id: int):
+        with self.cond:
+            return self.tickets.get(ticket_id)
+
+    def to_dict(self) -> dict:
+        with self.cond:
+            return {
+                'slots': self.slots,
+                'reserved_interactive': self.reserved_interactive,
+                'running': dict(self.running_by_lane),
+                'queued': {lane: len(queue) for lane, queue in self.queues.items()},
+                'admitted': dict(self.admitted),
+                'rejected': self.rejected,
+                'avg_call_seconds': round(self.avg_call_seconds(), 2)
+            }
+
+
+scheduler = Scheduler()
+
+
+def admit_request(data: dict) -> Ticket:
+    """
+    生成接口的准入：请求体中的 lane 为 'batch' 时进入批量车道，默认为交互车道
+    """
+    return scheduler.admit(data.get('lane') or 'interactive')
+
+
+def quota_error_response(e: QuotaExceeded):
+    return json_response({'error': str(e)}, 429)
+
+
+def with_queue_headers(response, ticket: Ticket):
+    """
+    在响应头中给出排队位置与预计等待秒数，客户端可用 X-Queue-Ticket 轮询 /queue/<ticket>；
+    响应关闭时释放排队名额（客户端在开始读取前断开也不会占住队列）
+    """
+    status = ticket.status()
+    response.headers['X-Queue-Ticket'] = str(ticket.id)
+    response.headers['X-Queue-Lane'] = ticket.lane
+    response.headers['X-Queue-Position'] = str(status['position'])
+    response.headers['X-Queue-Wait'] = str(status['estimated_wait'])
+    response.call_on_close(ticket.release)
+    return response
+
+
+@scheduler_bp.route('/queue', methods=['GET'])
+def queue_stats():
+    return json_response(scheduler.to_dict())
+
+
+@scheduler_bp.route('/queue/<int:ticket_id>', methods=['GET'])
+def ticket_status(ticket_id):
+    ticket = scheduler.get_ticket(ticket_id)
+    if ticket is None:
+        return json_response({'ticket': ticket_id, 'state': 'done', 'position': 0, 'estimated_wait': 0})
+    return json_response(ticket.status())
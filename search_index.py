@@ -0,0 +1,548 @@
+"""
+全文检索：基于汉字二元组（bigram）的倒排索引
+
+不依赖分词器，中文按相邻两字切分，英文与数字按词切分；单个汉字的查询匹配含有该字的全部二元组。
+索引覆盖拆书章节、章节拆解结果、大纲与知识库条目，
+单篇文档更新时只替换该文档的倒排项。
+拆书章节只保存在原始文件中的字节区间（source），正文在需要时从原始文件读取，不在内存和日志中另存一份。
+"""
+import html
+import json
+import logging
+import math
+import os
+import re
+import threading
+import time
+from array import array
+from collections import Counter
+
+from flask import Blueprint, request
+
+from common import DATA_DIR, ensure_dir, json_response
+from shared_state import file_lock
+
+logger = logging.getLogger(__name__)
+
+search_bp = Blueprint('search', __name__)
+
+SEARCH_DIR = os.path.join(DATA_DIR, 'search')
+DOC_TYPES = ('chapter', 'analysis', 'outline', 'knowledge')
+TOKEN_PATTERN = re.compile(r'[㐀-䶿一-鿿]+|[A-Za-z0-9]+')
+SNIPPET_RADIUS = 30
+MAX_SNIPPETS = 3
+COMPACT_RATIO = 0.3  # 已删除文档占比超过该值时重建倒排表
+# 单字查询展开出的倒排项总数上限，超过时视为过于宽泛（如"的"），拒绝查询
+MAX_CHAR_POSTINGS = 200000
+
+# BM25 参数
+K1 = 1.2
+B = 0.75
+
+
+def tokenize(text: str) -> list:
+    """
+    中文连续片段切为二元组（单字片段保留单字），英文数字按小写词处理
+    """
+    tokens = []
+    for match in TOKEN_PATTERN.finditer(text or ''):
+        run = match.group()
+        if run[0].isascii():
+            tokens.append(run.lower())
+        elif len(run) == 1:
+            tokens.append(run)
+        else:
+            tokens.extend(map(str.__add__, run, run[1:]))
+    return tokens
+
+
+def highlight(text: str, query: str, terms: list) -> list:
+    """
+    生成带 <mark> 标记的摘要片段，优先匹配完整查询串
+    """
+    needles = [query] if query and query in text else [t for t in terms if t in text]
+    snippets = []
+    seen_until = -1
+    for needle in needles:
+        start = text.find(needle)
+        while start != -1 and len(snippets) < MAX_SNIPPETS:
+            if start > seen_until:
+                left = max(0, start - SNIPPET_RADIUS)
+                right = min(len(text), start + len(needle) + SNIPPET_RADIUS)
+                snippets.append(
+                    ('…' if left > 0 else '')
+                    + html.escape(text[left:start])
+                    + '<mark>' + html.escape(needle) + '</mark>'
+                    + html.escape(text[start + len(needle):right])
+                    + ('…' if right < len(text) else '')
+                )
+                seen_until = right
+            start = text.find(needle, start + len(needle))
+        if len(snippets) >= MAX_SNIPPETS:
+            break
+    return snippets
+
+
+class BigramIndex:
+    """
+    倒排表为 gram -> (文档编号数组, 词频数组)，用紧凑的 array 存储以支撑数百万字的书。
+    文档更新采用"删除 + 追加"，被删除的编号在查询时跳过，累计过多时整体压缩。
+    多个 worker 进程共用同一个操作日志，每次读写前先重放其他进程追加的记录。
+    带 source 的文档不保存 text，load_text(source) 返回其正文
+    """
+
+    def __init__(self, log_path: str = None, load_text=None):
+        self.lock = threading.RLock()
+        self.load_text = load_text
+        self.log_path = log_path
+        self.log_offset = 0
+        self.log_inode = None
+        self.replaying = False
+        self._reset()
+        if log_path:
+            self._sync_log()
+
+    def _reset(self):
+        self.postings = {}
+        self.char_grams = {}    # 汉字 -> 含有该字的 gram
+        self.doc_ids = []       # 编号 -> 文档 id，已删除为 None
+        self.docs = []          # 编号 -> {'type', 'title', 'text', 'meta', 'source'}
+        self.doc_lengths = array('I')
+        self.id_to_num = {}
+        self.total_length = 0
+        self.deleted = 0
+
+    @property
+    def doc_count(self) -> int:
+        return len(self.id_to_num)
+
+    def upsert(self, doc_id: str, doc_type: str, title: str, text: str = None, meta: dict = None, log: bool = True,
+               source: dict = None):
+        """
+        提供 source 时只保存 source，text 仅用于建立倒排项，为 None 时通过 load_text 读取
+        """
+        with self.lock:
+            if log:
+                self._sync_log()
+            old = self.id_to_num.get(doc_id)
+            if old is not None:
+                current = self.docs[old]
+                same_text = current['source'] == source if source else current['text'] == text
+                if same_text and current['title'] == title and current['meta'] == (meta or {}):
+                    return False
+                self._remove(old)
+            if source and text is None:
+                text = self._load(source)
+
+            num = len(self.doc_ids)
+            grams = Counter(tokenize(title) + tokenize(text))
+            for gram, tf in grams.items():
+                entry = self.postings.get(gram)
+                if entry is None:
+                    entry = self.postings[gram] = (array('I'), array('I'))
+                    if not gram.isascii():
+                        for char in set(gram):
+                            self.char_grams.setdefault(char, set()).add(gram)
+                entry[0].append(num)
+                entry[1].append(tf)
+
+            length = sum(grams.values())
+            self.doc_ids.append(doc_id)
+            self.docs.append({'type': doc_type, 'title': title, 'text': None if source else text,
+                              'meta': meta or {}, 'source': source})
+            self.doc_lengths.append(length)
+            self.id_to_num[doc_id] = num
+            self.total_length += length
+
+            if log:
+                self._append_log(self._record(doc_id, self.docs[num]))
+            return True
+
+    @staticmethod
+    def _record(doc_id: str, doc: dict) -> dict:
+        record = {'op': 'upsert', 'id': doc_id, 'type': doc['type'], 'title': doc['title'], 'meta': doc['meta']}
+        if doc['source']:
+            record['source'] = doc['source']
+        else:
+            record['text'] = doc['text']
+        return record
+
+    def _load(self, source: dict) -> str:
+        try:
+            return self.load_text(source)
+        except (KeyError, OSError, TypeError) as e:
+            logger.warning(f"Failed to load indexed text from {source}: {e}")
+            return ''
+
+    def text(self, num: int) -> str:
+        doc = self.docs[num]
+        return self._load(doc['source']) if doc['source'] else doc['text']
+
+    def delete(self, doc_id: str, log: bool = True) -> bool:
+        with self.lock:
+            if log:
+                self._sync_log()
+            num = self.id_to_num.get(doc_id)
+            if num is None:
+                return False
+            self._remove(num)
+            if log:
+                self._append_log({'op': 'delete', 'id': doc_id})
+            return True
+
+    def _remove(self, num: int):
+        doc_id = self.doc_ids[num]
+        del self.id_to_num[doc_id]
+        self.doc_ids[num] = None
+        self.docs[num] = None
+        self.total_length -= self.doc_lengths[num]
+        self.deleted += 1
+        if self.deleted > COMPACT_RATIO * len(self.doc_ids) and self.deleted > 100:
+            self._compact()
+
+    def _compact(self):
+        live = [(doc_id, doc) for doc_id, doc in zip(self.doc_ids, self.docs) if doc_id is not None]
+        self._reset()
+        for doc_id, doc in live:
+            self.upsert(doc_id, doc['type'], doc['title'], doc['text'], doc['meta'], log=False, source=doc['source'])
+        # 重放过程中不重写正在读取的日志
+        if not self.replaying:
+            self._rewrite_log()
+
+    def entries(self, term: str) -> list:
+        """
+        查询词对应的倒排项：单个汉字没有自己的二元组，取含有该字的全部 gram；
+        展开后的倒排项过多时抛出 ValueError
+        """
+        if len(term) == 1 and not term.isascii():
+            entries = [self.postings[gram] for gram in self.char_grams.get(term, ())]
+            if sum(len(nums) for nums, _ in entries) > MAX_CHAR_POSTINGS:
+                raise ValueError(f'"{term}" 出现过于频繁，请使用更长的查询词')
+            return entries
+        entry = self.postings.get(term)
+        return [entry] if entry is not None else []
+
+    def score(self, terms: list, doc_type: str = None, require_all: bool = True) -> dict:
+        """
+        按 BM25 对含有查询 gram 的文档打分，返回 {编号: 分数}。
+        单字查询的词频为含该字的各 gram 词频之和（字在片段中间时计两次），只影响排序
+        """
+        n = self.doc_count
+        if n == 0 or not terms:
+            return {}
+        avg_length = self.total_length / n or 1
+        scores = {}
+        hits = Counter()
+        query_terms = Counter(terms)
+        for term, qtf in query_terms.items():
+            doc_tfs = Counter()
+            for nums, tfs in self.entries(term):
+                for num, tf in zip(nums, tfs):
+                    if self.doc_ids[num] is not None:
+                        doc_tfs[num] += tf
+            if not doc_tfs:
+                if require_all:
+                    return {}
+                continue
+            df = len(doc_tfs)
+            idf = math.log(1 + (n - df + 0.5) / (df + 0.5))
+            for num, tf in doc_tfs.items():
+                if doc_type and self.docs[num]['type'] != doc_type:
+                    continue
+                norm = tf * (K1 + 1) / (tf + K1 * (1 - B + B * self.doc_lengths[num] / avg_length))
+                scores[num] = scores.get(num, 0.0) + idf * norm * qtf
+                hits[num] += 1
+        if require_all:
+            needed = len(query_terms)
+            scores = {num: s for num, s in scores.items() if hits[num] == needed}
+        return scores
+
+    def search(self, query: str, doc_type: str = None, limit: int = 20, offset: int = 0, meta_filter: dict = None) -> dict:
+        started = time.perf_counter()
+        query = (query or '').strip()
+        terms = tokenize(query)
+        with self.lock:
+            self._sync_log()
+            scores = self.score(terms, doc_type)
+            if meta_filter:
+                scores = {
+                    num: s for num, s in scores.items()
+                    if all(self.docs[num]['meta'].get(k) == v for k, v in meta_filter.items())
+                }
+            # 只按索引中的数据排序（标题含完整查询串的额外加权），正文可能要从原始文件读取，
+            # 只为返回的这一页读取正文，统计查询串出现次数并生成摘要
+            ranked = sorted(
+                ((s * (2.0 if query in self.docs[num]['title'] else 1.0), num) for num, s in scores.items()),
+                key=lambda item: (-item[0], self.doc_ids[item[1]])
+            )
+
+            results = []
+            for s, num in ranked[offset:offset + limit]:
+                doc = self.docs[num]
+                text = self.text(num)
+                count = text.count(query) + doc['title'].count(query)
+                results.append({
+                    'id': self.doc_ids[num],
+                    'type': doc['type'],
+                    'title': doc['title'],
+                    'meta': doc['meta'],
+                    'score': round(s, 4),
+                    'count': count,
+                    'snippets': highlight(text, query, terms) or highlight(doc['title'], query, terms)
+                })
+        return {
+            'query': query,
+            'total': len(ranked),
+            'took_ms': round((time.perf_counter() - started) * 1000, 2),
+            'results': results
+        }
+
+    def refresh(self):
+        """
+        直接读取 docs / id_to_num 之前调用，合并其他进程的更新
+        """
+        with self.lock:
+            self._sync_log()
+
+    def stats(self) -> dict:
+        with self.lock:
+            self._sync_log()
+            return {
+                'docs': self.doc_count,
+                'terms': len(self.postings),
+                'total_length': self.total_length,
+                'deleted': self.deleted
+            }
+
+    # 操作日志：启动时重放，压缩时重写；记录以单次 O_APPEND 写入，多个进程追加互不交错
+    def _append_log(self, record: dict):
+        if not self.log_path:
+            return
+        ensure_dir(os.path.dirname(self.log_path))
+        line = (json.dumps(record, ensure_ascii=False) + '\n').encode('utf-8')
+        with file_lock(self.log_path):
+            fd = os.open(self.log_path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+            try:
+                stat = os.fstat(fd)
+                os.write(fd, line)
+            finally:
+                os.close(fd)
+            # 日志在上次同步后没有新记录时，自己追加的这一行已在内存中，跳过它；
+            # 否则留给下次同步，连同其他进程的记录按日志顺序重放
+            if self.log_inode in (None, stat.st_ino) and stat.st_size == self.log_offset:
+                self.log_inode = stat.st_ino
+                self.log_offset += len(line)
+
+    def _rewrite_log(self):
+        """
+        写出当前文档的快照，并原样保留其他进程在上次同步之后追加的记录，下次同步时重放
+        """
+        if not self.log_path:
+            return
+        ensure_dir(os.path.dirname(self.log_path))
+        tmp_path = self.log_path + '.tmp'
+        with file_lock(self.log_path):
+            with open(tmp_path, 'wb') as f:
+                for doc_id, doc in zip(self.doc_ids, self.docs):
+                    if doc_id is None:
+                        continue
+                    f.write((json.dumps(self._record(doc_id, doc), ensure_ascii=False) + '\n').encode('utf-8'))
+                snapshot_size = f.tell()
+                if os.path.exists(self.log_path) and os.stat(self.log_path).st_ino == self.log_inode:
+                    with open(self.log_path, 'rb') as log:
+                        log.seek(self.log_offset)
+                        f.write(log.read())
+            os.replace(tmp_path, self.log_path)
+            self.log_inode = os.stat(self.log_path).st_ino
+            self.log_offset = snapshot_size
+
+    def _sync_log(self):
+        """
+        重放日志中尚未读取的记录；日志被其他进程压缩重写后重新加载全部文档
+        """
+        if not self.log_path:
+            return
+        try:
+            f = open(self.log_path, 'rb')
+        except FileNotFoundError:
+            return
+        with f:
+            stat = os.fstat(f.fileno())
+            full_reload = stat.st_ino != self.log_inode or stat.st_size < self.log_offset
+            if not full_reload and stat.st_size == self.log_offset:
+                return
+            if full_reload:
+                self._reset()
+                self.log_offset = 0
+                self.log_inode = stat.st_ino
+
+            records = 0
+            self.replaying = True
+            try:
+                f.seek(self.log_offset)
+                for line in f:
+                    # 其他进程可能正在写入最后一行
+                    if not line.endswith(b'\n'):
+                        break
+                    self.log_offset += len(line)
+                    try:
+                        record = json.loads(line)
+                    except json.JSONDecodeError:
+                        continue
+                    records += 1
+                    if record['op'] == 'upsert':
+                        self.upsert(record['id'], record['type'], record['title'], record.get('text'),
+                                    record.get('meta'), log=False, source=record.get('source'))
+                    else:
+                        self.delete(record['id'], log=False)
+            finally:
+                self.replaying = False
+
+        if full_reload:
+            if records > self.doc_count * 2:
+                self._rewrite_log()
+            logger.info(f"Search index loaded: {self.doc_count} docs from {records} log records")
+
+
+def read_book_source(source: dict) -> str:
+    # books 导入了本模块，在使用时再导入
+    from books import book_store
+    return book_store.read_source(source)
+
+
+search_index = BigramIndex(os.path.join(SEARCH_DIR, 'docs.log'), read_book_source)
+
+
+def index_book(book_id: str, chapters):
+    """
+    将导入的书按章节写入索引，chapters 为 {'index', 'title', 'content', 'source'} 的可迭代对象；
+    索引中只保存 source，正文已建立倒排项后不再保留
+    """
+    started = time.time()
+    count = 0
+    for chapter in chapters:
+        search_index.upsert(
+            f"chapter:{book_id}:{chapter['index']}", 'chapter', chapter['title'], chapter['content'],
+            {'book_id': book_id, 'index': chapter['index']}, source=chapter['source']
+        )
+        count += 1
+    logger.info(f"Indexed book {book_id}: {count} chapters in {time.time() - started:.2f}s")
+
+
+def index_book_async(book_id: str, chapters):
+    thread = threading.Thread(target=index_book, args=(book_id, chapters), daemon=True)
+    thread.start()
+    return thread
+
+
+@search_bp.route('/search', methods=['GET'])
+def search():
+    query = request.args.get('q', '')
+    if not query.strip():
+        return json_response({'error': '缺少查询内容'}, 400)
+    doc_type = request.args.get('type') or None
+    meta_filter = {}
+    if request.args.get('book_id'):
+        meta_filter['book_id'] = request.args['book_id']
+    limit = min(request.args.get('limit', 20, type=int), 100)
+    offset = max(request.args.get('offset', 0, type=int), 0)
+    try:
+        return json_response(search_index.search(query, doc_type, limit, offset, meta_filter))
+    except ValueError as e:
+        return json_response({'error': str(e)}, 400)
+
+
+@search_bp.route('/search/docs', methods=['PUT'])
+def upsert_docs():
+    """
+    写入或更新文档，支持单篇 {id, type, title, text, meta} 或批量 {docs: [...]}
+    """
+    data = request.json or {}
+    docs = data.get('docs', [data])
+    changed = 0
+    for doc in docs:
+        if not doc.get('id') or doc.get('type') not in DOC_TYPES:
+            return json_response({'error': f"文档缺少 id 或 type 无效: {doc.get('id')}"}, 400)
+        if search_index.upsert(doc['id'], doc['type'], doc.get('title', ''), doc.get('text', ''), doc.get('meta')):
+            changed += 1
+    return json_response({'received': len(docs), 'changed': changed})
+
+
+@search_bp.route('/search/knowledge', methods=['PUT'])
+def sync_knowledge():
+    """
+    同步整个知识库（knowledge-base.js 的 data 结构），只重建有变化的条目
+    """
+    data = request.json or {}
+    if not isinstance(data, dict):
+        return json_response({'error': '知识库应为对象'}, 400)
+    seen = set()
+    changed = 0
+    for category, items in data.items():
+        if not isinstance(items, list):
+            continue
+        for item in items:
+            if not isinstance(item, dict):
+                continue
+            name = str(item.get('name', '')).strip()
+            if not name:
+                continue
+            doc_id = f'knowledge:{category}:{name}'
+            seen.add(doc_id)
+            text = '\n'.join(
+                (' '.join(map(str, value)) if isinstance(value, list) else str(value))
+                for key, value in item.items()
+                if key != 'name' and value
+            )
+            if search_index.upsert(doc_id, 'knowledge', name, text, {'category': category, 'name': name}):
+                changed += 1
+    return json_response({'changed': changed, 'deleted': delete_stale('knowledge:', seen)})
+
+
+@search_bp.route('/search/outline', methods=['PUT'])
+def sync_outline():
+    """
+    同步全书大纲与各章大纲 {outline, chapters: [...]}，只重建有变化的条目
+    """
+    data = request.json or {}
+    outline = data.get('outline', '') if isinstance(data, dict) else None
+    chapters = data.get('chapters', []) if isinstance(data, dict) else None
+    if not isinstance(outline, str) or not isinstance(chapters, list) \
+            or not all(isinstance(text, str) for text in chapters):
+        return json_response({'error': 'outline 应为文本，chapters 应为文本数组'}, 400)
+    docs = [('outline:book', '全书大纲', outline, {})]
+    docs += [(f'outline:chapter:{i + 1}', f'第{i + 1}章大纲', text, {'chapter': i + 1})
+             for i, text in enumerate(chapters)]
+    seen = set()
+    changed = 0
+    for doc_id, title, text, meta in docs:
+        if not text.strip():
+            continue
+        seen.add(doc_id)
+        if search_index.upsert(doc_id, 'outline', title, text, meta):
+            changed += 1
+    return json_response({'changed': changed, 'deleted': delete_stale('outline:', seen)})
+
+
+def delete_stale(prefix: str, seen: set) -> int:
+    """
+    删除以 prefix 开头、但不在本次同步内容中的文档，返回删除数
+    """
+    search_index.refresh()
+    with search_index.lock:
+        stale = [doc_id for doc_id in search_index.id_to_num if doc_id.startswith(prefix) and doc_id not in seen]
+    for doc_id in stale:
+        search_index.delete(doc_id)
+    return len(stale)
+
+
+@search_bp.route('/search/docs/<path:doc_id>', methods=['DELETE'])
+def delete_doc(doc_id):
+    if not search_index.delete(doc_id):
+        return json_response({'error': '文档不存在'}, 404)
+    return json_response({'deleted': doc_id})
+
+
+@search_bp.route('/search/stats', methods=['GET'])
+def search_stats():
+    return json_response(search_index.stats())
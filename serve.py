@@ -0,0 +1,142 @@
+"""
+生产环境入口：加载应用后 fork 出多个 worker 进程，共同监听同一个端口
+
+    python serve.py app.py --workers 4 --port 60001
+
+调用统计、限流令牌桶与检索索引经由 shared_state 和数据文件在进程间共享，
+仪表盘与限额按全部 worker 合并计算；worker 异常退出后自动重启。
+多进程模式需要 os.fork（Linux / macOS），Windows 下只能以 --workers 1 运行。
+"""
+import argparse
+import importlib.util
+import logging
+import os
+import signal
+import socket
+import sys
+import time
+
+from werkzeug.serving import make_server
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+RESPAWN_DELAY = 1.0  # worker 启动后很快退出时，延迟重启，避免反复 fork
+
+logger = logging.getLogger('serve')
+
+
+def load_module(path: str):
+    sys.path.insert(0, BASE_DIR)
+    spec = importlib.util.spec_from_file_location('novel_app', os.path.abspath(path))
+    module = importlib.util.module_from_spec(spec)
+    # 先登记到 sys.modules，init_app 可由 app.import_name 找到后端文件
+    sys.modules[spec.name] = module
+    spec.loader.exec_module(module)
+    return module
+
+
+def load_app(path: str):
+    """
+    在 fork 之前导入应用，模板、静态资源打包与检索索引只需加载一次，由各 worker 共享。
+    返回 (app, on_start)：后端定义的 on_start() 用于预加载模型等启动任务，可能启动后台线程，
+    不能在 fork 之前的主进程中调用（线程不会随 fork 复制，持有的锁却会），由 serve 在第一个 worker 中调用
+    """
+    module = load_module(path)
+    on_start = getattr(module, 'on_start', None)
+    return module.app, on_start if callable(on_start) else None
+
+
+def run_worker(app, host: str, port: int, sock: socket.socket = None):
+    server = make_server(host, port, app, threaded=True, fd=sock.fileno() if sock else None)
+    logger.info(f"Worker {os.getpid()} serving on {host}:{port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+def spawn_worker(app, host: str, port: int, sock: socket.socket, on_start=None) -> int:
+    pid = os.fork()
+    if pid:
+        return pid
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    code = 0
+    try:
+        if on_start:
+            on_start()
+        run_worker(app, host, port, sock)
+    except Exception:
+        logger.exception(f"Worker {os.getpid()} crashed")
+        code = 1
+    os._exit(code)
+
+
+def stop(signum, frame):
+    raise SystemExit(0)
+
+
+def serve(app, host: str, port: int, workers: int, on_start=None):
+    """
+    on_start 只在一个 worker 中调用一次（重启的 worker 不再调用）
+    """
+    if workers == 1 or not hasattr(os, 'fork'):
+        if workers > 1:
+            logger.warning("os.fork is not available, running a single worker")
+        if on_start:
+            on_start()
+        run_worker(app, host, port)
+        return
+
+    sock = socket.create_server((host, port), family=socket.AF_INET6 if ':' in host else socket.AF_INET,
+                                backlog=128)
+    sock.set_inheritable(True)
+    started = {}
+    for i in range(workers):
+        started[spawn_worker(app, host, port, sock, on_start if i == 0 else None)] = time.monotonic()
+    logger.info(f"Master {os.getpid()} started {workers} workers on {host}:{port}")
+
+    signal.signal(signal.SIGTERM, stop)
+    try:
+        while True:
+            pid, status = os.wait()
+            if pid not in started:
+                continue
+            uptime = time.monotonic() - started.pop(pid)
+            logger.warning(f"Worker {pid} exited with status {status}, restarting")
+            if uptime < RESPAWN_DELAY:
+                time.sleep(RESPAWN_DELAY)
+            started[spawn_worker(app, host, port, sock)] = time.monotonic()
+    except (KeyboardInterrupt, SystemExit):
+        logger.info("Shutting down workers")
+    finally:
+        for pid in started:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+        for pid in started:
+            try:
+                os.waitpid(pid, 0)
+            except ChildProcessError:
+                pass
+        sock.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='以多个 worker 进程运行小说编辑器后端')
+    parser.add_argument('app', nargs='?', default='app.py', help='后端文件，如 app.py、apps/app-ollama.py')
+    parser.add_argument('--host', default='0.0.0.0')
+    parser.add_argument('--port', type=int, default=60001)
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1)
+    parser.add_argument('--log-level', default='INFO')
+    args = parser.parse_args()
+
+    app, on_start = load_app(args.app)
+    # 各后端以 DEBUG 级别输出每个分块，生产环境默认只保留 INFO 以上
+    logging.getLogger().setLevel(args.log_level.upper())
+    serve(app, args.host, args.port, max(1, args.workers), on_start)
+
+
+if __name__ == '__main__':
+    main()
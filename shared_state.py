@@ -0,0 +1,228 @@
+"""
+多进程共享状态：计数器、最近样本、限流令牌桶与少量键值保存在本地 SQLite（WAL 模式）中，
+多个 worker 进程读写同一份数据，统计、限额与仪表盘在全局范围内保持正确
+"""
+import contextlib
+import json
+import os
+import sqlite3
+import threading
+import time
+
+try:
+    import fcntl
+except ImportError:
+    # Windows 下没有 fork，只以单进程运行，文件锁退化为空操作
+    fcntl = None
+
+from common import DATA_DIR, ensure_dir
+
+STATE_PATH = os.environ.get('NOVEL_STATE_DB', os.path.join(DATA_DIR, 'state.db'))
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS counters (name TEXT PRIMARY KEY, value REAL NOT NULL);
+CREATE TABLE IF NOT EXISTS samples (seq INTEGER PRIMARY KEY AUTOINCREMENT, series TEXT NOT NULL, value REAL NOT NULL);
+CREATE INDEX IF NOT EXISTS samples_series ON samples (series, seq);
+CREATE TABLE IF NOT EXISTS buckets (name TEXT PRIMARY KEY, tokens REAL NOT NULL, updated REAL NOT NULL);
+CREATE TABLE IF NOT EXISTS kv (key TEXT PRIMARY KEY, value TEXT NOT NULL);
+"""
+
+
+class SharedState:
+    """
+    每个线程持有独立连接；fork 出的子进程检测到 pid 变化后重新连接，不复用父进程的连接。
+    写操作在 transaction() 中进行，BEGIN IMMEDIATE 保证多进程下的读改写是原子的
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.local = threading.local()
+        self.schema_pid = None
+
+    def connect(self) -> sqlite3.Connection:
+        conn = getattr(self.local, 'conn', None)
+        if conn is None or self.local.pid != os.getpid():
+            ensure_dir(os.path.dirname(self.path))
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            if self.schema_pid != os.getpid():
+                conn.executescript(SCHEMA)
+                self.schema_pid = os.getpid()
+            self.local.conn = conn
+            self.local.pid = os.getpid()
+        return conn
+
+    @contextlib.contextmanager
+    def transaction(self):
+        conn = self.connect()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            yield conn
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+        conn.execute('COMMIT')
+
+    # 写操作：在 transaction() 内调用，conn 为其返回的连接
+    @staticmethod
+    def add_counters(conn, counters: dict):
+        conn.executemany(
+            'INSERT INTO counters (name, value) VALUES (?, ?) '
+            'ON CONFLICT(name) DO UPDATE SET value = value + excluded.value',
+            counters.items()
+        )
+
+    @staticmethod
+    def push_sample(conn, series: str, value: float, keep: int):
+        """
+        追加样本并只保留最近 keep 条
+        """
+        conn.execute('INSERT INTO samples (series, value) VALUES (?, ?)', (series, value))
+        conn.execute(
+            'DELETE FROM samples WHERE series = ? AND seq <= '
+            '(SELECT seq FROM samples WHERE series = ? ORDER BY seq DESC LIMIT 1 OFFSET ?)',
+            (series, series, keep)
+        )
+
+    @staticmethod
+    def set_value(conn, key: str, value):
+        conn.execute(
+            'INSERT INTO kv (key, value) VALUES (?, ?) ON CONFLICT(key) DO UPDATE SET value = excluded.value',
+            (key, json.dumps(value, ensure_ascii=False))
+        )
+
+    @staticmethod
+    def delete_counters(conn, start: str, end: str):
+        """
+        删除名称在 [start, end) 范围内的计数器，用于清理按时间分段的过期计数
+        """
+        conn.execute('DELETE FROM counters WHERE name >= ? AND name < ?', (start, end))
+
+    def counters(self, names) -> dict:
+        names = list(names)
+        values = dict.fromkeys(names, 0)
+        rows = self.connect().execute(
+            f"SELECT name, value FROM counters WHERE name IN ({','.join('?' * len(names))})", names
+        )
+        values.update(rows)
+        return values
+
+    def counters_between(self, start: str, end: str) -> dict:
+        """
+        名称在 [start, end) 范围内的全部计数器，计数器名以时间开头时可按时间段查询
+        """
+        rows = self.connect().execute(
+            'SELECT name, value FROM counters WHERE name >= ? AND name < ? ORDER BY name', (start, end)
+        )
+        return dict(rows)
+
+    def samples(self, series: str) -> list:
+        rows = self.connect().execute('SELECT value FROM samples WHERE series = ? ORDER BY seq', (series,))
+        return [value for value, in rows]
+
+    def get_value(self, key: str, default=None):
+        row = self.connect().execute('SELECT value FROM kv WHERE key = ?', (key,)).fetchone()
+        return json.loads(row[0]) if row else default
+
+    def put_value(self, key: str, value):
+        with self.transaction() as conn:
+            self.set_value(conn, key, value)
+
+    def take(self, bucket: str, rate: float, capacity: float, amount: float = 1) -> float:
+        """
+        令牌桶限流：每秒补充 rate 个令牌，最多积累 capacity 个。
+        令牌足够时扣除并返回 0，否则不扣除，返回还需等待的秒数
+        """
+        now = time.time()
+        with self.transaction() as conn:
+            row = conn.execute('SELECT tokens, updated FROM buckets WHERE name = ?', (bucket,)).fetchone()
+            tokens = capacity if row is None else min(capacity, row[0] + (now - row[1]) * rate)
+            wait = 0.0
+            if tokens >= amount:
+                tokens -= amount
+            else:
+                wait = (amount - tokens) / rate if rate > 0 else float('inf')
+            conn.execute(
+                'INSERT INTO buckets (name, tokens, updated) VALUES (?, ?, ?) '
+                'ON CONFLICT(name) DO UPDATE SET tokens = excluded.tokens, updated = excluded.updated',
+                (bucket, tokens, now)
+            )
+        return wait
+
+
+shared_state = SharedState(STATE_PATH)
+
+
+@contextlib.contextmanager
+def file_lock(path: str):
+    """
+    跨进程互斥访问 path（锁文件为 path.lock），用于多个 worker 追加或重写同一个数据文件
+    """
+    if fcntl is None:
+        yield
+        return
+    ensure_dir(os.path.dirname(path))
+    with open(path + '.lock', 'a') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+class ProcessSlots:
+    """
+    跨进程的并发名额：每个名额对应一个锁文件（path.<序号>.lock），持有 flock 即占用该名额。
+    进程退出时内核自动释放锁，不会因 worker 崩溃而泄漏名额；没有 fcntl 时退化为进程内信号量
+    """
+    POLL_INTERVAL = 0.05
+
+    def __init__(self, path: str, count: int):
+        self.path = path
+        self.count = count
+        self.semaphore = threading.BoundedSemaphore(count) if fcntl is None else None
+
+    def acquire(self, timeout: float = None):
+        """
+        返回占用的名额（release 时传回），超时返回 None
+        """
+        if self.semaphore is not None:
+            return True if self.semaphore.acquire(timeout=timeout) else None
+        ensure_dir(os.path.dirname(self.path))
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            for i in range(self.count):
+                f = open(f'{self.path}.{i}.lock', 'a')
+                try:
+                    fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    return f
+                except BlockingIOError:
+                    f.close()
+            if deadline is not None and time.monotonic() >= deadline:
+                return None
+            time.sleep(self.POLL_INTERVAL)
+
+    def release(self, slot):
+        if self.semaphore is not None:
+            self.semaphore.release()
+            return
+        fcntl.flock(slot, fcntl.LOCK_UN)
+        slot.close()
+
+
+def process_alive(pid: int) -> bool:
+    if not pid:
+        return False
+    if pid == os.getpid():
+        return True
+    if os.name == 'nt':
+        # Windows 上 os.kill 会直接终止进程，不能用于探测；此时也只有单进程
+        return False
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
@@ -730,6 +730,9 @@ const optimizerConfig = {
         minAcceptableScore: 80,
         maxIterations: 3,
         minImprovement: 5,
+        parallelCandidates: 3, // 每轮并发生成的候选数，设为 1 则使用逐次迭代模式
+        skipExplanation: false, // 为 true 时在【**优化结束**】后即停止生成，不输出优化说明
+        judgeMode: 'self', // self: 使用模型自评的评分; judge: 额外调用低成本模型打分
         scoreRules: {
             60: {
                 focus: ' ',
@@ -1083,6 +1086,27 @@ function getContext(segments, currentIndex) {
     return { prevText, nextText };
 }
 
+// 按待优化内容筛选相关的背景与人物设定，失败时使用完整设定
+async function retrieveRelevantSettings(query, background, characters) {
+    try {
+        const response = await fetch('/knowledge/retrieve', {
+            method: 'POST',
+            headers: {'Content-Type': 'application/json'},
+            body: JSON.stringify({ query, sections: { background, characters } })
+        });
+        if (!response.ok) return { background, characters, knowledge: '' };
+        const result = await response.json();
+        return {
+            background: result.sections.background,
+            characters: result.sections.characters,
+            knowledge: result.sections.knowledge
+        };
+    } catch (error) {
+        console.warn('相关设定筛选失败，使用完整设定:', error);
+        return { background, characters, knowledge: '' };
+    }
+}
+
 // 构建AI提示词
 function buildPrompt(data, iteration, optimizationHistory) {
     const basePrompt = `
@@ -1093,7 +1117,7 @@ function buildPrompt(data, iteration, optimizationHistory) {
 如果出现大量机械性AI语句、冗余修辞、大量的环境环境直接扣40分。
 背景信息：${data.background || ''}
 角色设定：${data.characters || ''}
-
+${data.knowledge ? `相关知识库：\n${data.knowledge}\n` : ''}
 上文内容：
 ${data.prevText}
 
@@ -1232,8 +1256,119 @@ function parseAIResponse(response) {
     }
 }
 
+// 服务端多候选模式：每轮并发生成多个候选并择优，达到目标分数即停止
+async function optimizeSegmentParallel(index) {
+    const segmentElement = document.querySelector(`[data-index="${index}"]`);
+    try {
+        showLoading(segmentElement);
+        updateSegmentStatus(index, 'optimizing');
+
+        const resultPanel = uiState.resultPanel;
+        resultPanel.style.display = 'flex';
+        resultPanel.style.opacity = '1';
+        const contentArea = resultPanel.querySelector('.content-comparison');
+        const scoreArea = resultPanel.querySelector('.score-value');
+        const reasonArea = resultPanel.querySelector('.score-reason');
+        const changesArea = resultPanel.querySelector('.changes-value');
+        const iterationInfo = resultPanel.querySelector('.current-iteration');
+
+        contentArea.textContent = '正在并行生成候选内容...';
+        scoreArea.textContent = '--';
+        reasonArea.textContent = '分析中...';
+        changesArea.textContent = '等待中...';
+
+        const currentText = uiState.segments[index];
+        const context = getContext(uiState.segments, index);
+        const settings = await retrieveRelevantSettings(
+            `${context.prevText}\n${currentText}\n${context.nextText}`,
+            $('#background').val(),
+            $('#characters').val()
+        );
+        const prompt = buildPrompt({
+            currentText,
+            ...context,
+            ...settings,
+            style: $('#style').val()
+        }, 0, []);
+
+        const feedback = {};
+        Object.entries(optimizerConfig.scoring.scoreRules).forEach(([level, rule]) => {
+            feedback[level] = `${rule.focus}\n${rule.secondary}\n${rule.prompt}`;
+        });
+
+        const response = await fetch('/optimize/segment', {
+            method: 'POST',
+            headers: {'Content-Type': 'application/json'},
+            body: JSON.stringify({
+                prompt,
+                candidates: optimizerConfig.scoring.parallelCandidates,
+                target_score: optimizerConfig.scoring.minAcceptableScore,
+                max_rounds: optimizerConfig.scoring.maxIterations,
+                scoring: optimizerConfig.scoring.judgeMode,
+                skip_explanation: optimizerConfig.scoring.skipExplanation,
+                feedback
+            })
+        });
+        if (!response.ok) throw new Error(`API请求失败: ${response.status}`);
+
+        const reader = response.body.getReader();
+        const decoder = new TextDecoder();
+        let buffer = '';
+        let result = null;
+
+        while (true) {
+            const {value, done} = await reader.read();
+            if (done) break;
+            buffer += decoder.decode(value, {stream: true});
+            const lines = buffer.split('\n');
+            buffer = lines.pop();
+
+            for (const line of lines.filter(l => l.trim())) {
+                const event = JSON.parse(line);
+                if (event.event === 'candidate') {
+                    if (iterationInfo) {
+                        iterationInfo.textContent = `迭代次数: ${event.round}（候选 ${event.candidate + 1}）`;
+                    }
+                    scoreArea.textContent = event.score + '（评估中）';
+                } else if (event.event === 'result') {
+                    if (event.error) throw new Error(event.error);
+                    result = event;
+                }
+            }
+        }
+        if (!result) throw new Error('未收到优化结果');
+
+        scoreArea.textContent = result.score;
+        reasonArea.textContent = result.reason;
+        contentArea.textContent = result.content;
+        changesArea.textContent = result.changes;
+
+        uiState.optimizationHistory.push({
+            segmentIndex: index,
+            iteration: result.round,
+            score: result.score,
+            content: result.content,
+            reason: result.reason,
+            changes: result.changes
+        });
+        return result;
+    } catch (error) {
+        console.error(`段落 ${index + 1} 优化失败:`, error);
+        updateSegmentStatus(index, 'error');
+        showError(`段落 ${index + 1} 优化失败: ${error.message}`);
+        throw error;
+    } finally {
+        hideLoading(segmentElement);
+        updateSegmentStatus(index, 'optimized');
+    }
+}
+
 // 修改后的optimizeSegment函数中的相关部分
 async function optimizeSegment(index) {
+    if (optimizerConfig.scoring.parallelCandidates > 1) {
+        return optimizeSegmentParallel(index);
+    }
+
     try {
         showLoading(document.querySelector(`[data-index="${index}"]`));
         updateSegmentStatus(index, 'optimizing');
@@ -1267,87 +1402,68 @@ async function optimizeSegment(index) {
             changesArea.textContent = '等待中...';
 
             const context = getContext(uiState.segments, index);
+            const settings = await retrieveRelevantSettings(
+                `${context.prevText}\n${currentContent}\n${context.nextText}`,
+                $('#background').val(),
+                $('#characters').val()
+            );
             const prompt = buildPrompt({
                 currentText: currentContent,
                 ...context,
-                background: $('#background').val(),
-                characters: $('#characters').val(),
+                ...settings,
                 style: $('#style').val()
             }, iteration - 1, uiState.optimizationHistory);
 
             try {
-                const response = await fetch('/gen2', {
+                // 服务端增量解析各标记段落，以结构化事件返回
+                const response = await fetch('/optimize/stream', {
                     method: 'POST',
                     headers: {'Content-Type': 'application/json'},
-                    body: JSON.stringify({prompt})
+                    body: JSON.stringify({
+                        prompt,
+                        stop_after_content: optimizerConfig.scoring.skipExplanation
+                    })
                 });
 
                 if (!response.ok) throw new Error(`API请求失败: ${response.status}`);
 
                 const reader = response.body.getReader();
                 const decoder = new TextDecoder();
-                let completeResponse = '';
+                const areas = { reason: reasonArea, content: contentArea, changes: changesArea };
+                const started = new Set();
                 let buffer = '';
-                let currentSection = '';
-                let tempContent = '';
-                let tempScore = '';
-                let tempReason = '';
-                let tempChanges = '';
-                
+                let result = null;
+
                 while (true) {
                     const {value, done} = await reader.read();
                     if (done) break;
-                    
-                    const chunk = decoder.decode(value, {stream: true});
-                    completeResponse += chunk;
-                    buffer += chunk;
-                    
-                    // 处理流式输出
-                    while (buffer.includes('【**')) {
-                        const startIndex = buffer.indexOf('【**');
-                        const endIndex = buffer.indexOf('**】', startIndex);
-                        
-                        if (endIndex === -1) break;
-                        
-                        const marker = buffer.substring(startIndex + 3, endIndex);
-                        const nextStart = buffer.indexOf('【**', endIndex);
-                        const content = buffer.substring(endIndex + 3, nextStart === -1 ? buffer.length : nextStart);
-                        
-                        // 临时存储所有内容
-                        switch (marker) {
-                            case '评分':
-                                tempScore = content;
-                                scoreArea.textContent = content + '（评估中）';
-                                break;
-                            case '评分说明':
-                                tempReason = content;
-                                reasonArea.textContent = content;
-                                break;
-                            case '优化开始':
-                                contentArea.textContent = '';
-                                currentSection = '优化内容';
+
+                    buffer += decoder.decode(value, {stream: true});
+                    const lines = buffer.split('\n');
+                    buffer = lines.pop();
+
+                    for (const line of lines.filter(l => l.trim())) {
+                        const event = JSON.parse(line);
+                        switch (event.event) {
+                            case 'score':
+                                scoreArea.textContent = event.value + '（评估中）';
                                 break;
-                            case '优化结束':
-                                tempContent = content;
-                                contentArea.textContent = content;
+                            case 'delta':
+                                if (!started.has(event.section)) {
+                                    areas[event.section].textContent = '';
+                                    started.add(event.section);
+                                }
+                                areas[event.section].textContent += event.text;
                                 break;
-                            case '优化说明':
-                                tempChanges = content;
-                                changesArea.textContent = content;
+                            case 'result':
+                                result = event;
                                 break;
+                            case 'error':
+                                throw new Error(`解析响应失败: ${event.error}`);
                         }
-                        
-                        buffer = buffer.substring(nextStart === -1 ? buffer.length : nextStart);
-                    }
-                    
-                    if (currentSection === '优化内容' && buffer.length > 0) {
-                        contentArea.textContent += buffer;
-                        buffer = '';
                     }
                 }
-
-                // 完整响应接收完毕后，解析最终结果
-                const result = parseAIResponse(completeResponse);
+                if (!result) throw new Error('未收到完整的优化结果');
                 
                 // 更新最终显示
                 scoreArea.textContent = result.score;
@@ -9,6 +9,9 @@ class BookSplitter {
             SUPPORTED_ENCODINGS: ['UTF-8', 'GBK', 'GB2312', 'BIG5'],
             MAX_RETRIES: 3,
             RETRY_DELAY: 1000,
+            // 查询已有拆解结果时每批的章节数；浏览器内分割的书要随请求发送正文，批次小一些
+            LOOKUP_BATCH: { SERVER: 1000, LOCAL: 50 },
+            SUMMARY_POLL_INTERVAL: 2000,
             Z_INDEX: {
                 MODAL: 999998,
                 BALL: 999999,
@@ -95,6 +98,7 @@ class BookSplitter {
                     <button id="book-splitter-import" class="primary-button">导入文本</button>
                     <button id="book-splitter-split" class="primary-button" disabled>开始分割</button>
                     <button id="book-splitter-analyze-all" class="primary-button" disabled>全部拆书</button>
+                    <button id="book-splitter-summarize" class="primary-button" disabled>全书摘要</button>
                     <button id="book-splitter-export" class="primary-button" disabled>导出数据</button>
                     <button id="book-splitter-clear" class="warning-button">清除数据</button>
                 </div>
@@ -106,6 +110,7 @@ class BookSplitter {
                     </div>
                     <textarea id="book-splitter-prompt" rows="6" placeholder="输入拆书提示词...">${this.getDefaultPrompt()}</textarea>
                 </div>
+                <div id="book-splitter-book-summary" class="chapter-analysis" style="display: none;"></div>
                 <div id="book-splitter-chapters" class="chapters-containerxxx">
                     <div class="ttttt1"></div>
                 </div>
@@ -522,12 +527,147 @@ class BookSplitter {
             this.saveToStorage();
             this.enableButtons();
             this.showStatus(`成功分割出 ${this.chapters.length} 章`, 'success');
+            await this.restoreCachedAnalyses();
         } catch (error) {
             console.error('分割文本失败:', error);
             this.showStatus(`分割文本失败: ${error.message}`, 'error');
         }
     }
 
+    // 大文件交给服务端识别编码并切分，只返回章节索引
+    async importOnServer(file) {
+        const formData = new FormData();
+        formData.append('file', file);
+        const selectedEncoding = document.getElementById('book-splitter-encoding')?.value;
+        if (selectedEncoding && selectedEncoding !== 'UTF-8') {
+            formData.append('encoding', selectedEncoding);
+        }
+
+        const response = await fetch('/books/import', { method: 'POST', body: formData });
+        if (response.status === 404) return null;
+        const book = await response.json();
+        if (!response.ok) throw new Error(book.error || `HTTP error! status: ${response.status}`);
+        return book;
+    }
+
+    async loadServerBook(book) {
+        const chaptersContainer = document.querySelector('.ttttt1');
+        if (!chaptersContainer) throw new Error('找不到章节容器元素');
+        if (book.chapters.length === 0) {
+            this.showStatus('未找到任何章节', 'error');
+            return;
+        }
+
+        chaptersContainer.innerHTML = '';
+        this.chapters = book.chapters.map(chapter => ({
+            id: `chapter-${chapter.index}`,
+            title: chapter.title,
+            content: '',
+            length: chapter.length,
+            bookId: book.book_id,
+            analysis: '',
+            status: 'pending'
+        }));
+        this.state.totalChapters = this.chapters.length;
+        this.state.processedChapters = this.chapters.length;
+
+        // 正文按需加载，这里不逐章等待动画
+        this.chapters.forEach((chapter, i) => this.createChapterElement(chapter.title, '', i));
+
+        this.updateProgress();
+        this.saveToStorage();
+        this.enableButtons();
+        this.showStatus(`成功分割出 ${this.chapters.length} 章（编码 ${book.encoding}）`, 'success');
+        await this.restoreCachedAnalyses();
+    }
+
+    // 服务端按（章节内容、拆解提示词、模型）保存拆解结果：没有变化的章节直接复用，
+    // 之前拆解过但内容或提示词已变化的章节重新标记为待处理
+    async restoreCachedAnalyses() {
+        if (this.chapters.length === 0) return 0;
+        const prompt = document.getElementById('book-splitter-prompt')?.value || this.getDefaultPrompt();
+        const batchSize = this.chapters[0].bookId ? this.CONFIG.LOOKUP_BATCH.SERVER : this.CONFIG.LOOKUP_BATCH.LOCAL;
+        let restored = 0;
+
+        try {
+            for (let start = 0; start < this.chapters.length; start += batchSize) {
+                const batch = this.chapters.slice(start, start + batchSize);
+                const response = await fetch('/analyses/lookup', await jsonRequest({
+                    prompt,
+                    book_id: batch[0].bookId,
+                    chapters: batch.map((chapter, i) => ({
+                        index: start + i,
+                        title: chapter.title,
+                        ...(chapter.bookId ? {} : { content: chapter.content })
+                    }))
+                }));
+                if (!response.ok) break;
+
+                const result = await response.json();
+                for (const item of result.chapters) {
+                    const chapter = this.chapters[item.index];
+                    if (!chapter || !item.key) continue;
+                    if (item.analysis !== null) {
+                        if (chapter.analysisKey !== item.key) restored++;
+                        Object.assign(chapter, { analysis: item.analysis, analysisKey: item.key, status: 'success' });
+                    } else if (chapter.analysisKey && chapter.analysisKey !== item.key) {
+                        chapter.status = 'pending';
+                    } else {
+                        continue;
+                    }
+                    this.renderChapterAnalysis(item.index);
+                }
+            }
+        } catch (error) {
+            console.warn('查询已有拆解结果失败:', error);
+        }
+
+        this.saveToStorage();
+        this.updateProgress();
+        if (restored > 0) this.showStatus(`${restored} 章复用了已有的拆解结果`, 'success');
+        return restored;
+    }
+
+    renderChapterAnalysis(index) {
+        const chapter = this.chapters[index];
+        const container = document.getElementById(chapter.id);
+        if (!container) return;
+        const analysisContent = container.querySelector('.chapter-analysis');
+        if (analysisContent && chapter.status === 'success') {
+            analysisContent.style.display = 'block';
+            analysisContent.textContent = chapter.analysis;
+        }
+        this.updateChapterStatus(container, chapter.status);
+    }
+
+    indexAnalysis(index) {
+        const chapter = this.chapters[index];
+        if (!chapter.bookId) return;
+        fetch('/search/docs', {
+            method: 'PUT',
+            headers: { 'Content-Type': 'application/json' },
+            body: JSON.stringify({
+                id: `analysis:${chapter.bookId}:${index}`,
+                type: 'analysis',
+                title: chapter.title,
+                text: chapter.analysis,
+                meta: { book_id: chapter.bookId, index }
+            })
+        }).catch(error => console.warn('拆解结果索引失败:', error));
+    }
+
+    async ensureChapterContent(index) {
+        const chapter = this.chapters[index];
+        if (!chapter || chapter.content || !chapter.bookId) return;
+
+        const response = await this.makeRequest(`/books/${chapter.bookId}/chapters/${index}`, { method: 'GET' });
+        const data = await response.json();
+        chapter.content = data.content;
+
+        const textarea = document.querySelector(`#${chapter.id} .iiwiozj`);
+        if (textarea) textarea.value = data.content;
+    }
+
     createChapterElement(title, content, index) {
         return new Promise((resolve) => {
             const container = document.createElement('div');
@@ -558,6 +698,11 @@ class BookSplitter {
 
             header.addEventListener('click', () => {
                 chapterContent.classList.toggle('show');
+                if (chapterContent.classList.contains('show')) {
+                    this.ensureChapterContent(index).catch(error => {
+                        this.showStatus(`章节内容加载失败: ${error.message}`, 'error');
+                    });
+                }
             });
 
             analyzeBtn.addEventListener('click', () => this.analyzeChapter(container, index));
@@ -608,15 +753,28 @@ async analyzeChapter(container, index, isRetry = false) {
     const basePrompt = document.getElementById('book-splitter-prompt')?.value || this.getDefaultPrompt();
 
     try {
-        // Construct the analysis prompt
-        const prompt = `\n\n章节标题：${chapter.title}\n\n章节内容：${chapter.content} \n\n${basePrompt}`;
-
-        // Make the API request with simplified body
-        const response = await this.makeRequest('/gen', {
-            method: 'POST',
-            headers: { 'Content-Type': 'application/json' },
-            body: JSON.stringify({ prompt })
-        });
+        // 由服务端拼接提示词；服务端导入的书籍只发送章节序号，正文由服务端读取
+        // 内容、提示词与模型都没变时直接返回已保存的结果，不再调用模型
+        // 章节拆解走批量车道，不占用聊天等交互请求的名额
+        const body = {
+            prompt: basePrompt,
+            title: chapter.title,
+            ...(chapter.bookId ? { book_id: chapter.bookId, index } : { content: chapter.content }),
+            lane: 'batch',
+            feature: 'splitter'
+        };
+        let response = await this.makeRequest('/analyses/chapter', await jsonRequest(body));
+        // 超出模型上下文的章节先在服务端分段概括，完成前返回 202，按 Retry-After 重新请求
+        while (response.status === 202) {
+            analysisContent.textContent = '章节较长，正在分段概括...';
+            await new Promise(resolve => setTimeout(resolve, Number(response.headers.get('Retry-After') || 5) * 1000));
+            response = await this.makeRequest('/analyses/chapter', await jsonRequest(body));
+        }
+        const cached = response.headers.get('X-Analysis-Cache') === 'hit';
+        const queuePosition = Number(response.headers.get('X-Queue-Position') || 0);
+        if (queuePosition > 0) {
+            analysisContent.textContent = `排队中（第 ${queuePosition} 位，预计等待约 ${Math.ceil(Number(response.headers.get('X-Queue-Wait') || 0))} 秒）...`;
+        }
 
         // Handle streaming response
         const reader = response.body.getReader();
@@ -633,11 +791,14 @@ async analyzeChapter(container, index, isRetry = false) {
 
         // Update chapter data and UI
         this.chapters[index].analysis = analysisText;
+        this.chapters[index].analysisKey = response.headers.get('X-Analysis-Key');
+        this.indexAnalysis(index);
         this.chapters[index].status = 'success';
         this.updateChapterStatus(container, 'success');
         this.saveToStorage();
         this.updateProgress();
         analyzeBtn.disabled = false;
+        return cached;
 
     } catch (error) {
         console.error('Analysis failed:', error);
@@ -652,6 +813,7 @@ async analyzeChapter(container, index, isRetry = false) {
 
 
     async analyzeAllChapters() {
+        await this.restoreCachedAnalyses();
         const unanalyzedChapters = this.chapters.filter(c => c.status !== 'success');
         if (unanalyzedChapters.length === 0) {
             this.showStatus('所有章节已分析完成', 'success');
@@ -668,14 +830,49 @@ async analyzeChapter(container, index, isRetry = false) {
             if (!container) continue;
 
             this.showStatus(`正在分析第 ${i + 1}/${this.chapters.length} 章`, 'info');
-            await this.analyzeChapter(container, i);
-            await new Promise(resolve => setTimeout(resolve, 1000)); // 添加延迟避免请求过快
+            const cached = await this.analyzeChapter(container, i);
+            if (!cached) await new Promise(resolve => setTimeout(resolve, 1000)); // 添加延迟避免请求过快
         }
 
         analyzeAllBtn.disabled = false;
         this.showStatus('全部分析完成', 'success');
     }
 
+    // 服务端分层摘要：超长章节分块概括，再逐层合并为剧情摘要与全书梗概；之前生成过的节点直接复用
+    async summarizeBook() {
+        const button = document.getElementById('book-splitter-summarize');
+        const output = document.getElementById('book-splitter-book-summary');
+        const stages = { chapters: '概括章节', merge: '合并超长章节', arcs: '概括剧情', sections: '合并剧情', book: '生成全书梗概' };
+        button.disabled = true;
+
+        try {
+            const bookId = this.chapters[0].bookId;
+            const response = await fetch('/summaries/runs', await jsonRequest(bookId
+                ? { book_id: bookId }
+                : { chapters: this.chapters.map(({ title, content }) => ({ title, content })) }));
+            let run = await response.json();
+            if (!response.ok) throw new Error(run.error || `HTTP error! status: ${response.status}`);
+
+            while (run.status === 'pending' || run.status === 'running') {
+                if (run.stage) {
+                    this.showStatus(`全书摘要：${stages[run.stage]} ${run.progress.done}/${run.progress.total}`, 'info');
+                }
+                await new Promise(resolve => setTimeout(resolve, this.CONFIG.SUMMARY_POLL_INTERVAL));
+                run = await (await this.makeRequest(`/summaries/runs/${run.run_id}`, { method: 'GET' })).json();
+            }
+            if (run.status !== 'done') throw new Error(run.error || run.status);
+
+            output.style.display = 'block';
+            output.textContent = [run.book, ...run.arcs.map(arc => `【第${arc.start + 1}至${arc.end}章】\n${arc.summary}`)].join('\n\n');
+            this.showStatus(`全书摘要完成（调用模型 ${run.calls} 次，复用 ${run.cached} 个已有结果）`, 'success');
+        } catch (error) {
+            console.error('全书摘要失败:', error);
+            this.showStatus(`全书摘要失败: ${error.message}`, 'error');
+        } finally {
+            button.disabled = false;
+        }
+    }
+
     async makeRequest(url, options, retries = 3) {
         try {
             const response = await fetch(url, options);
@@ -756,12 +953,14 @@ async analyzeChapter(container, index, isRetry = false) {
     enableButtons() {
         document.getElementById('book-splitter-split').disabled = false;
         document.getElementById('book-splitter-analyze-all').disabled = false;
+        document.getElementById('book-splitter-summarize').disabled = false;
         document.getElementById('book-splitter-export').disabled = false;
     }
 
     disableButtons() {
         document.getElementById('book-splitter-split').disabled = true;
         document.getElementById('book-splitter-analyze-all').disabled = true;
+        document.getElementById('book-splitter-summarize').disabled = true;
         document.getElementById('book-splitter-export').disabled = true;
     }
 
@@ -907,6 +1106,17 @@ this.updateChapterStatus(container, chapter.status || 'pending');
                 return;
             }
 
+            try {
+                this.showStatus('正在上传文件...', 'info');
+                const book = await this.importOnServer(file);
+                if (book) {
+                    await this.loadServerBook(book);
+                    return;
+                }
+            } catch (error) {
+                console.warn('服务端导入失败，改为浏览器内分割:', error);
+            }
+
             try {
                 this.showStatus('正在读取文件...', 'info');
                 const content = await this.tryReadFileWithEncodings(file);
@@ -935,6 +1145,14 @@ this.updateChapterStatus(container, chapter.status || 'pending');
             await this.analyzeAllChapters();
         });
 
+        document.getElementById('book-splitter-summarize')?.addEventListener('click', async () => {
+            if (this.chapters.length === 0) {
+                this.showStatus('请先导入并分割文本', 'error');
+                return;
+            }
+            await this.summarizeBook();
+        });
+
         // 导出和清除按钮
         document.getElementById('book-splitter-export')?.addEventListener('click', () => {
             if (this.chapters.length === 0) {
@@ -455,7 +455,7 @@ async function generateTitle() {
         const response = await fetch('/gen', {
             method: 'POST',
             headers: {'Content-Type': 'application/json'},
-            body: JSON.stringify({prompt})
+            body: JSON.stringify({prompt, task: 'title'})
         });
 
         const result = await handleStreamResponse(response, $('#genTitleResult')[0]);
@@ -482,7 +482,7 @@ async function generateSummary() {
         const response = await fetch('/gen', {
             method: 'POST',
             headers: {'Content-Type': 'application/json'},
-            body: JSON.stringify({prompt})
+            body: JSON.stringify({prompt, task: 'intro'})
         });
 
         const result = await handleStreamResponse(response, $('#genSummaryResult')[0]);
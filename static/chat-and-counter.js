@@ -709,13 +709,11 @@ bindEvents() {
 
     async processMessage(message) {
         try {
-            const response = await fetch('/gen', {
-                method: 'POST',
-                headers: { 'Content-Type': 'application/json' },
-                body: JSON.stringify({
-                    prompt: this.buildPromptWithContext(message)
-                })
-            });
+            const response = await fetch('/gen', await jsonRequest({
+                prompt: this.buildPromptWithContext(message),
+                feature: 'chat',
+                task: 'chat'
+            }));
 
             if (!response.ok) {
                 throw new Error(`API错误: ${response.status}`);
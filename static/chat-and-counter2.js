@@ -709,7 +709,9 @@ bindEvents() {
                 method: 'POST',
                 headers: { 'Content-Type': 'application/json' },
                 body: JSON.stringify({
-                    prompt: this.buildPromptWithContext(message)
+                    prompt: this.buildPromptWithContext(message),
+                    feature: 'chat',
+                    task: 'chat'
                 })
             });
 
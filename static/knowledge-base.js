@@ -10,6 +10,9 @@ class NovelKnowledgeBase {
             locations: [] // 地点空间
         };
         this.currentEditingItem = null;
+        // 已合并进知识库的提取结果的键，再次提取时跳过这些章节
+        this.extractedStorageKey = 'novelKnowledgeExtracted';
+        this.extractPollInterval = 2000;
         this.init();
     }
 
@@ -478,6 +481,7 @@ class NovelKnowledgeBase {
                     <div class="knowledge-search">
                         <input type="text" placeholder="搜索知识库...">
                     </div>
+                    <button class="btn btn-primary extract-button" onclick="knowledgeBase.extractFromAnalyses()">从拆书提取</button>
                     <button class="btn btn-primary" onclick="knowledgeBase.exportData()">导出数据</button>
                     <button class="btn btn-secondary" onclick="knowledgeBase.togglePanel()">关闭</button>
                 </div>
@@ -632,6 +636,31 @@ class NovelKnowledgeBase {
             return;
         }
 
+        // 优先使用服务端索引，请求失败时退回本地遍历
+        clearTimeout(this.searchTimer);
+        this.searchTimer = setTimeout(() => {
+            this.searchOnServer(keyword).catch(() => this.searchLocally(keyword));
+        }, 150);
+    }
+
+    async searchOnServer(keyword) {
+        const params = new URLSearchParams({ q: keyword, type: 'knowledge', limit: 50 });
+        const response = await fetch(`/search?${params}`);
+        if (!response.ok) throw new Error(`HTTP error! status: ${response.status}`);
+        const data = await response.json();
+
+        const results = [];
+        data.results.forEach(hit => {
+            const { category, name } = hit.meta;
+            const index = (this.data[category] || []).findIndex(item => item.name === name);
+            if (index !== -1) {
+                results.push({ ...this.data[category][index], type: category, index });
+            }
+        });
+        this.showSearchResults(results, keyword);
+    }
+
+    searchLocally(keyword) {
         const results = [];
         Object.entries(this.data).forEach(([type, items]) => {
             items.forEach((item, index) => {
@@ -695,6 +724,15 @@ class NovelKnowledgeBase {
 
     saveData() {
         localStorage.setItem('novelKnowledgeBase', JSON.stringify(this.data));
+        this.syncSearchIndex();
+    }
+
+    syncSearchIndex() {
+        fetch('/search/knowledge', {
+            method: 'PUT',
+            headers: { 'Content-Type': 'application/json' },
+            body: JSON.stringify(this.data)
+        }).catch(error => console.warn('知识库索引同步失败:', error));
     }
 
     loadData() {
@@ -707,6 +745,65 @@ class NovelKnowledgeBase {
                 alert('加载保存的数据时出错，将使用空数据开始');
             }
         }
+        this.syncSearchIndex();
+    }
+
+    async extractFromAnalyses() {
+        const splitter = window.bookSplitter;
+        const chapters = (splitter ? splitter.chapters : [])
+            .map((chapter, index) => ({ chapter, index }))
+            .filter(({ chapter }) => chapter.status === 'success' && chapter.analysis);
+        if (chapters.length === 0) {
+            alert('没有已完成拆解的章节，请先在拆书工具中拆解章节');
+            return;
+        }
+
+        const button = this.panel.querySelector('.extract-button');
+        const processed = JSON.parse(localStorage.getItem(this.extractedStorageKey) || '[]');
+        button.disabled = true;
+        try {
+            // 有拆书结果的键时由服务端读取已保存的拆解结果，不必重新上传
+            const response = await fetch('/knowledge/extractions', await jsonRequest({
+                chapters: chapters.map(({ chapter, index }) => chapter.analysisKey
+                    ? { index, title: chapter.title, key: chapter.analysisKey }
+                    : { index, title: chapter.title, analysis: chapter.analysis }),
+                processed
+            }));
+            let run = await response.json();
+            if (!response.ok) throw new Error(run.error || `HTTP error! status: ${response.status}`);
+
+            while (run.status === 'pending' || run.status === 'running') {
+                button.textContent = `提取中 ${run.progress.done}/${run.progress.total}`;
+                await new Promise(resolve => setTimeout(resolve, this.extractPollInterval));
+                const poll = await fetch(`/knowledge/extractions/${run.run_id}`);
+                if (!poll.ok) throw new Error(`HTTP error! status: ${poll.status}`);
+                run = await poll.json();
+            }
+            if (run.status === 'interrupted') throw new Error('提取任务被中断，请重试');
+            if (run.error) throw new Error(run.error);
+
+            // 提取期间知识库可能被编辑过，以当前数据为准合并
+            const merge = await fetch('/knowledge/merge', await jsonRequest({ knowledge: this.data, items: run.items }));
+            const result = await merge.json();
+            if (!merge.ok) throw new Error(result.error || `HTTP error! status: ${merge.status}`);
+
+            this.data = result.knowledge;
+            this.saveData();
+            this.updatePlotTextArea();
+            localStorage.setItem(this.extractedStorageKey, JSON.stringify([...new Set([...processed, ...run.processed])]));
+            const active = this.panel.querySelector('.nav-item.active');
+            this.switchTab(active ? active.dataset.type : 'characters');
+
+            let message = `提取完成：新增 ${result.added} 条，更新 ${result.updated} 条，跳过 ${run.skipped} 个已提取过的章节`;
+            if (run.errors.length) message += `；${run.errors.length} 章提取失败，再次提取时会重试`;
+            alert(message);
+        } catch (error) {
+            console.error('从拆书结果提取失败:', error);
+            alert(`从拆书结果提取失败: ${error.message}`);
+        } finally {
+            button.disabled = false;
+            button.textContent = '从拆书提取';
+        }
     }
 
     exportData() {
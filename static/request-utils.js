@@ -0,0 +1,20 @@
+// request-utils.js
+
+// 超过该大小的 JSON 请求体使用 gzip 压缩后发送（章节正文、完整对话等）
+const COMPRESS_THRESHOLD = 8 * 1024;
+
+// 生成 fetch 的请求参数；浏览器不支持 CompressionStream 时原样发送
+async function jsonRequest(data, method = 'POST') {
+    const body = JSON.stringify(data);
+    const headers = { 'Content-Type': 'application/json' };
+    if (body.length < COMPRESS_THRESHOLD || typeof CompressionStream === 'undefined') {
+        return { method, headers, body };
+    }
+
+    const stream = new Blob([body]).stream().pipeThrough(new CompressionStream('gzip'));
+    return {
+        method,
+        headers: { ...headers, 'Content-Encoding': 'gzip' },
+        body: await new Response(stream).arrayBuffer()
+    };
+}
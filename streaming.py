@@ -0,0 +1,212 @@
+"""
+流式路由的公共处理：客户端断开时关闭上游，超时与卡顿检测，并记录调用结果
+"""
+import logging
+import queue
+import threading
+import time
+from contextlib import closing, nullcontext
+
+from model_router import model_router
+from scheduler import scheduler
+from token_estimator import estimate_route_tokens
+from token_stats import token_stats
+from tracing import bind
+from usage_ledger import Usage, usage_ledger
+
+logger = logging.getLogger(__name__)
+
+# 单位为秒：connect 建立连接，first_token 等待首个输出，idle 相邻输出的最大间隔，total 整次生成
+DEFAULT_TIMEOUTS = {'connect': 10, 'first_token': 90, 'idle': 45, 'total': 900}
+ROUTE_TIMEOUTS = {
+    # 低成本模型首字通常更快
+    'gen2': {'first_token': 60},
+}
+# 尚未向客户端输出任何内容时，同一路由重试的次数，之后改用备用路由
+STALL_RETRIES = 1
+FALLBACK_ROUTES = {'gen': 'gen2'}
+
+
+class UpstreamTimeout(Exception):
+    pass
+
+
+def route_timeouts(route: str, overrides: dict = None) -> dict:
+    return {**DEFAULT_TIMEOUTS, **ROUTE_TIMEOUTS.get(route, {}), **(overrides or {})}
+
+
+def socket_timeout(route: str, overrides: dict = None) -> tuple:
+    """
+    传给 HTTP 客户端的 (连接超时, 读超时)。读超时只是兜底，防止半开连接让线程永久阻塞；
+    精确的首字/间隔/总时限由 with_deadlines 负责
+    """
+    timeouts = route_timeouts(route, overrides)
+    return timeouts['connect'], max(timeouts['first_token'], timeouts['idle'])
+
+
+def is_retryable(e: Exception) -> bool:
+    # requests 的连接/超时异常继承自 OSError；OpenAI SDK 另有自己的连接与超时异常
+    return isinstance(e, (UpstreamTimeout, OSError)) or \
+        type(e).__name__ in ('APIConnectionError', 'APITimeoutError')
+
+
+def with_deadlines(route: str, chunks, timeouts: dict, trace=None):
+    """
+    在后台线程中读取上游输出，按首字、间隔与总时限检查卡顿，超时抛出 UpstreamTimeout。
+    放弃读取后，后台线程在收到下一块输出（或触发读超时）时关闭上游。
+    trace 绑定到后台线程，上游调用中记录的阶段归入该请求；收到第一块正文时记录 first_token
+    """
+    items = queue.Queue()
+    stop = threading.Event()
+
+    def pump():
+        bind(trace)
+        try:
+            for chunk in chunks:
+                if stop.is_set():
+                    break
+                items.put(('chunk', chunk))
+            items.put(('done', None))
+        except Exception as e:
+            items.put(('error', e))
+        finally:
+            chunks.close()
+
+    threading.Thread(target=pump, name=f'upstream-{route}', daemon=True).start()
+    started = time.monotonic()
+    received = False
+    try:
+        while True:
+            wait = timeouts['idle'] if received else timeouts['first_token']
+            remaining = timeouts['total'] - (time.monotonic() - started)
+            try:
+                kind, value = items.get(timeout=max(0, min(wait, remaining)))
+            except queue.Empty:
+                if remaining <= wait:
+                    raise UpstreamTimeout(f"{route} 生成超过总时限 {timeouts['total']} 秒")
+                if received:
+                    raise UpstreamTimeout(f"{route} 上游已 {timeouts['idle']} 秒无输出")
+                raise UpstreamTimeout(f"{route} 上游 {timeouts['first_token']} 秒内未返回首个输出")
+            if kind == 'done':
+                return
+            if kind == 'error':
+                raise value
+            if not received and trace and not isinstance(value, Usage):
+                trace.mark('first_token')
+            received = True
+            yield value
+    finally:
+        stop.set()
+
+
+def resilient_stream(stream_completion, route: str, prompt: str, timeouts: dict = None,
+                     lane: str = 'batch', ticket=None, tags: dict = None, trace=None):
+    """
+    带时限的 stream_completion：尚未产出任何内容时遇到卡顿或连接错误会重试，再失败则改用备用路由；
+    已有输出后出错直接抛出，由调用方输出错误标记。
+    调用前在调度器中排队：ticket 为生成接口已准入的调用，未提供时按 lane 准入，超出额度抛出 QuotaExceeded。
+    上游产出的 Usage 不向下传递，每次尝试连同 tags（功能、项目、请求 ID）记入用量账本，
+    并计入调用次数与 token 额度（批量任务不经过 guard_stream，额度也在这里统计）；
+    提供 trace 时记录排队与每次尝试的耗时。每次尝试的首字延迟、输出速度与成败记入路由统计
+    """
+    routes = [route] * (STALL_RETRIES + 1)
+    if route in FALLBACK_ROUTES:
+        routes.append(FALLBACK_ROUTES[route])
+
+    if ticket is None:
+        ticket = scheduler.admit(lane)
+    try:
+        ticket.wait()
+        if trace and ticket.started:
+            trace.add_span('queue_wait', ticket.enqueued, ticket.started, lane=ticket.lane)
+        for attempt, current in enumerate(routes):
+            parts = []
+            usage = None
+            failed = False
+            finished = False
+            first = None
+            started = time.monotonic()
+            try:
+                deadlines = route_timeouts(current, timeouts)
+                span = trace.span('attempt', route=current, attempt=attempt + 1) if trace else nullcontext()
+                with span, closing(with_deadlines(current, stream_completion(current, prompt), deadlines, trace)) as chunks:
+                    for chunk in chunks:
+                        if isinstance(chunk, Usage):
+                            usage = chunk
+                            continue
+                        parts.append(chunk)
+                        first = first or time.monotonic()
+                        yield chunk
+                finished = True
+                return
+            except Exception as e:
+                failed = True
+                if parts or not is_retryable(e) or attempt == len(routes) - 1:
+                    raise
+                logger.warning(f"Upstream {current} failed before first chunk ({e}), retrying with {routes[attempt + 1]}")
+            finally:
+                seconds = time.monotonic() - started
+                # 没有任何输出的失败尝试不计入账本
+                if parts or usage:
+                    usage_ledger.record(current, prompt, ''.join(parts), usage, tags, seconds)
+                prompt_tokens = (usage and usage.prompt_tokens) or estimate_route_tokens(prompt, current)
+                completion = (usage and usage.completion_tokens) or estimate_route_tokens(''.join(parts), current)
+                # 既未完成也未出错的尝试是被调用方关闭的（客户端断开或任务取消）
+                token_stats.record_call(
+                    success=finished,
+                    response_time=seconds * 1000,
+                    tokens_used=prompt_tokens + completion,
+                    cancelled=not finished and not failed,
+                    prompt_tokens=prompt_tokens
+                )
+                # 首个输出前客户端就断开的尝试说明不了上游的快慢，不计入路由统计
+                if parts or failed:
+                    model_router.observe(current, first and first - started, seconds, completion, failed)
+    finally:
+        ticket.release()
+
+
+def default_error(e: Exception) -> str:
+    return f"Error: {str(e)}"
+
+
+def guard_stream(route: str, chunks, format_error=default_error, chunk_text=None, trace=None):
+    """
+    包装上游的流式输出。
+    客户端断开时 WSGI 服务器会关闭响应迭代器，这里收到 GeneratorExit 后立即关闭上游生成器
+    （其 finally 负责断开上游连接），并把本次调用记为 cancelled。
+    调用次数与 token 由 resilient_stream 按每次上游尝试统计，这里只记录客户端看到的结果；
+    chunk_text 从输出块中取出正文（如 NDJSON）。
+    WSGI 服务器写完一块才会取下一块，yield 所用的时间即向客户端输出的耗时，结束时记入 trace 的 client_flush
+    """
+    started = time.time()
+    outcome = 'success'
+    parts = []
+    first_write = None
+    flushing = 0.0
+    try:
+        for content in chunks:
+            parts.append(chunk_text(content) if chunk_text else content)
+            write_started = time.monotonic()
+            first_write = first_write or write_started
+            yield content
+            flushing += time.monotonic() - write_started
+    except GeneratorExit:
+        outcome = 'cancelled'
+        logger.info(f"Client disconnected from {route}, closing upstream stream")
+        raise
+    except Exception as e:
+        outcome = 'error'
+        logger.error(f"Error in generate_stream: {e}")
+        if trace:
+            trace.attrs['error'] = str(e)
+        yield format_error(e)
+    finally:
+        close = getattr(chunks, 'close', None)
+        if close:
+            close()
+        if trace:
+            if first_write:
+                trace.add_span('client_flush', first_write, blocked=round(flushing * 1000, 1), chunks=len(parts))
+            trace.finish(outcome, chars=sum(len(p) for p in parts))
+        token_stats.record_request(outcome, (time.time() - started) * 1000)
@@ -0,0 +1,371 @@
+"""
+整本书与超长章节的分层摘要（map-reduce）
+
+超出模型 token 预算的章节按段落切块，各块并行概括后合并为章节摘要；
+章节摘要每 arc_size 章合并为一段剧情（arc）摘要，剧情摘要再逐层合并，直到得出全书梗概与结构分析。
+每次模型调用以（填充后的提示词、模型）的哈希为键缓存在 data/summaries/cache/ 下，
+修改某一章后重新运行，只有该章到全书梗概这一条路径上的节点需要重新生成。
+"""
+import hashlib
+import logging
+import os
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+
+from flask import Blueprint, current_app, request
+
+from books import book_store
+from common import DATA_DIR, BackgroundRun, ResultStore, RunRegistry, complete_text, int_field, json_response
+from pipeline import fill_template
+from prompt_registry import prompt_limit
+from request_body import read_json
+from token_estimator import OUTPUT_RESERVE, context_window, estimate_route_tokens, route_models
+
+logger = logging.getLogger(__name__)
+
+summary_bp = Blueprint('summary', __name__)
+
+SUMMARY_DIR = os.path.join(DATA_DIR, 'summaries')
+RUNS_DIR = os.path.join(SUMMARY_DIR, 'runs')
+DEFAULT_ROUTE = 'gen2'
+DEFAULT_ARC_SIZE = 10
+MAX_ARC_SIZE = 50
+DEFAULT_CONCURRENCY = 3
+MAX_CONCURRENCY = 8
+# 模型窗口再大，每块也不超过该 token 数，块太大时概括会丢失细节
+MAX_CHUNK_TOKENS = 8000
+# 为提示词中的说明文字预留的 token 数
+INSTRUCTION_TOKENS = 500
+
+CHAPTER_PROMPT = """请用不超过300字概括以下章节（${title}）的主要情节、人物变化与伏笔，只输出概要本身：
+
+${text}"""
+
+CHUNK_PROMPT = """以下是章节（${title}）的第 ${part}/${parts} 部分。请用不超过300字概括这一部分的情节、出场人物与关键信息，只输出概要本身：
+
+${text}"""
+
+MERGE_CHUNKS_PROMPT = """以下是同一章节（${title}）各部分的概要，按顺序排列。请合并为一段不超过400字的章节概要，保留主要情节、人物变化与伏笔，只输出概要本身：
+
+${text}"""
+
+ARC_PROMPT = """以下是小说连续若干章（${span}）的概要，按顺序排列。请概括这一段剧情的主线进展、人物关系变化、冲突与埋下的伏笔，不超过600字，只输出概要本身：
+
+${text}"""
+
+BOOK_PROMPT = """以下是一部小说从头到尾各段剧情的概要，按顺序排列。请输出：
+1. 全书梗概（不超过800字）
+2. 结构分析：故事分为哪几个阶段、各阶段的起承转合与核心冲突
+3. 主要人物的成长弧线
+4. 贯穿全书的伏笔与呼应
+
+${text}"""
+
+
+def prompt_budget(route: str) -> int:
+    """
+    路由可用的提示词 token 数：上下文窗口减去输出预留，且不超过该路由的输入上限
+    """
+    return prompt_limit(route) or context_window(route) - OUTPUT_RESERVE
+
+
+def split_text(text: str, route: str, limit: int) -> list:
+    """
+    按段落切成不超过 limit tokens 的块，超长的段落按字数再切开
+    """
+    chunks, current, size = [], [], 0
+    for paragraph in text.split('\n'):
+        tokens = estimate_route_tokens(paragraph, route)
+        if tokens > limit:
+            step = max(1, len(paragraph) * limit // tokens)
+            pieces = [paragraph[i:i + step] for i in range(0, len(paragraph), step)]
+        else:
+            pieces = [paragraph]
+        for piece in pieces:
+            piece_tokens = tokens if len(pieces) == 1 else estimate_route_tokens(piece, route)
+            if current and size + piece_tokens > limit:
+                chunks.append('\n'.join(current))
+                current, size = [], 0
+            current.append(piece)
+            size += piece_tokens
+    if current:
+        chunks.append('\n'.join(current))
+    return chunks
+
+
+summary_store = ResultStore(os.path.join(SUMMARY_DIR, 'cache'))
+
+
+class Summarizer:
+    """
+    带缓存的概括调用；calls、cached 分别统计实际调用模型与命中缓存的次数
+    """
+
+    def __init__(self, stream_completion, route: str = DEFAULT_ROUTE, store: ResultStore = summary_store):
+        self.stream_completion = stream_completion
+        self.route = route
+        self.model = route_models.get(route, route)
+        self.store = store
+        self.budget = prompt_budget(route) - INSTRUCTION_TOKENS
+        self.chunk_tokens = min(self.budget, MAX_CHUNK_TOKENS)
+        self.lock = threading.Lock()
+        self.calls = 0
+        self.cached = 0
+
+    def tokens(self, text: str) -> int:
+        return estimate_route_tokens(text, self.route)
+
+    def complete(self, template: str, **variables) -> str:
+        prompt = fill_template(template, variables)
+        key = hashlib.sha256(f'{self.model}\0{prompt}'.encode('utf-8')).hexdigest()
+        record = self.store.get(key)
+        if record is not None:
+            with self.lock:
+                self.cached += 1
+            return record['summary']
+        summary = complete_text(self.stream_completion, self.route, prompt).strip()
+        self.store.put(key, {'summary': summary, 'model': self.model, 'created': time.time()})
+        with self.lock:
+            self.calls += 1
+        return summary
+
+    def chunks(self, content: str) -> list:
+        """
+        章节正文放得下时返回 [正文]，否则返回切好的块
+        """
+        if self.tokens(content) <= self.chunk_tokens:
+            return [content]
+        return split_text(content, self.route, self.chunk_tokens)
+
+    def summarize_part(self, title: str, chunks: list, part: int) -> str:
+        if len(chunks) == 1:
+            return self.complete(CHAPTER_PROMPT, title=title, text=chunks[0])
+        return self.complete(CHUNK_PROMPT, title=title, part=str(part + 1), parts=str(len(chunks)), text=chunks[part])
+
+    def reduce(self, template: str, items: list, **variables) -> str:
+        """
+        把按顺序排列的若干摘要合并为一段：放不进预算时先分组合并，再合并各组的结果
+        """
+        text = '\n\n'.join(items)
+        if self.tokens(text) <= self.budget or len(items) == 1:
+            return self.complete(template, text=text, **variables)
+        groups, current, size = [], [], 0
+        for item in items:
+            tokens = self.tokens(item)
+            if current and size + tokens > self.budget:
+                groups.append(current)
+                current, size = [], 0
+            current.append(item)
+            size += tokens
+        groups.append(current)
+        if len(groups) == 1:
+            # 单条就超出预算，只能原样交给模型
+            return self.complete(template, text=text, **variables)
+        return self.reduce(template, [self.complete(template, text='\n\n'.join(g), **variables) for g in groups],
+                           **variables)
+
+    def chapter(self, title: str, content: str, pool: ThreadPoolExecutor) -> str:
+        """
+        单章摘要，超长章节的各块在 pool 中并行概括；不能在 pool 的工作线程中调用
+        """
+        chunks = self.chunks(content)
+        parts = list(pool.map(partial(self.summarize_part, title, chunks), range(len(chunks))))
+        return self.merge_parts(title, parts)
+
+    def merge_parts(self, title: str, parts: list) -> str:
+        return parts[0] if len(parts) == 1 else self.reduce(MERGE_CHUNKS_PROMPT, parts, title=title)
+
+
+def condense_chapter(stream_completion, title: str, content: str, route: str = DEFAULT_ROUTE,
+                     concurrency: int = DEFAULT_CONCURRENCY) -> str:
+    """
+    把超出上下文的章节压缩为分段概括后的章节摘要，供拆解等需要整章输入的功能使用
+    """
+    with ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix='condense') as pool:
+        return Summarizer(stream_completion, route).chapter(title, content, pool)
+
+
+def chapter_label(index: int, title: str) -> str:
+    return title or f'第{index + 1}章'
+
+
+class SummaryRun(BackgroundRun):
+    """
+    按层推进：chapters 各章（超长章节为各块）→ merge 合并超长章节的块 → arcs 剧情 → sections 逐层合并 → book 全书；
+    同一层的节点并行生成，每层结束后写入检查点
+    """
+
+    root = RUNS_DIR
+
+    def __init__(self, run_id: str, spec: dict, state: dict = None):
+        super().__init__(run_id, spec, state or {
+            'status': 'pending',
+            'stage': None,
+            'done': 0,
+            'total': 0,
+            'calls': 0,
+            'cached': 0,
+            'error': '',
+            'created': time.time(),
+            'updated': time.time(),
+            'chapters': [],
+            'arcs': [],
+            'book': ''
+        })
+
+    def start(self, stream_completion, chapters: list):
+        # 用量账本中以任务 ID 作为请求 ID，汇总整本书摘要的消耗
+        stream_completion = partial(stream_completion, tags={'feature': 'summary', 'request_id': self.run_id})
+        self.thread = threading.Thread(target=self.run, args=(stream_completion, chapters), daemon=True)
+        self.thread.start()
+
+    def _stage(self, pool, summarizer, stage: str, func, items: list) -> list:
+        with self.lock:
+            self.state.update(stage=stage, done=0, total=len(items))
+
+        def task(item):
+            result = func(item)
+            with self.lock:
+                self.state['done'] += 1
+                self.state.update(calls=summarizer.calls, cached=summarizer.cached)
+            return result
+
+        results = list(pool.map(task, items))
+        self.checkpoint()
+        return results
+
+    def run(self, stream_completion, chapters: list):
+        self.state['status'] = 'running'
+        self.state['pid'] = os.getpid()
+        self.checkpoint()
+        summarizer = Summarizer(stream_completion, self.spec['route'])
+        arc_size = self.spec['arc_size']
+        try:
+            with ThreadPoolExecutor(max_workers=self.spec['concurrency'],
+                                    thread_name_prefix=f'summary-{self.run_id}') as pool:
+                # 所有章节的块一起排队，超长章节的各块与其他章节并行
+                chunks = [summarizer.chunks(c['content']) for c in chapters]
+                parts = [(i, part) for i, c in enumerate(chunks) for part in range(len(c))]
+                results = self._stage(pool, summarizer, 'chapters',
+                                      lambda p: summarizer.summarize_part(chapters[p[0]]['title'], chunks[p[0]], p[1]),
+                                      parts)
+                partials = [[] for _ in chapters]
+                for (i, _), summary in zip(parts, results):
+                    partials[i].append(summary)
+
+                summaries = self._stage(pool, summarizer, 'merge',
+                                        lambda i: summarizer.merge_parts(chapters[i]['title'], partials[i]),
+                                        list(range(len(chapters))))
+                self.state['chapters'] = [
+                    {'index': i, 'title': c['title'], 'chunks': len(chunks[i]), 'summary': summaries[i]}
+                    for i, c in enumerate(chapters)
+                ]
+
+                # 固定每 arc_size 章一组：修改一章只影响所在的一组
+                arcs = [(start, min(start + arc_size, len(chapters))) for start in range(0, len(chapters), arc_size)]
+                arc_summaries = self._stage(pool, summarizer, 'arcs', lambda arc: summarizer.reduce(
+                    ARC_PROMPT,
+                    [f"{chapter_label(i, chapters[i]['title'])}：{summaries[i]}" for i in range(*arc)],
+                    span=f'第{arc[0] + 1}至{arc[1]}章'
+                ), arcs)
+                self.state['arcs'] = [
+                    {'start': start, 'end': end, 'summary': summary}
+                    for (start, end), summary in zip(arcs, arc_summaries)
+                ]
+
+                level = [(start, end, f'第{start + 1}至{end}章：{summary}')
+                         for (start, end), summary in zip(arcs, arc_summaries)]
+                while len(level) > arc_size:
+                    groups = [level[i:i + arc_size] for i in range(0, len(level), arc_size)]
+                    merged = self._stage(pool, summarizer, 'sections', lambda group: summarizer.reduce(
+                        ARC_PROMPT, [item for _, _, item in group], span=f'第{group[0][0] + 1}至{group[-1][1]}章'
+                    ), groups)
+                    level = [(group[0][0], group[-1][1], f'第{group[0][0] + 1}至{group[-1][1]}章：{summary}')
+                             for group, summary in zip(groups, merged)]
+
+                book = self._stage(pool, summarizer, 'book',
+                                   lambda items: summarizer.reduce(BOOK_PROMPT, items), [[item for _, _, item in level]])
+                self.state['book'] = book[0]
+                self.state['status'] = 'done'
+        except Exception as e:
+            # 已生成的节点都在缓存中，重新运行时从失败处继续
+            logger.error(f"Summary run {self.run_id} failed at {self.state['stage']}: {e}")
+            self.state.update(status='error', error=str(e))
+        self.state.update(calls=summarizer.calls, cached=summarizer.cached)
+        self.final_checkpoint()
+        logger.info(f"Summary run {self.run_id} finished with status {self.state['status']} "
+                    f"({summarizer.calls} calls, {summarizer.cached} cached)")
+
+    def to_dict(self, include_chapters: bool = False) -> dict:
+        with self.lock:
+            data = {
+                'run_id': self.run_id,
+                'status': self.state['status'],
+                'stage': self.state['stage'],
+                'progress': {'done': self.state['done'], 'total': self.state['total']},
+                'calls': self.state['calls'],
+                'cached': self.state['cached'],
+                'error': self.state['error'],
+                'created': self.state['created'],
+                'updated': self.state['updated'],
+                'book': self.state['book'],
+                'arcs': list(self.state['arcs'])
+            }
+            if include_chapters:
+                data['chapters'] = list(self.state['chapters'])
+            return data
+
+
+runs = RunRegistry(SummaryRun)
+get_run = runs.get
+
+
+@summary_bp.route('/summaries/runs', methods=['POST'])
+def create_summary_run():
+    """
+    请求: {book_id | chapters: [{title, content}], route?, arc_size?, concurrency?}
+    """
+    data = read_json()
+    route = data.get('route') or DEFAULT_ROUTE
+    if not isinstance(route, str) or route not in route_models:
+        return json_response({'error': f'不支持的路由: {route}'}, 400)
+    try:
+        arc_size = int_field(data, 'arc_size', DEFAULT_ARC_SIZE, 2, MAX_ARC_SIZE)
+        concurrency = int_field(data, 'concurrency', DEFAULT_CONCURRENCY, 1, MAX_CONCURRENCY)
+    except ValueError as e:
+        return json_response({'error': str(e)}, 400)
+
+    if data.get('book_id'):
+        try:
+            chapters = [{'title': c['title'], 'content': c['content']} for c in book_store.iter_chapters(data['book_id'])]
+        except KeyError:
+            return json_response({'error': '书籍不存在'}, 404)
+    else:
+        chapters = [{'title': c.get('title', ''), 'content': c['content']}
+                    for c in data.get('chapters') or [] if isinstance(c, dict) and c.get('content')]
+    if not chapters:
+        return json_response({'error': '缺少章节内容'}, 400)
+
+    spec = {
+        'book_id': data.get('book_id'),
+        'chapters': len(chapters),
+        'route': route,
+        'arc_size': arc_size,
+        'concurrency': concurrency
+    }
+    run = SummaryRun(uuid.uuid4().hex[:16], spec)
+    runs.add(run)
+    run.checkpoint()
+    run.start(current_app.extensions['stream_completion'], chapters)
+    return json_response(run.to_dict(), 202)
+
+
+@summary_bp.route('/summaries/runs/<run_id>', methods=['GET'])
+def get_summary_run(run_id):
+    run = get_run(run_id)
+    if run is None:
+        return json_response({'error': '任务不存在'}, 404)
+    return json_response(run.to_dict(include_chapters=request.args.get('chapters') == '1'))
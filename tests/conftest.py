@@ -0,0 +1,8 @@
+import os
+import sys
+import tempfile
+
+# 统计、账本与检索索引写入临时目录；须在导入 common 之前设置
+os.environ.setdefault('NOVEL_DATA_DIR', tempfile.mkdtemp(prefix='novel-tests-'))
+os.environ.setdefault('NOVEL_ACCESS_LOG', '0')
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,62 @@
+"""
+以 fast 模式回放 tests/cassettes 中录制的上游响应，经由各后端的解析与 resilient_stream 检查输出
+"""
+import os
+import time
+
+import pytest
+
+from cassettes import Cassette, bench, store
+from serve import BASE_DIR, load_module
+from streaming import resilient_stream
+from usage_ledger import Usage
+
+CASSETTES = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'cassettes')
+PROMPT = '续写：林黛玉初进贾府'
+
+CASES = [
+    ('app-claude.py', 'claude/messages-stream.cassette',
+     '黛玉方进入房时，只见两个人搀着一位鬓发如银的老母迎上来。', ('claude-3-sonnet-20240229', 21, 38)),
+    ('app-deepseek.py', 'deepseek/chat-stream.cassette',
+     '宝玉听了，忙起身笑道：“这个妹妹我曾见过的。”', ('deepseek-chat', 15, 17)),
+    ('app-ollama.py', 'ollama/generate-stream.cassette',
+     '刘姥姥一进荣国府，看什么都新鲜。', ('qwen2.5:14b', 19, 14)),
+]
+
+
+def replay(app_file: str, cassette: str):
+    """
+    指定回放的 cassette 后加载后端；后端在导入时按回放模式创建上游会话
+    """
+    path = os.path.join(CASSETTES, cassette)
+    store.force(path, fast=True)
+    return load_module(os.path.join(BASE_DIR, 'apps', app_file)), path
+
+
+@pytest.mark.parametrize('app_file, cassette, text, usage', CASES)
+def test_backend_parses_recorded_stream(app_file, cassette, text, usage):
+    backend, _ = replay(app_file, cassette)
+    items = list(backend.stream_completion('gen', PROMPT))
+    chunks = [item for item in items if isinstance(item, str)]
+    usages = [item for item in items if isinstance(item, Usage)]
+    assert ''.join(chunks) == text
+    assert len(chunks) > 1
+    assert [(u.model, u.prompt_tokens, u.completion_tokens) for u in usages] == [usage]
+
+
+@pytest.mark.parametrize('app_file, cassette, text, usage', CASES)
+def test_resilient_stream_replays_without_delays(app_file, cassette, text, usage):
+    backend, path = replay(app_file, cassette)
+    started = time.monotonic()
+    output = ''.join(resilient_stream(backend.stream_completion, 'gen', PROMPT, lane='interactive',
+                                      tags={'feature': 'test'}))
+    assert output == text
+    assert time.monotonic() - started < Cassette.load(path).duration
+
+
+def test_bench_reports_replayed_output():
+    _, path = replay('app-claude.py', 'claude/messages-stream.cassette')
+    result = bench(os.path.join(BASE_DIR, 'apps', 'app-claude.py'), path, fast=True, repeat=3)
+    assert result['runs'] == 3
+    assert result['chars'] == len(CASES[0][2])
+    assert result['total_median'] < result['recorded_duration']
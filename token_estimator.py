@@ -0,0 +1,115 @@
+"""
+离线 token 估算：按字符类别（汉字、拉丁字母、数字、标点符号、换行）分别计数，
+再乘以各模型家族分词器的换算比例。各类字符用正则整体统计，百万字的文本也只需扫描几遍。
+
+比例参考各家文档给出的换算关系（如 DeepSeek：1 个汉字约 0.6 token，1 个英文字符约 0.3 token；
+通义千问：1 token 约 1.5～1.8 个汉字），用于统计、额度与上下文长度判断，不追求与计费完全一致。
+"""
+import math
+import re
+
+# 中日韩统一表意文字、假名与韩文音节
+CJK_PATTERN = re.compile(r'[぀-ヿ㐀-䶿一-鿿가-힯豈-﫿]+')
+LATIN_PATTERN = re.compile(r'[A-Za-z]+')
+DIGIT_PATTERN = re.compile(r'[0-9]+')
+SPACE_PATTERN = re.compile(r'\s+')
+
+# 每个字符对应的 token 数；latin 为每个字母，单个英文单词至少计 1 个 token
+FAMILIES = {
+    'default':  {'cjk': 1.0,  'latin': 0.3,  'digit': 0.5,  'other': 1.0, 'newline': 1.0},
+    'gpt':      {'cjk': 1.1,  'latin': 0.25, 'digit': 0.34, 'other': 0.8, 'newline': 0.5},  # cl100k
+    'gpt-4o':   {'cjk': 0.75, 'latin': 0.25, 'digit': 0.34, 'other': 0.7, 'newline': 0.5},  # o200k
+    'claude':   {'cjk': 1.2,  'latin': 0.27, 'digit': 0.34, 'other': 0.9, 'newline': 0.5},
+    'gemini':   {'cjk': 0.8,  'latin': 0.25, 'digit': 1.0,  'other': 0.7, 'newline': 0.5},
+    'qwen':     {'cjk': 0.65, 'latin': 0.27, 'digit': 1.0,  'other': 0.7, 'newline': 0.5},
+    'deepseek': {'cjk': 0.6,  'latin': 0.3,  'digit': 0.5,  'other': 0.7, 'newline': 0.5},
+    'ernie':    {'cjk': 0.77, 'latin': 0.3,  'digit': 0.5,  'other': 0.8, 'newline': 0.5},
+    'doubao':   {'cjk': 0.65, 'latin': 0.3,  'digit': 0.5,  'other': 0.7, 'newline': 0.5},
+}
+
+# 每个字符最多对应的 token 数（单字母单词计 1 个），用于快速判断明显未超限的文本
+MAX_TOKENS_PER_CHAR = max(1.0, *(max(rates.values()) for rates in FAMILIES.values()))
+
+# 模型名称中的关键字 -> 家族，按顺序匹配
+MODEL_FAMILIES = [
+    ('gpt-4o', 'gpt-4o'), ('gpt', 'gpt'),
+    ('claude', 'claude'), ('gemini', 'gemini'), ('qwen', 'qwen'),
+    ('deepseek', 'deepseek'), ('ernie', 'ernie'), ('doubao', 'doubao'),
+]
+
+# 路由 -> 模型名称，由各后端在 init_app 时登记
+route_models = {}
+
+# 为输出预留的 token 数，提示词加上它仍放得下才算合适
+OUTPUT_RESERVE = 4096
+
+# 上下文窗口（tokens），按模型名称中的关键字顺序匹配
+CONTEXT_WINDOWS = [
+    ('128k', 128000), ('32k', 32000),
+    ('gpt-4o', 128000), ('gpt-4-turbo', 128000), ('gpt-4', 8192), ('gpt-3.5', 16385),
+    ('claude', 200000),
+    ('gemini', 1000000),
+    ('qwen-long', 10000000), ('qwen-turbo', 1000000), ('qwen-plus', 131072), ('qwen', 32768),
+    ('deepseek', 64000),
+    ('ernie', 8192),
+    ('doubao', 32768),
+]
+DEFAULT_CONTEXT_WINDOW = 8192
+# 按完整模型名称指定的上下文窗口，优先于 CONTEXT_WINDOWS，由各后端登记（如本地模型的 num_ctx）
+context_windows = {}
+
+
+def context_window(model: str) -> int:
+    if model in context_windows:
+        return context_windows[model]
+    name = (model or '').lower()
+    for keyword, window in CONTEXT_WINDOWS:
+        if keyword in name:
+            return window
+    return DEFAULT_CONTEXT_WINDOW
+
+
+def family_for(model: str = None) -> str:
+    name = (model or '').lower()
+    for keyword, family in MODEL_FAMILIES:
+        if keyword in name:
+            return family
+    return 'default'
+
+
+def count_chars(text: str) -> dict:
+    """
+    按类别统计字符数；latin_words 为英文单词个数
+    """
+    cjk = sum(map(len, CJK_PATTERN.findall(text)))
+    latin_words = LATIN_PATTERN.findall(text)
+    latin = sum(map(len, latin_words))
+    digit = sum(map(len, DIGIT_PATTERN.findall(text)))
+    space = sum(map(len, SPACE_PATTERN.findall(text)))
+    return {
+        'cjk': cjk,
+        'latin': latin,
+        'latin_words': len(latin_words),
+        'digit': digit,
+        'newline': text.count('\n'),
+        'other': len(text) - cjk - latin - digit - space
+    }
+
+
+def estimate_tokens(text: str, model: str = None) -> int:
+    if not text:
+        return 0
+    rates = FAMILIES[family_for(model)]
+    counts = count_chars(text)
+    tokens = (
+        counts['cjk'] * rates['cjk']
+        + max(counts['latin_words'], counts['latin'] * rates['latin'])
+        + counts['digit'] * rates['digit']
+        + counts['other'] * rates['other']
+        + counts['newline'] * rates['newline']
+    )
+    return math.ceil(tokens)
+
+
+def estimate_route_tokens(text: str, route: str = None) -> int:
+    return estimate_tokens(text, route_models.get(route))
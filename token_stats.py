@@ -0,0 +1,144 @@
+from datetime import datetime
+
+from flask import Blueprint
+
+from common import json_response
+from shared_state import shared_state
+
+stats_bp = Blueprint('stats', __name__)
+
+# 平均耗时与平均用量按最近多少次调用计算
+RECENT_CALLS = 100
+
+
+class TokenStats:
+    """
+    计数保存在共享状态中，多个 worker 进程的调用合并统计；
+    按日、按月的调用次数以日期为键累加，跨天跨月时自然归零。
+    调用次数与 token 按上游调用（含重试与批量任务）统计，生成接口的请求结果另外计数
+    """
+
+    def __init__(self, state=shared_state):
+        self.state = state
+        self.total_tokens = 1000000
+        self.daily_limit = 10000
+        self.monthly_limit = 200000
+
+    @staticmethod
+    def period_keys(now: datetime = None) -> tuple:
+        now = now or datetime.now()
+        return f'calls:day:{now:%Y-%m-%d}', f'calls:month:{now:%Y-%m}'
+
+    def record_call(self, success=True, response_time=0, tokens_used=0, cancelled=False, prompt_tokens=0):
+        """
+        cancelled 表示客户端中途断开，单独计数，不计入成功率；
+        tokens_used 为提示词与输出的合计，其中提示词部分为 prompt_tokens
+        """
+        now = datetime.now()
+        day_key, month_key = self.period_keys(now)
+        counters = {day_key: 1, month_key: 1, 'calls:total': 1}
+        if cancelled:
+            counters['calls:cancelled'] = 1
+        elif success:
+            counters['calls:success'] = 1
+        if tokens_used > 0:
+            counters['tokens:used'] = tokens_used
+        if prompt_tokens > 0:
+            counters['tokens:prompt'] = prompt_tokens
+
+        with self.state.transaction() as conn:
+            self.state.add_counters(conn, counters)
+            self.state.set_value(conn, 'last_call_time', now.isoformat())
+            self.state.push_sample(conn, 'response_time', response_time, RECENT_CALLS)
+            if tokens_used > 0:
+                self.state.push_sample(conn, 'token_usage', tokens_used, RECENT_CALLS)
+
+    def record_request(self, outcome: str, response_time: float = 0):
+        """
+        记录一次生成接口请求的结果（success、error 或 cancelled）与客户端看到的总耗时
+        """
+        with self.state.transaction() as conn:
+            self.state.add_counters(conn, {'requests:total': 1, f'requests:{outcome}': 1})
+            self.state.push_sample(conn, 'request_time', response_time, RECENT_CALLS)
+
+    def snapshot(self) -> dict:
+        day_key, month_key = self.period_keys()
+        counters = self.state.counters([day_key, month_key, 'calls:total', 'calls:success',
+                                        'calls:cancelled', 'tokens:used', 'tokens:prompt'])
+        return {
+            'today_calls': int(counters[day_key]),
+            'month_calls': int(counters[month_key]),
+            'total_count': int(counters['calls:total']),
+            'success_count': int(counters['calls:success']),
+            'cancelled_count': int(counters['calls:cancelled']),
+            'tokens_used': int(counters['tokens:used']),
+            'prompt_tokens': int(counters['tokens:prompt'])
+        }
+
+    @property
+    def today_calls(self):
+        return self.snapshot()['today_calls']
+
+    @property
+    def month_calls(self):
+        return self.snapshot()['month_calls']
+
+    @property
+    def remaining_tokens(self):
+        return max(0, self.total_tokens - self.snapshot()['tokens_used'])
+
+    @property
+    def avg_response_time(self):
+        response_times = self.state.samples('response_time')
+        return sum(response_times) / len(response_times) if response_times else 0
+
+    @property
+    def avg_token_usage(self):
+        token_usages = self.state.samples('token_usage')
+        return int(sum(token_usages) / len(token_usages)) if token_usages else 0
+
+    @property
+    def avg_request_time(self):
+        request_times = self.state.samples('request_time')
+        return sum(request_times) / len(request_times) if request_times else 0
+
+    def request_counts(self) -> dict:
+        counters = self.state.counters([f'requests:{k}' for k in ('total', 'success', 'error', 'cancelled')])
+        return {key.split(':', 1)[1]: int(value) for key, value in counters.items()}
+
+    @staticmethod
+    def compute_success_rate(counts: dict) -> float:
+        finished = counts['total_count'] - counts['cancelled_count']
+        return counts['success_count'] / finished if finished > 0 else 1.0
+
+    @property
+    def success_rate(self):
+        return self.compute_success_rate(self.snapshot())
+
+    def to_dict(self):
+        counts = self.snapshot()
+        return {
+            "remaining_tokens": max(0, self.total_tokens - counts['tokens_used']),
+            "total_tokens": self.total_tokens,
+            "today_calls": counts['today_calls'],
+            "daily_limit": self.daily_limit,
+            "month_calls": counts['month_calls'],
+            "monthly_limit": self.monthly_limit,
+            "last_call_time": self.state.get_value('last_call_time'),
+            "avg_response_time": self.avg_response_time,
+            "success_rate": self.compute_success_rate(counts),
+            "cancelled_count": counts['cancelled_count'],
+            "avg_token_usage": self.avg_token_usage,
+            "prompt_tokens": counts['prompt_tokens'],
+            "completion_tokens": counts['tokens_used'] - counts['prompt_tokens'],
+            "requests": self.request_counts(),
+            "avg_request_time": self.avg_request_time
+        }
+
+
+token_stats = TokenStats()
+
+
+@stats_bp.route('/api-stats', methods=['GET'])
+def api_stats():
+    return json_response(token_stats.to_dict())
@@ -0,0 +1,238 @@
+"""
+生成请求的耗时追踪
+
+每次 /gen、/gen2 调用对应一条 Trace，以请求 ID（X-Request-Id 请求头，没有时生成，并在响应头中返回）标识，
+记录请求体解析、排队、获取凭证、连接上游、首字节、首个 token、每次尝试（重试）与向客户端输出等阶段。
+结束的 Trace 保存在进程内的环形缓冲中，可在仪表盘或 /traces 接口查看；
+设置 NOVEL_TRACE_EXPORT=1 时另外逐条追加到 data/traces/<日期>.jsonl。
+多进程部署时每个 worker 只保存自己处理的请求，导出文件包含全部 worker 的记录。
+
+上游调用在 with_deadlines 的后台线程中进行，该线程绑定当前 Trace，
+后端代码通过模块级的 span() / first_byte() 记录阶段，没有绑定 Trace 时不做任何事
+"""
+import contextlib
+import json
+import logging
+import os
+import threading
+import time
+import uuid
+from collections import deque
+from contextvars import ContextVar
+from datetime import datetime
+
+from flask import Blueprint, g, has_request_context, request
+
+from common import DATA_DIR, ensure_dir, json_response
+from shared_state import file_lock
+
+logger = logging.getLogger(__name__)
+
+traces_bp = Blueprint('traces', __name__)
+
+BUFFER_SIZE = 500
+EXPORT_DIR = os.path.join(DATA_DIR, 'traces')
+
+current_trace = ContextVar('current_trace', default=None)
+
+
+def request_id() -> str:
+    """
+    当前请求的 ID：取自 X-Request-Id 请求头，没有时生成；同一请求内多次调用返回相同的值
+    """
+    if not has_request_context():
+        return uuid.uuid4().hex
+    if 'request_id' not in g:
+        g.request_id = request.headers.get('X-Request-Id') or uuid.uuid4().hex
+    return g.request_id
+
+
+def add_request_id_header(response):
+    """
+    after_request：把请求 ID 写入响应头，用户反馈问题时可据此查找 Trace 与用量明细
+    """
+    if 'request_id' in g:
+        response.headers['X-Request-Id'] = g.request_id
+    return response
+
+
+class Trace:
+    """
+    span 的 start 为相对请求开始的毫秒数；duration 为 0 的 span 表示时间点（如首字节、首个 token）
+    """
+
+    def __init__(self, trace_id: str, name: str, tracer=None, **attrs):
+        self.id = trace_id
+        self.name = name
+        self.tracer = tracer
+        self.attrs = attrs
+        self.started = time.time()
+        self.origin = time.monotonic()
+        self.spans = []
+        self.status = None
+        self.duration = None
+
+    def _ms(self, moment: float) -> float:
+        return round((moment - self.origin) * 1000, 1)
+
+    def add_span(self, name: str, start: float, end: float = None, **attrs) -> dict:
+        """
+        start / end 为 time.monotonic() 的时间；list.append 是原子的，可在多个线程中调用
+        """
+        end = time.monotonic() if end is None else end
+        span = {'name': name, 'start': self._ms(start), 'duration': round((end - start) * 1000, 1), **attrs}
+        self.spans.append(span)
+        return span
+
+    def mark(self, name: str, **attrs) -> dict:
+        return self.add_span(name, time.monotonic(), time.monotonic(), **attrs)
+
+    @contextlib.contextmanager
+    def span(self, name: str, **attrs):
+        """
+        记录代码块的耗时；代码块中可向返回的 dict 添加属性，出错时记下错误信息
+        """
+        start = time.monotonic()
+        extra = dict(attrs)
+        try:
+            yield extra
+        except GeneratorExit:
+            extra['status'] = 'cancelled'
+            raise
+        except Exception as e:
+            extra['error'] = str(e)
+            raise
+        finally:
+            self.add_span(name, start, **extra)
+
+    def first(self, name: str) -> dict:
+        return next((s for s in self.spans if s['name'] == name), None)
+
+    def finish(self, status: str = 'success', **attrs):
+        """
+        可重复调用，只有第一次生效
+        """
+        if self.status is not None:
+            return
+        self.status = status
+        self.duration = round((time.monotonic() - self.origin) * 1000, 1)
+        self.attrs.update(attrs)
+        if self.tracer:
+            self.tracer.store(self)
+
+    def to_dict(self, spans: bool = True) -> dict:
+        queue = self.first('queue_wait')
+        first_token = self.first('first_token')
+        data = {
+            'id': self.id,
+            'name': self.name,
+            'time': datetime.fromtimestamp(self.started).isoformat(timespec='milliseconds'),
+            'status': self.status,
+            'duration': self.duration,
+            'queue_ms': queue['duration'] if queue else None,
+            'first_token_ms': first_token['start'] if first_token else None,
+            'attempts': sum(1 for s in self.spans if s['name'] == 'attempt'),
+            **self.attrs
+        }
+        if spans:
+            data['spans'] = sorted(self.spans, key=lambda s: s['start'])
+        return data
+
+
+class Tracer:
+    def __init__(self, size: int = BUFFER_SIZE, export_dir: str = None):
+        self.traces = deque(maxlen=size)
+        self.lock = threading.Lock()
+        self.export_dir = export_dir
+
+    def start(self, name: str, trace_id: str = None, **attrs) -> Trace:
+        return Trace(trace_id or uuid.uuid4().hex, name, self, **attrs)
+
+    def store(self, trace: Trace):
+        with self.lock:
+            self.traces.append(trace)
+        if self.export_dir:
+            try:
+                self.export(trace)
+            except OSError as e:
+                logger.error(f"Failed to export trace {trace.id}: {e}")
+
+    def export(self, trace: Trace):
+        path = os.path.join(ensure_dir(self.export_dir), f'{datetime.fromtimestamp(trace.started):%Y-%m-%d}.jsonl')
+        line = json.dumps(trace.to_dict(), ensure_ascii=False)
+        with file_lock(path), open(path, 'a', encoding='utf-8') as f:
+            f.write(line + '\n')
+
+    def recent(self, limit: int = 50, min_ms: float = 0, name: str = None, status: str = None) -> list:
+        with self.lock:
+            traces = list(self.traces)
+        traces = [t for t in reversed(traces)
+                  if t.duration >= min_ms and (not name or t.name == name) and (not status or t.status == status)]
+        return [t.to_dict(spans=False) for t in traces[:limit]]
+
+    def get(self, trace_id: str):
+        with self.lock:
+            return next((t for t in reversed(self.traces) if t.id == trace_id), None)
+
+
+tracer = Tracer(export_dir=EXPORT_DIR if os.environ.get('NOVEL_TRACE_EXPORT') == '1' else None)
+
+
+def start_trace(route: str) -> Trace:
+    """
+    在生成接口开头调用，以当前请求 ID 开始一条 Trace，并保存在 g.trace 中供请求处理中的其他模块使用
+    """
+    if not has_request_context():
+        return tracer.start(route)
+    g.trace = tracer.start(route, request_id(), path=request.path)
+    return g.trace
+
+
+def bind(trace):
+    """
+    在执行上游调用的线程中绑定 Trace（线程各自持有 contextvars，新线程不继承）
+    """
+    current_trace.set(trace)
+
+
+def span(name: str, **attrs):
+    """
+    在当前绑定的 Trace 中记录一个阶段，供各后端在上游调用中使用
+    """
+    trace = current_trace.get()
+    return trace.span(name, **attrs) if trace else contextlib.nullcontext({})
+
+
+def first_byte(chunks):
+    """
+    包装上游的响应迭代器，收到第一块数据时记录 first_byte
+    """
+    trace = current_trace.get()
+    if trace is None:
+        yield from chunks
+        return
+    marked = False
+    for chunk in chunks:
+        if not marked:
+            trace.mark('first_byte')
+            marked = True
+        yield chunk
+
+
+@traces_bp.route('/traces', methods=['GET'])
+def list_traces():
+    """
+    最近结束的请求（最新的在前）；min_ms 只看耗时超过该毫秒数的请求，route、status 过滤
+    """
+    limit = min(request.args.get('limit', 50, type=int), BUFFER_SIZE)
+    return json_response({'traces': tracer.recent(
+        limit, request.args.get('min_ms', 0, type=float), request.args.get('route'), request.args.get('status')
+    )})
+
+
+@traces_bp.route('/traces/<trace_id>', methods=['GET'])
+def get_trace(trace_id):
+    trace = tracer.get(trace_id)
+    if trace is None:
+        return json_response({'error': '未找到该请求的记录（可能已被新的记录覆盖，或由其他 worker 处理）'}, 404)
+    return json_response(trace.to_dict())
@@ -0,0 +1,288 @@
+"""
+用量与费用账本
+
+各后端在流式输出结束时产出一个 Usage（服务商返回的实际 token 数），由 resilient_stream 取出，
+不会发送给客户端；连同请求、路由、模型、密钥、项目与功能（拆书、优化、聊天等）记入账本。
+服务商没有返回用量（或调用中途被取消）时按 token_estimator 估算，并标记为 estimated。
+
+记录先放入内存缓冲，由后台线程每 FLUSH_INTERVAL 秒批量写入：
+按小时、按天的汇总累加到 shared_state 的计数器，逐条明细追加到 data/usage/<日期>.jsonl
+"""
+import atexit
+import json
+import logging
+import os
+import threading
+import time
+import uuid
+from datetime import datetime, timedelta
+
+from flask import Blueprint, request
+
+from common import DATA_DIR, ensure_dir, json_response
+from shared_state import file_lock, shared_state
+from token_estimator import estimate_route_tokens, route_models
+from tracing import request_id
+
+logger = logging.getLogger(__name__)
+
+usage_bp = Blueprint('usage', __name__)
+
+USAGE_DIR = os.path.join(DATA_DIR, 'usage')
+FLUSH_INTERVAL = 5.0
+FLUSH_SIZE = 200  # 缓冲达到该条数时立即写入
+HOURLY_RETENTION_DAYS = 14  # 按小时的汇总只保留最近两周，按天的汇总长期保留
+DIMENSIONS = ('feature', 'route', 'model', 'key', 'project')
+FIELDS = ('calls', 'prompt_tokens', 'completion_tokens', 'cost')
+
+# 价格：元 / 百万 tokens（输入, 输出），按模型名称中的关键字顺序匹配；美元价格按 1:7.2 折算
+PRICES = [
+    ('gpt-4o-mini', 1.08, 4.32),
+    ('gpt-4o', 18.0, 72.0),
+    ('gpt-4', 216.0, 432.0),
+    ('gpt-3.5', 3.6, 10.8),
+    ('haiku', 1.8, 9.0),
+    ('sonnet', 21.6, 108.0),
+    ('opus', 108.0, 540.0),
+    ('gemini', 9.0, 36.0),
+    ('qwen-max', 20.0, 60.0),
+    ('qwen-plus', 0.8, 2.0),
+    ('qwen-turbo', 0.3, 0.6),
+    ('qwen', 4.0, 12.0),
+    ('deepseek', 2.0, 8.0),
+    ('ernie', 0.8, 2.0),
+    ('doubao', 0.8, 2.0),
+]
+# 按完整模型名称指定的价格，优先于 PRICES，由各后端登记（如本地模型不计费）
+model_prices = {}
+
+
+class Usage:
+    """
+    上游生成器在输出结束时产出的用量；key 为密钥的标识（不是密钥本身），
+    eval_seconds 为服务商报告的生成耗时
+    """
+    __slots__ = ('model', 'prompt_tokens', 'completion_tokens', 'key', 'eval_seconds')
+
+    def __init__(self, model: str = None, prompt_tokens: int = 0, completion_tokens: int = 0,
+                 key: str = None, eval_seconds: float = None):
+        self.model = model
+        self.prompt_tokens = prompt_tokens or 0
+        self.completion_tokens = completion_tokens or 0
+        self.key = key
+        self.eval_seconds = eval_seconds
+
+
+def key_label(api_key: str) -> str:
+    """
+    账本中只记录密钥末四位，用于区分不同密钥
+    """
+    return f'…{api_key[-4:]}' if api_key else None
+
+
+def price_for(model: str) -> tuple:
+    if model in model_prices:
+        return model_prices[model]
+    name = (model or '').lower()
+    for keyword, input_price, output_price in PRICES:
+        if keyword in name:
+            return input_price, output_price
+    return 0.0, 0.0
+
+
+def compute_cost(model: str, prompt_tokens: int, completion_tokens: int) -> float:
+    input_price, output_price = price_for(model)
+    return (prompt_tokens * input_price + completion_tokens * output_price) / 1_000_000
+
+
+def request_tags(data: dict, feature: str = 'generate') -> dict:
+    """
+    生成接口的账本标签：请求体中的 feature（如 splitter、chat）与 project_id，
+    请求 ID 与该请求的 Trace 相同
+    """
+    return {
+        'feature': data.get('feature') or feature,
+        'project': data.get('project_id'),
+        'request_id': request_id()
+    }
+
+
+class UsageLedger:
+    def __init__(self, state=shared_state, root: str = USAGE_DIR):
+        self.state = state
+        self.root = root
+        self.lock = threading.Lock()
+        self.pending = []
+        self.pid = None
+        self.pruned_hour = None
+
+    def record(self, route: str, prompt: str, text: str, usage: Usage = None, tags: dict = None,
+               seconds: float = 0):
+        """
+        记录一次上游调用；usage 为空时按提示词与输出文本估算
+        """
+        tags = tags or {}
+        model = (usage and usage.model) or route_models.get(route)
+        if usage is not None:
+            prompt_tokens, completion_tokens = usage.prompt_tokens, usage.completion_tokens
+        else:
+            prompt_tokens = estimate_route_tokens(prompt, route)
+            completion_tokens = estimate_route_tokens(text, route)
+        entry = {
+            'time': time.time(),
+            'request_id': tags.get('request_id') or uuid.uuid4().hex,
+            'feature': tags.get('feature') or 'generate',
+            'route': route,
+            'model': model,
+            'key': usage.key if usage else None,
+            'project': tags.get('project'),
+            'prompt_tokens': prompt_tokens,
+            'completion_tokens': completion_tokens,
+            'cost': round(compute_cost(model, prompt_tokens, completion_tokens), 6),
+            'estimated': usage is None,
+            'seconds': round(seconds, 3)
+        }
+        if usage is not None and usage.eval_seconds is not None:
+            entry['eval_seconds'] = round(usage.eval_seconds, 3)
+
+        self._ensure_flusher()
+        with self.lock:
+            self.pending.append(entry)
+            full = len(self.pending) >= FLUSH_SIZE
+        if full:
+            self.flush()
+
+    def _ensure_flusher(self):
+        with self.lock:
+            if self.pid == os.getpid():
+                return
+            # fork 出的 worker 不继承父进程的后台线程，也不重复写入父进程缓冲中的记录
+            self.pid = os.getpid()
+            self.pending = []
+        threading.Thread(target=self._flush_loop, name='usage-ledger', daemon=True).start()
+
+    def _flush_loop(self):
+        pid = os.getpid()
+        while self.pid == pid:
+            time.sleep(FLUSH_INTERVAL)
+            try:
+                self.flush()
+            except Exception as e:
+                logger.error(f"Failed to flush usage ledger: {e}")
+
+    @staticmethod
+    def counter_name(period: str, entry: dict, field: str) -> str:
+        """
+        计数器名以时间段开头（如 usage:hour:2024-05-01T13），其后是各维度与字段的 JSON 数组
+        """
+        dims = [entry[d] for d in DIMENSIONS] + [field]
+        return f"usage:{period} {json.dumps(dims, ensure_ascii=False)}"
+
+    def flush(self):
+        with self.lock:
+            entries, self.pending = self.pending, []
+        if not entries:
+            return
+        counters = {}
+        lines = {}
+        for entry in entries:
+            when = datetime.fromtimestamp(entry['time'])
+            for period in (f'hour:{when:%Y-%m-%dT%H}', f'day:{when:%Y-%m-%d}'):
+                for field in FIELDS:
+                    name = self.counter_name(period, entry, field)
+                    counters[name] = counters.get(name, 0) + (1 if field == 'calls' else entry[field])
+            lines.setdefault(f'{when:%Y-%m-%d}', []).append(json.dumps(entry, ensure_ascii=False))
+
+        with self.state.transaction() as conn:
+            self.state.add_counters(conn, counters)
+            self._prune(conn)
+        ensure_dir(self.root)
+        for date, day_lines in lines.items():
+            path = os.path.join(self.root, f'{date}.jsonl')
+            with file_lock(path), open(path, 'a', encoding='utf-8') as f:
+                f.write('\n'.join(day_lines) + '\n')
+
+    def _prune(self, conn):
+        hour = f'{datetime.now():%Y-%m-%dT%H}'
+        if hour == self.pruned_hour:
+            return
+        cutoff = datetime.now() - timedelta(days=HOURLY_RETENTION_DAYS)
+        self.state.delete_counters(conn, 'usage:hour:', f'usage:hour:{cutoff:%Y-%m-%d}')
+        self.pruned_hour = hour
+
+    def summary(self, period: str, start: str, end: str, group_by=DIMENSIONS) -> dict:
+        """
+        汇总 [start, end] 时间段（day 为日期，hour 为 YYYY-MM-DDTHH）的用量，按 group_by 中的维度分组
+        """
+        self.flush()
+        counters = self.state.counters_between(f'usage:{period}:{start}', f'usage:{period}:{end}\uffff')
+        rows = {}
+        totals = dict.fromkeys(FIELDS, 0)
+        for name, value in counters.items():
+            head, dims = name.split(' ', 1)
+            *values, field = json.loads(dims)
+            entry = dict(zip(DIMENSIONS, values))
+            group = (head.split(':', 2)[2],) + tuple(entry[d] for d in group_by)
+            row = rows.setdefault(group, {'time': group[0], **{d: entry[d] for d in group_by},
+                                          **dict.fromkeys(FIELDS, 0)})
+            row[field] += value
+            totals[field] += value
+        for row in [*rows.values(), totals]:
+            for field in ('calls', 'prompt_tokens', 'completion_tokens'):
+                row[field] = int(row[field])
+            row['cost'] = round(row['cost'], 4)
+        return {
+            'period': period,
+            'currency': 'CNY',
+            'rows': sorted(rows.values(), key=lambda r: (r['time'], -r['cost'])),
+            'totals': totals
+        }
+
+    def entries(self, date: str, limit: int = 100, **filters) -> list:
+        """
+        某一天的逐条明细（最近的在前），filters 按维度或 request_id 过滤
+        """
+        self.flush()
+        path = os.path.join(self.root, f'{date}.jsonl')
+        if not os.path.exists(path):
+            return []
+        with open(path, encoding='utf-8') as f:
+            entries = [json.loads(line) for line in f if line.strip()]
+        entries = [e for e in entries if all(e.get(k) == v for k, v in filters.items() if v)]
+        return entries[::-1][:limit]
+
+
+usage_ledger = UsageLedger()
+atexit.register(usage_ledger.flush)
+
+
+@usage_bp.route('/usage', methods=['GET'])
+def usage_summary():
+    """
+    period=day（默认最近 7 天）或 hour（默认最近 24 小时），可用 start/end 指定范围；
+    group_by 为逗号分隔的维度，默认按功能与模型汇总
+    """
+    period = request.args.get('period', 'day')
+    if period not in ('day', 'hour'):
+        return json_response({'error': 'period 只能是 day 或 hour'}, 400)
+    now = datetime.now()
+    if period == 'day':
+        start, end = f'{now - timedelta(days=6):%Y-%m-%d}', f'{now:%Y-%m-%d}'
+    else:
+        start, end = f'{now - timedelta(hours=23):%Y-%m-%dT%H}', f'{now:%Y-%m-%dT%H}'
+    group_by = [d for d in request.args.get('group_by', 'feature,model').split(',') if d in DIMENSIONS]
+    return json_response(usage_ledger.summary(
+        period, request.args.get('start', start), request.args.get('end', end), group_by
+    ))
+
+
+@usage_bp.route('/usage/requests', methods=['GET'])
+def usage_requests():
+    date = request.args.get('date', f'{datetime.now():%Y-%m-%d}')
+    try:
+        datetime.strptime(date, '%Y-%m-%d')
+    except ValueError:
+        return json_response({'error': '日期格式应为 YYYY-MM-DD'}, 400)
+    filters = {name: request.args.get(name) for name in (*DIMENSIONS, 'request_id')}
+    limit = min(request.args.get('limit', 100, type=int), 1000)
+    return json_response({'date': date, 'entries': usage_ledger.entries(date, limit, **filters)})